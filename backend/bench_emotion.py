@@ -0,0 +1,146 @@
+# bench_emotion.py
+# Offline latency/throughput benchmark for the emotion serving path. It drives the real
+# route_emotion functions (decode_gray, extract_face, to_tensor, load_model) and writes the
+# results as JSON so runs can be compared.
+#
+#   python bench_emotion.py --backends eager,onnx --batch-sizes 1,8,32 --threads 1,4 --output bench.json
+#   python bench_emotion.py --baseline bench.json   # compare against an earlier run
+import argparse
+import datetime
+import glob
+import json
+import os
+import platform
+import time
+import numpy as np
+import torch
+
+import route_emotion
+from bench_preprocess import synthetic_frames
+
+
+def summarize(timings_ms):
+    timings = np.asarray(timings_ms)
+    return {
+        "runs": int(timings.size),
+        "mean_ms": round(float(timings.mean()), 4),
+        "p50_ms": round(float(np.percentile(timings, 50)), 4),
+        "p95_ms": round(float(np.percentile(timings, 95)), 4),
+        "p99_ms": round(float(np.percentile(timings, 99)), 4),
+    }
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, 1000.0 * (time.perf_counter() - start)
+
+
+def load_frames(images_dir):
+    frames = synthetic_frames([(640, 480), (1280, 720)])
+    if images_dir:
+        for path in sorted(glob.glob(os.path.join(images_dir, "*.jpg")) + glob.glob(os.path.join(images_dir, "*.png"))):
+            with open(path, "rb") as f:
+                frames.append((os.path.basename(path), f.read()))
+    return frames
+
+
+def bench_stages(frames, runs):
+    # Per-frame stages, measured one after the other on the same frame
+    results = {}
+    for name, data in frames:
+        stages = {"decode": [], "extract_face": [], "transform": []}
+        for _ in range(runs):
+            gray, ms = timed(route_emotion.decode_gray, data)
+            stages["decode"].append(ms)
+            face, ms = timed(route_emotion.extract_face, gray)
+            stages["extract_face"].append(ms)
+            _, ms = timed(route_emotion.to_tensor, face)
+            stages["transform"].append(ms)
+        results[name] = {stage: summarize(t) for stage, t in stages.items()}
+    return results
+
+
+def bench_forward(model, batch_size, runs, warmup=3):
+    batch = torch.randn(batch_size, route_emotion.INPUT_CHANNELS, route_emotion.INPUT_SIZE, route_emotion.INPUT_SIZE)
+    timings = []
+    with torch.no_grad():
+        for i in range(warmup + runs):
+            _, ms = timed(model, batch)
+            if i >= warmup:
+                timings.append(ms)
+    result = summarize(timings)
+    result["images_per_sec"] = round(1000.0 * batch_size / result["p50_ms"], 2)
+    return result
+
+
+def compare(results, baseline_path):
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+
+    def key(r):
+        return (r["backend"], r["threads"], r["batch_size"])
+
+    before = {key(r): r for r in baseline.get("forward", []) if "p50_ms" in r}
+    print(f"Compared with {baseline_path} (p50 ratio, >1 is slower):")
+    for r in results["forward"]:
+        if "p50_ms" in r and key(r) in before:
+            ratio = r["p50_ms"] / before[key(r)]["p50_ms"]
+            flag = "  REGRESSION" if ratio > 1.1 else ""
+            print(f"  {r['backend']:<12} threads {r['threads']:>2} batch {r['batch_size']:>3}: {ratio:6.2f}{flag}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the emotion-recognition serving path.")
+    parser.add_argument("--backends", default="eager", help="comma separated: eager,torchscript,onnx,int8")
+    parser.add_argument("--batch-sizes", default="1,4,16")
+    parser.add_argument("--threads", default=str(torch.get_num_threads()), help="comma separated torch/ORT thread counts")
+    parser.add_argument("--runs", type=int, default=30)
+    parser.add_argument("--images", default=None, help="folder of sample .jpg/.png frames")
+    parser.add_argument("--output", default="bench_emotion.json")
+    parser.add_argument("--baseline", default=None, help="earlier JSON output to compare against")
+    args = parser.parse_args()
+
+    backends = [b.strip() for b in args.backends.split(",") if b.strip()]
+    batch_sizes = [int(b) for b in args.batch_sizes.split(",")]
+    thread_counts = [int(t) for t in args.threads.split(",")]
+
+    results = {
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "host": {"platform": platform.platform(), "cpus": os.cpu_count(), "torch": torch.__version__},
+        "config": {"backends": backends, "batch_sizes": batch_sizes, "threads": thread_counts,
+                   "runs": args.runs, "input_size": route_emotion.INPUT_SIZE,
+                   "input_channels": route_emotion.INPUT_CHANNELS},
+        "stages": bench_stages(load_frames(args.images), args.runs),
+        "forward": [],
+    }
+
+    for threads in thread_counts:
+        torch.set_num_threads(threads)
+        route_emotion.TORCH_THREADS = threads  # picked up by the ONNX Runtime session
+        for backend in backends:
+            try:
+                model = route_emotion.load_model(backend)
+            except Exception as e:
+                results["forward"].append({"backend": backend, "threads": threads, "error": str(e)})
+                print(f"{backend:<12} threads {threads:>2}: skipped ({e})")
+                continue
+            for batch_size in batch_sizes:
+                result = bench_forward(model, batch_size, args.runs)
+                results["forward"].append({"backend": backend, "threads": threads, "batch_size": batch_size, **result})
+                print(f"{backend:<12} threads {threads:>2} batch {batch_size:>3}: p50 {result['p50_ms']:9.2f} ms | "
+                      f"p95 {result['p95_ms']:9.2f} ms | p99 {result['p99_ms']:9.2f} ms | {result['images_per_sec']:8.1f} img/s")
+
+    for name, stages in results["stages"].items():
+        print(f"{name}: " + " | ".join(f"{stage} p50 {s['p50_ms']:.2f} ms" for stage, s in stages.items()))
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.baseline:
+        compare(results, args.baseline)
+
+
+if __name__ == "__main__":
+    main()
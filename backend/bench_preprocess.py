@@ -0,0 +1,95 @@
+# bench_preprocess.py
+# Compares the original PIL preprocessing chain with route_emotion's grayscale path:
+# timing per frame and the numerical difference of the resulting model inputs. Every frame is
+# cropped three ways: a square face, a non-square face and the whole frame (the no-face fallback).
+#
+#   python bench_preprocess.py [--images DIR] [--runs 50]
+import argparse
+import glob
+import io
+import os
+import time
+import cv2
+import numpy as np
+from PIL import Image
+
+import route_emotion
+
+
+# Decoders and resamplers round differently; allow a few grey levels of difference per pixel
+TOLERANCE = 3.0 / (255.0 * (min(route_emotion.STD) if route_emotion.INPUT_CHANNELS == 3 else 1.0))
+
+
+def legacy_preprocess(data: bytes, rect):
+    # The chain predict_emotion used before: RGB decode, BGR and gray copies, crop, PIL "L", TRANSFORM.
+    # The face rectangle is fixed so both paths time only decoding and preprocessing.
+    image = Image.open(io.BytesIO(data)).convert("RGB")
+    image_cv = cv2.cvtColor(np.array(image), cv2.COLOR_RGB2BGR)
+    cv2.cvtColor(image_cv, cv2.COLOR_BGR2GRAY)
+    x, y, w, h = rect
+    face = image_cv[y:y + h, x:x + w]
+    return route_emotion.TRANSFORM(Image.fromarray(cv2.cvtColor(face, cv2.COLOR_BGR2RGB)).convert("L"))
+
+
+def lean_preprocess(data: bytes, rect):
+    x, y, w, h = rect
+    return route_emotion.to_tensor(route_emotion.decode_gray(data)[y:y + h, x:x + w])
+
+
+def synthetic_frames(sizes, seed=0):
+    # Smooth noise looks more like a camera frame than white noise and compresses realistically
+    rng = np.random.default_rng(seed)
+    frames = []
+    for width, height in sizes:
+        small = rng.integers(0, 256, (height // 16, width // 16, 3), dtype=np.uint8)
+        frame = cv2.resize(small, (width, height), interpolation=cv2.INTER_CUBIC)
+        frames.append((f"synthetic-{width}x{height}", cv2.imencode(".jpg", frame)[1].tobytes()))
+    return frames
+
+
+def crops(data: bytes):
+    # Haar boxes are square, but ROI-tracked and fallback crops need not be
+    height, width = route_emotion.decode_gray(data).shape
+    side = int(min(width, height) * 0.4)
+    tall_w, tall_h = min(width, int(side * 0.7)), min(height, side)
+    return [("square", ((width - side) // 2, (height - side) // 2, side, side)),
+            ("non-square", ((width - tall_w) // 2, (height - tall_h) // 2, tall_w, tall_h)),
+            ("whole frame", (0, 0, width, height))]
+
+
+def time_ms(fn, data, rect, runs):
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        fn(data, rect)
+        timings.append(1000.0 * (time.perf_counter() - start))
+    return float(np.median(timings))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Microbenchmark for emotion preprocessing.")
+    parser.add_argument("--images", default=None, help="folder of sample .jpg/.png frames")
+    parser.add_argument("--runs", type=int, default=50)
+    args = parser.parse_args()
+
+    frames = synthetic_frames([(640, 480), (1280, 720), (260, 180)])
+    if args.images:
+        for path in sorted(glob.glob(os.path.join(args.images, "*.jpg")) + glob.glob(os.path.join(args.images, "*.png"))):
+            with open(path, "rb") as f:
+                frames.append((os.path.basename(path), f.read()))
+
+    print(f"{'frame':<28}{'crop':<13}{'legacy ms':>11}{'lean ms':>10}{'speedup':>9}{'max diff':>10}{'mean diff':>11}  (tolerance {TOLERANCE:.4f})")
+    for name, data in frames:
+        for crop, rect in crops(data):
+            reference = legacy_preprocess(data, rect)
+            lean = lean_preprocess(data, rect)
+            diff = (reference - lean).abs()
+
+            legacy_ms = time_ms(legacy_preprocess, data, rect, args.runs)
+            lean_ms = time_ms(lean_preprocess, data, rect, args.runs)
+            print(f"{name[:27]:<28}{crop:<13}{legacy_ms:>11.3f}{lean_ms:>10.3f}{legacy_ms / lean_ms:>8.1f}x"
+                  f"{diff.max().item():>10.4f}{diff.mean().item():>11.5f}  {'ok' if diff.max() <= TOLERANCE else 'MISMATCH'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+# helper_batching.py
+import asyncio
+import time
+from collections import Counter
+
+
+class MicroBatcher:
+    """
+    Collects single inputs from concurrent callers for up to `max_wait_ms` (or until
+    `max_batch_size` items are queued), runs them through one `run_batch` call and
+    hands every caller back its own result.
+
+    `run_batch` receives a list of items and must return a sequence of results in the
+    same order. When an `executor` (see helper_executor.BoundedExecutor) is given the
+    batch runs on it instead of on the event loop.
+    """
+
+    def __init__(self, run_batch, max_batch_size: int = 16, max_wait_ms: float = 5.0, executor=None):
+        if max_batch_size < 1:
+            raise ValueError("max_batch_size must be at least 1")
+        self.run_batch = run_batch
+        self.executor = executor
+        self.max_batch_size = int(max_batch_size)
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000.0
+
+        self._queue = None
+        self._worker = None
+        self._loop = None
+
+        self._batches = 0
+        self._items = 0
+        self._errors = 0
+        self._max_seen = 0
+        self._busy_time = 0.0
+        self._size_hist = Counter()
+
+    def _ensure_worker(self):
+        # The queue and worker are bound to the running loop; recreate them if the
+        # loop changed (e.g. a new TestClient) or the worker died.
+        loop = asyncio.get_running_loop()
+        if self._worker is None or self._worker.done() or self._loop is not loop:
+            self._loop = loop
+            self._queue = asyncio.Queue()
+            self._worker = loop.create_task(self._run())
+
+    async def submit(self, item):
+        """Queue one item and wait for its result."""
+        self._ensure_worker()
+        future = self._loop.create_future()
+        await self._queue.put((item, future))
+        return await future
+
+    async def _collect(self):
+        item, future = await self._queue.get()
+        batch = [(item, future)]
+        deadline = self._loop.time() + self.max_wait
+
+        while len(batch) < self.max_batch_size:
+            # Take everything that is already waiting before sleeping on the queue.
+            if not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+                continue
+            timeout = deadline - self._loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _execute(self, items):
+        if self.executor is not None:
+            return await self.executor.run(self.run_batch, items)
+        return self.run_batch(items)
+
+    async def _run(self):
+        while True:
+            batch = await self._collect()
+            # Callers that were cancelled while waiting do not need a slot in the batch.
+            batch = [(item, future) for item, future in batch if not future.done()]
+            if not batch:
+                continue
+
+            items = [item for item, _ in batch]
+            start = time.perf_counter()
+            try:
+                results = await self._execute(items)
+            except Exception as e:
+                self._errors += 1
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            finally:
+                self._record(len(batch), time.perf_counter() - start)
+
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+    def _record(self, size: int, elapsed: float):
+        self._batches += 1
+        self._items += size
+        self._busy_time += elapsed
+        self._max_seen = max(self._max_seen, size)
+        self._size_hist[size] += 1
+
+    def stats(self) -> dict:
+        return {
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": self.max_wait * 1000.0,
+            "queue_depth": self._queue.qsize() if self._queue is not None else 0,
+            "batches": self._batches,
+            "items": self._items,
+            "errors": self._errors,
+            "avg_batch_size": round(self._items / self._batches, 3) if self._batches else 0.0,
+            "max_batch_size_seen": self._max_seen,
+            "avg_batch_ms": round(1000.0 * self._busy_time / self._batches, 3) if self._batches else 0.0,
+            "batch_size_histogram": {str(k): v for k, v in sorted(self._size_hist.items())},
+        }
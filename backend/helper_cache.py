@@ -0,0 +1,94 @@
+# helper_cache.py
+import time
+from collections import OrderedDict
+import cv2
+import numpy as np
+
+
+def dhash(gray: np.ndarray, size: int = 8) -> int:
+    """
+    Difference hash of a grayscale image: shrink to (size+1)x size and record whether each
+    pixel is brighter than its right neighbour. Near-identical frames differ in few bits.
+    """
+    small = cv2.resize(gray, (size + 1, size), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+class PerceptualCache:
+    """
+    Per-session LRU/TTL cache keyed by perceptual hash. A lookup hits when a stored hash of the
+    same session is within `threshold` bits (Hamming distance) and younger than `ttl` seconds.
+
+    Not thread-safe: use it from the event loop only.
+    """
+
+    def __init__(self, threshold: int = 4, ttl: float = 2.0, entries_per_session: int = 8, max_sessions: int = 1000):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.entries_per_session = max(1, int(entries_per_session))
+        self.max_sessions = max(1, int(max_sessions))
+        self._sessions = OrderedDict()
+
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._expired = 0
+
+    def lookup(self, session_id: str, frame_hash: int):
+        entries = self._sessions.get(session_id)
+        if entries is None:
+            self._misses += 1
+            return None
+
+        now = time.monotonic()
+        for key in [k for k, (_, stored) in entries.items() if now - stored > self.ttl]:
+            del entries[key]
+            self._expired += 1
+
+        best_key, best_distance = None, self.threshold + 1
+        for key in entries:
+            distance = bin(key ^ frame_hash).count("1")
+            if distance < best_distance:
+                best_key, best_distance = key, distance
+
+        if best_key is None:
+            self._misses += 1
+            return None
+
+        self._hits += 1
+        entries.move_to_end(best_key)
+        self._sessions.move_to_end(session_id)
+        return entries[best_key][0]
+
+    def store(self, session_id: str, frame_hash: int, value):
+        entries = self._sessions.get(session_id)
+        if entries is None:
+            if len(self._sessions) >= self.max_sessions:
+                _, dropped = self._sessions.popitem(last=False)
+                self._evictions += len(dropped)
+            entries = self._sessions[session_id] = OrderedDict()
+
+        entries[frame_hash] = (value, time.monotonic())
+        entries.move_to_end(frame_hash)
+        self._sessions.move_to_end(session_id)
+        while len(entries) > self.entries_per_session:
+            entries.popitem(last=False)
+            self._evictions += 1
+
+    def forget(self, session_id: str):
+        self._sessions.pop(session_id, None)
+
+    def stats(self) -> dict:
+        lookups = self._hits + self._misses
+        return {
+            "threshold": self.threshold,
+            "ttl": self.ttl,
+            "sessions": len(self._sessions),
+            "entries": sum(len(e) for e in self._sessions.values()),
+            "hits": self._hits,
+            "misses": self._misses,
+            "hit_rate": round(self._hits / lookups, 3) if lookups else 0.0,
+            "evictions": self._evictions,
+            "expired": self._expired,
+        }
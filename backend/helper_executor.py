@@ -0,0 +1,115 @@
+# helper_executor.py
+import asyncio
+import multiprocessing
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from fastapi import HTTPException
+
+
+class BoundedExecutor:
+    """
+    A thread or process pool for CPU-bound work that async routes can await without
+    blocking the event loop.
+
+    At most `max_workers` jobs run at once and at most `max_pending` more may wait for a
+    free worker; further submissions are rejected with a 503 so one hot endpoint cannot
+    build an unbounded backlog.
+
+    Process pools use the "spawn" start method (forking a process that already runs
+    torch threads can deadlock), so `fn` must be importable from a module, and exceptions
+    it raises must be picklable. If a worker process dies the calls it took down fail with
+    a 503 and the pool is rebuilt for the next call. Module state of a worker process
+    (caches, trackers) is not shared with the caller: pass such state in and out of `fn`.
+    """
+
+    def __init__(self, kind: str = "thread", max_workers: int = 2, max_pending: int = 64, name: str = "cpu",
+                 initializer=None, initargs=()):
+        if kind not in ("thread", "process"):
+            raise ValueError(f"Unknown executor kind: {kind}")
+        self.kind = kind
+        self.name = name
+        self.max_workers = max(1, int(max_workers))
+        self.max_pending = max(0, int(max_pending))
+        self.initializer = initializer
+        self.initargs = initargs
+        self._pool = None
+
+        self._running = 0
+        self._waiting = 0
+        self._completed = 0
+        self._rejected = 0
+        self._restarts = 0
+        self._busy_time = 0.0
+        self._wait_time = 0.0
+        self._slots = None
+        self._loop = None
+
+    def _ensure_pool(self):
+        if self._pool is None:
+            if self.kind == "process":
+                self._pool = ProcessPoolExecutor(max_workers=self.max_workers,
+                                                 mp_context=multiprocessing.get_context("spawn"),
+                                                 initializer=self.initializer, initargs=self.initargs)
+            else:
+                self._pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix=self.name,
+                                                initializer=self.initializer, initargs=self.initargs)
+
+        loop = asyncio.get_running_loop()
+        if self._slots is None or self._loop is not loop:
+            self._loop = loop
+            self._slots = asyncio.Semaphore(self.max_workers)
+
+    async def run(self, fn, *args):
+        """Run `fn(*args)` on the pool and return its result."""
+        self._ensure_pool()
+        if self._slots.locked() and self._waiting >= self.max_pending:
+            self._rejected += 1
+            raise HTTPException(status_code=503, detail=f"{self.name} executor is saturated, try again later")
+
+        queued = time.perf_counter()
+        self._waiting += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self._waiting -= 1
+
+        started = time.perf_counter()
+        self._wait_time += started - queued
+        self._running += 1
+        pool = self._pool
+        try:
+            return await self._loop.run_in_executor(pool, fn, *args)
+        except BrokenProcessPool:
+            # Every call running on the dead pool fails; only the first one replaces it
+            if self._pool is pool:
+                self._restarts += 1
+                pool.shutdown(wait=False, cancel_futures=True)
+                self._pool = None
+                self._ensure_pool()
+            raise HTTPException(status_code=503, detail=f"{self.name} executor worker died, try again")
+        finally:
+            self._running -= 1
+            self._completed += 1
+            self._busy_time += time.perf_counter() - started
+            self._slots.release()
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    def stats(self) -> dict:
+        return {
+            "kind": self.kind,
+            "max_workers": self.max_workers,
+            "max_pending": self.max_pending,
+            "running": self._running,
+            "waiting": self._waiting,
+            "saturation": round((self._running + self._waiting) / (self.max_workers + self.max_pending), 3),
+            "completed": self._completed,
+            "rejected": self._rejected,
+            "restarts": self._restarts,
+            "avg_wait_ms": round(1000.0 * self._wait_time / self._completed, 3) if self._completed else 0.0,
+            "avg_run_ms": round(1000.0 * self._busy_time / self._completed, 3) if self._completed else 0.0,
+        }
@@ -0,0 +1,133 @@
+# helper_tracking.py
+import threading
+import time
+
+
+class FaceTracker:
+    """
+    Remembers the last face rectangle per session so consecutive webcam frames only run the
+    detector on a padded region around it instead of the full frame.
+
+    A full-frame detection is forced every `redetect_every` frames, and whenever the face is
+    not found inside the region. `detect` takes a grayscale image and returns (x, y, w, h) boxes.
+    """
+
+    def __init__(self, detect, redetect_every: int = 10, padding: float = 0.5,
+                 session_ttl: float = 600.0, max_sessions: int = 1000):
+        self.detect = detect
+        self.redetect_every = max(1, int(redetect_every))
+        self.padding = float(padding)
+        self.session_ttl = session_ttl
+        self.max_sessions = max_sessions
+
+        self._sessions = {}
+        self._lock = threading.Lock()
+        self._counts = {"full": 0, "roi": 0, "lost": 0}
+        self._time = {"full": 0.0, "roi": 0.0, "lost": 0.0}
+
+    def locate(self, gray, session_id: str = None):
+        """
+        Return ((x, y, w, h) or None, info) for the first face in `gray`. `info` holds the
+        detection mode ("full", "roi" or "lost") and the time spent detecting in ms.
+        """
+        rect, info = self.track(gray, self._get(session_id))
+        self.record(info)
+        return rect, info
+
+    def track(self, gray, state: dict = None):
+        """
+        The detection step of locate() on an explicit session state ({"rect", "frames"}, updated
+        in place; None for a one-off frame). It touches nothing else on the tracker, so it can run
+        in a worker process while the sessions stay with checkout() and checkin() in the caller.
+        """
+        start = time.perf_counter()
+        mode = "full"
+        rect = None
+        if state is not None and state["rect"] is not None and state["frames"] < self.redetect_every:
+            rect = self._detect_roi(gray, state["rect"])
+            mode = "roi" if rect is not None else "lost"
+
+        if rect is None:
+            rect = self._first(self.detect(gray))
+            if state is not None:
+                state["frames"] = 0
+        if state is not None:
+            state["rect"] = rect
+            state["frames"] += 1
+        return rect, {"mode": mode, "ms": round(1000.0 * (time.perf_counter() - start), 3)}
+
+    def record(self, info: dict):
+        """Count a detection made by track() in the stats."""
+        with self._lock:
+            self._counts[info["mode"]] += 1
+            self._time[info["mode"]] += info["ms"] / 1000.0
+
+    def checkout(self, session_id: str = None):
+        """Copy of a session's state to pass to track(), or None without a session id."""
+        state = self._get(session_id)
+        if state is None:
+            return None
+        with self._lock:
+            return {"rect": state["rect"], "frames": state["frames"]}
+
+    def checkin(self, session_id: str, state: dict, info: dict):
+        """Store the state track() returned for a session and count its detection."""
+        if session_id and state is not None:
+            with self._lock:
+                self._sessions.setdefault(session_id, {"last_used": time.time()}).update(
+                    rect=state["rect"], frames=state["frames"])
+        self.record(info)
+
+    def _detect_roi(self, gray, rect):
+        x, y, w, h = rect
+        pad_x, pad_y = int(w * self.padding), int(h * self.padding)
+        left, top = max(0, x - pad_x), max(0, y - pad_y)
+        right, bottom = min(gray.shape[1], x + w + pad_x), min(gray.shape[0], y + h + pad_y)
+
+        found = self._first(self.detect(gray[top:bottom, left:right]))
+        if found is None:
+            return None
+        fx, fy, fw, fh = found
+        return (fx + left, fy + top, fw, fh)
+
+    @staticmethod
+    def _first(faces):
+        if len(faces) == 0:
+            return None
+        return tuple(int(v) for v in faces[0])
+
+    def _get(self, session_id):
+        if not session_id:
+            return None
+        now = time.time()
+        with self._lock:
+            if session_id not in self._sessions and len(self._sessions) >= self.max_sessions:
+                self._prune(now)
+            state = self._sessions.setdefault(session_id, {"rect": None, "frames": 0, "last_used": now})
+            state["last_used"] = now
+            return state
+
+    def _prune(self, now):
+        stale = [sid for sid, s in self._sessions.items() if now - s["last_used"] > self.session_ttl]
+        for sid in stale:
+            del self._sessions[sid]
+        # Still full: drop the least recently used sessions
+        if len(self._sessions) >= self.max_sessions:
+            oldest = sorted(self._sessions, key=lambda sid: self._sessions[sid]["last_used"])
+            for sid in oldest[:len(self._sessions) - self.max_sessions + 1]:
+                del self._sessions[sid]
+
+    def forget(self, session_id: str):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "sessions": len(self._sessions),
+                "redetect_every": self.redetect_every,
+                "padding": self.padding,
+                "frames": dict(self._counts),
+                "avg_detect_ms": {mode: round(1000.0 * self._time[mode] / n, 3) if n else 0.0
+                                  for mode, n in self._counts.items()},
+            }
@@ -1,70 +1,437 @@
-from fastapi import APIRouter, UploadFile, File, HTTPException
+from fastapi import APIRouter, UploadFile, File, Form, HTTPException, WebSocket
+from typing import List
+import asyncio
 import io
+import os
+import sys
+import tarfile
+import time
+import uuid
+import zipfile
 import torch
 import cv2
 import numpy as np
-from torchvision import models, transforms
+from torchvision import transforms
 from PIL import Image
+from helper_batching import MicroBatcher
+from helper_executor import BoundedExecutor
+from helper_tracking import FaceTracker
+from helper_cache import PerceptualCache, dhash
+
+# Add emotion recognition to path
+sys.path.append(
+    os.path.abspath(
+        os.path.join(os.path.dirname(__file__), "..", "emotion-recognition")
+    )
+)
+
+import model_util
 
 # -------------------- Config -------------------- #
 EMOTIONS = ["Neutral", "Happiness", "Surprise", "Sadness", "Anger", "Disgust", "Fear", "Contempt"]
-MODEL_PATH = "../emotion-recognition/best_model.pth"
+MODEL_PATH = os.getenv("EMOTION_MODEL_PATH", "../emotion-recognition/best_model.pth")
+
+# Inference backend: "eager", "torchscript", "onnx" or "int8". Exported graphs are cached next to
+# MODEL_PATH and rebuilt only when the checkpoint is newer than the cache.
+BACKEND = os.getenv("EMOTION_BACKEND", "eager")
+# int8 models need calibration data, so they are built offline by emotion-recognition/quantize_model.py
+QUANTIZED_MODEL_PATH = os.getenv("EMOTION_QUANTIZED_MODEL_PATH", os.path.splitext(MODEL_PATH)[0] + ".int8.ts")
 
 DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
-TRANSFORM = transforms.Compose([
-    transforms.Grayscale(num_output_channels=3),
-    transforms.Resize((224, 224)),
-    transforms.ToTensor(),
-    transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
-])
+# Micro-batching: concurrent requests are grouped into one forward pass
+BATCH_MAX_SIZE = int(os.getenv("EMOTION_BATCH_MAX_SIZE", "16"))
+BATCH_MAX_WAIT_MS = float(os.getenv("EMOTION_BATCH_MAX_WAIT_MS", "5"))
+
+# CPU work (decode, face detection, forward pass) runs on a bounded pool, not the event loop
+EXECUTOR_KIND = os.getenv("EMOTION_EXECUTOR", "thread")  # "thread" or "process"
+EXECUTOR_WORKERS = int(os.getenv("EMOTION_EXECUTOR_WORKERS", "2"))
+EXECUTOR_MAX_PENDING = int(os.getenv("EMOTION_EXECUTOR_MAX_PENDING", "64"))
+# Multi-image requests
+BATCH_MAX_IMAGES = int(os.getenv("EMOTION_BATCH_MAX_IMAGES", "64"))
+ARCHIVE_MAX_MEMBER_BYTES = 10 * 1024 * 1024
+
+# Per-session face tracking: search near the last face and re-run full detection every N frames
+TRACK_REDETECT_EVERY = int(os.getenv("EMOTION_TRACK_REDETECT_EVERY", "10"))
+TRACK_PADDING = float(os.getenv("EMOTION_TRACK_PADDING", "0.5"))
+
+# Near-duplicate frames of a session reuse the last prediction (Hamming distance on a 64-bit dHash)
+CACHE_ENABLED = os.getenv("EMOTION_CACHE", "1") == "1"
+CACHE_THRESHOLD = int(os.getenv("EMOTION_CACHE_THRESHOLD", "4"))
+CACHE_TTL = float(os.getenv("EMOTION_CACHE_TTL", "2"))
+CACHE_ENTRIES = int(os.getenv("EMOTION_CACHE_ENTRIES", "8"))
+
+# WebSocket streaming: weight of the newest frame in the exponentially smoothed distribution
+STREAM_ALPHA = float(os.getenv("EMOTION_STREAM_ALPHA", "0.3"))
+
+TORCH_THREADS = int(os.getenv("EMOTION_TORCH_THREADS", "0"))  # 0 keeps torch's default
+
+if TORCH_THREADS > 0:
+    torch.set_num_threads(TORCH_THREADS)
+
+# Resolution the checkpoint was trained at (resnet_parameters.input_size); 48-96 for small-stem models.
+# Checkpoints saved with their config record it; older ones need EMOTION_INPUT_SIZE.
+INPUT_SIZE = int(os.getenv("EMOTION_INPUT_SIZE") or model_util.checkpoint_config(MODEL_PATH)["input_size"] or 224)
+MEAN = [0.485, 0.456, 0.406]
+STD = [0.229, 0.224, 0.225]
+
+# Single-channel checkpoints (convert_single_channel.py) take the grayscale face in [0, 1] as is
+INPUT_CHANNELS = model_util.checkpoint_input_channels(MODEL_PATH)
+
+# Reference PIL pipeline; serving uses the equivalent to_tensor below
+if INPUT_CHANNELS == 3:
+    TRANSFORM = transforms.Compose([
+        transforms.Grayscale(num_output_channels=3),
+        transforms.Resize((INPUT_SIZE, INPUT_SIZE)),
+        transforms.ToTensor(),
+        transforms.Normalize(mean=MEAN, std=STD)
+    ])
+    # ToTensor + Normalize folded into one multiply-add per channel: (x / 255 - mean) / std
+    NORM_SCALE = torch.tensor([1.0 / (255.0 * s) for s in STD]).view(3, 1, 1)
+    NORM_SHIFT = torch.tensor([-m / s for m, s in zip(MEAN, STD)]).view(3, 1, 1)
+else:
+    TRANSFORM = transforms.Compose([
+        transforms.Grayscale(num_output_channels=1),
+        transforms.Resize((INPUT_SIZE, INPUT_SIZE)),
+        transforms.ToTensor()
+    ])
+    NORM_SCALE = torch.tensor(1.0 / 255.0).view(1, 1, 1)
+    NORM_SHIFT = None
 
 # Load Model
-def load_model():
-    model = models.resnet18(weights=None)
-    model.fc = torch.nn.Linear(model.fc.in_features, len(EMOTIONS))
-    model.load_state_dict(torch.load(MODEL_PATH, map_location=DEVICE, weights_only=True))
-    model.to(DEVICE)
-    model.eval()
-    return model
+def load_model(backend: str = None):
+    backend = backend or BACKEND
+    base = os.path.splitext(MODEL_PATH)[0]
+
+    if backend == "eager":
+        return model_util.load_checkpoint(MODEL_PATH, DEVICE)
+
+    if backend == "torchscript":
+        path = base + ".ts"
+        if model_util.is_stale(path, MODEL_PATH):
+            model_util.export_torchscript(model_util.load_checkpoint(MODEL_PATH), path, INPUT_SIZE)
+        return model_util.load_torchscript(path, DEVICE)
+
+    if backend == "onnx":
+        path, optimized_path = base + ".onnx", base + ".opt.onnx"
+        if model_util.is_stale(path, MODEL_PATH):
+            model_util.export_onnx(model_util.load_checkpoint(MODEL_PATH), path, INPUT_SIZE)
+        if model_util.is_stale(optimized_path, path):
+            model_util.optimize_onnx(path, optimized_path, TORCH_THREADS)
+        return model_util.OnnxModel(optimized_path, TORCH_THREADS, optimized=True)
+
+    if backend == "int8":
+        if not os.path.exists(QUANTIZED_MODEL_PATH):
+            raise FileNotFoundError(f"{QUANTIZED_MODEL_PATH} not found, run emotion-recognition/quantize_model.py first")
+        # unlike the exported graphs it cannot be rebuilt here, so a model older than the checkpoint is refused
+        if model_util.is_stale(QUANTIZED_MODEL_PATH, MODEL_PATH):
+            raise RuntimeError(f"{QUANTIZED_MODEL_PATH} is older than {MODEL_PATH}, "
+                               f"re-run emotion-recognition/quantize_model.py")
+        # Quantized kernels only run on CPU
+        model = torch.jit.load(QUANTIZED_MODEL_PATH, map_location="cpu")
+        model.eval()
+        return model
+
+    raise ValueError(f"Unknown emotion backend: {backend}")
 
 model = load_model()
 
 # Load Face Detector
 face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + "haarcascade_frontalface_default.xml")
 
-# Extract Face
-def extract_face(image_pil: Image.Image) -> Image.Image:
-    image_cv = cv2.cvtColor(np.array(image_pil), cv2.COLOR_RGB2BGR)
-    gray = cv2.cvtColor(image_cv, cv2.COLOR_BGR2GRAY)
-    faces = face_cascade.detectMultiScale(gray, scaleFactor=1.1, minNeighbors=5)
+def detect_faces(gray: np.ndarray):
+    return face_cascade.detectMultiScale(gray, scaleFactor=1.1, minNeighbors=5)
+
+tracker = FaceTracker(detect_faces, redetect_every=TRACK_REDETECT_EVERY, padding=TRACK_PADDING)
+
+# Decode straight to grayscale. EXIF orientation is ignored, as PIL.Image.open does.
+def decode_gray(data: bytes) -> np.ndarray:
+    gray = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_GRAYSCALE | cv2.IMREAD_IGNORE_ORIENTATION)
+    if gray is None:
+        # Formats OpenCV cannot read still go through PIL
+        gray = np.asarray(Image.open(io.BytesIO(data)).convert("L"))
+    return gray
+
+# View of the face region, or the whole frame if no face was found
+def crop_face(gray: np.ndarray, rect) -> np.ndarray:
+    if rect is None:
+        return gray
+
+    x, y, w, h = rect
+    return gray[y:y + h, x:x + w]
+
+# Extract Face. With a session id only the area around that session's last face is searched;
+# if `detection` is given it receives the detection mode and time.
+def extract_face(gray: np.ndarray, session_id: str = None, detection: dict = None) -> np.ndarray:
+    rect, info = tracker.locate(gray, session_id)
+    if detection is not None:
+        detection.update(info)
+    return crop_face(gray, rect)
+
+# Resize once and normalize into a float tensor; numerically equivalent to TRANSFORM
+def to_tensor(face: np.ndarray, out: torch.Tensor = None) -> torch.Tensor:
+    # PIL's antialiased bilinear filter, the one TRANSFORM's Resize runs. OpenCV's INTER_AREA and
+    # INTER_LINEAR each match it only on some crop shapes, not on faces shrunk along one axis only.
+    resized = np.array(Image.fromarray(np.ascontiguousarray(face)).resize((INPUT_SIZE, INPUT_SIZE), Image.BILINEAR))
+    if out is None:
+        out = torch.empty(INPUT_CHANNELS, INPUT_SIZE, INPUT_SIZE)
+    torch.mul(torch.from_numpy(resized), NORM_SCALE, out=out)
+    if NORM_SHIFT is not None:
+        out.add_(NORM_SHIFT)
+    return out
+
+# Executor side of the pipeline. The session's tracking state is passed in and returned
+# (tracker.checkout / checkin) so it lives on the event loop, also when workers are processes.
+def face_tensor(gray: np.ndarray, state: dict = None):
+    rect, detection = tracker.track(gray, state)
+    return to_tensor(crop_face(gray, rect)), detection, state
+
+# Preprocess a slice of a multi-image request: decode, crop the faces and transform them into one
+# preallocated (N, C, H, W) batch. Returns the batch of the images that could be read and, per
+# image, its detection or the error it raised.
+def preprocess_many(images: List[bytes]):
+    batch = torch.empty(len(images), INPUT_CHANNELS, INPUT_SIZE, INPUT_SIZE)
+    outcomes, filled = [], 0
+    for data in images:
+        try:
+            gray = decode_gray(data)
+            rect, detection = tracker.track(gray)
+            to_tensor(crop_face(gray, rect), out=batch[filled])
+        except Exception as e:
+            outcomes.append(f"Error processing image: {e}")
+            continue
+        outcomes.append(detection)
+        filled += 1
+    return batch[:filled], outcomes
 
-    if len(faces) == 0:
-        return image_pil.convert("L")
+def decode_with_hash(data: bytes):
+    gray = decode_gray(data)
+    return gray, dhash(gray)
 
-    x, y, w, h = faces[0]
-    face = image_cv[y:y + h, x:x + w]
-    return Image.fromarray(cv2.cvtColor(face, cv2.COLOR_BGR2RGB)).convert("L")
+# Unpack a zip or tar upload into (name, bytes) pairs. Runs on the executor, so a bad archive
+# raises a plain ValueError: exceptions that cannot be pickled (HTTPException) break a process pool.
+def read_archive(data: bytes):
+    buffer = io.BytesIO(data)
+    images = []
+    if zipfile.is_zipfile(buffer):
+        try:
+            with zipfile.ZipFile(buffer) as archive:
+                for info in archive.infolist():
+                    if info.is_dir() or info.file_size > ARCHIVE_MAX_MEMBER_BYTES:
+                        continue
+                    images.append((info.filename, archive.read(info)))
+                    if len(images) > BATCH_MAX_IMAGES:
+                        break
+        except zipfile.BadZipFile:
+            raise ValueError("Archive is not a valid zip file")
+        return images
+
+    buffer.seek(0)
+    try:
+        with tarfile.open(fileobj=buffer, mode="r:*") as archive:
+            for member in archive:
+                if not member.isfile() or member.size > ARCHIVE_MAX_MEMBER_BYTES:
+                    continue
+                images.append((member.name, archive.extractfile(member).read()))
+                if len(images) > BATCH_MAX_IMAGES:
+                    break
+    except tarfile.TarError:
+        raise ValueError("Archive must be a zip or tar file")
+    return images
+
+# Batched Inference
+def predict_batch(tensors):
+    batch = tensors if isinstance(tensors, torch.Tensor) else torch.stack(tensors)
+    batch = batch.to("cpu" if BACKEND in ("onnx", "int8") else DEVICE)
+    with torch.no_grad():
+        outputs = model(batch)
+    return torch.softmax(outputs, dim=1).cpu()
+
+executor = BoundedExecutor(EXECUTOR_KIND, max_workers=EXECUTOR_WORKERS, max_pending=EXECUTOR_MAX_PENDING,
+                           name="emotion")
+batcher = MicroBatcher(predict_batch, max_batch_size=BATCH_MAX_SIZE, max_wait_ms=BATCH_MAX_WAIT_MS,
+                       executor=executor)
+frame_cache = PerceptualCache(threshold=CACHE_THRESHOLD, ttl=CACHE_TTL, entries_per_session=CACHE_ENTRIES)
+stream_stats = {"connections": 0, "active": 0, "frames": 0, "dropped": 0}
+
+# Full single-frame pipeline shared by the HTTP and WebSocket routes: cache lookup,
+# face extraction on the executor, then the micro-batched forward pass
+async def predict_frame(data: bytes, session_id: str = None):
+    if not (session_id and CACHE_ENABLED):
+        gray = await executor.run(decode_gray, data)
+    else:
+        gray, frame_hash = await executor.run(decode_with_hash, data)
+        probs = frame_cache.lookup(session_id, frame_hash)
+        if probs is not None:
+            return probs, {"mode": "cached", "ms": 0.0}
+
+    tensor, detection, state = await executor.run(face_tensor, gray, tracker.checkout(session_id))
+    tracker.checkin(session_id, state, detection)
+    probs = await batcher.submit(tensor)
+    if session_id and CACHE_ENABLED:
+        frame_cache.store(session_id, frame_hash, probs)
+    return probs, detection
+
+def probabilities(probs) -> dict:
+    return {e: round(float(p), 4) for e, p in zip(EMOTIONS, probs)}
 
 # -------------------- FastAPI Route -------------------- #
 
 emotion_router = APIRouter()
 
 @emotion_router.post("/predict-emotion")
-async def predict_emotion(file: UploadFile = File(...)):
+async def predict_emotion(file: UploadFile = File(...), session_id: str = Form(None)):
     if not file:
         raise HTTPException(status_code=400, detail="No image uploaded")
 
     try:
-        image = Image.open(io.BytesIO(await file.read())).convert("RGB")
-        face = extract_face(image)
-        tensor = TRANSFORM(face).unsqueeze(0).to(DEVICE)
+        probs, detection = await predict_frame(await file.read(), session_id)
+        return {"emotion": EMOTIONS[int(probs.argmax())], "detection": detection}
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error processing image: {str(e)}")
+
+@emotion_router.post("/predict-emotion/batch")
+async def predict_emotion_batch(files: List[UploadFile] = File(None), archive: UploadFile = File(None)):
+    images = [(f.filename, await f.read()) for f in files or []]
+    if archive is not None:
+        try:
+            images += await executor.run(read_archive, await archive.read())
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+    if not images:
+        raise HTTPException(status_code=400, detail="No images uploaded")
+    if len(images) > BATCH_MAX_IMAGES:
+        raise HTTPException(status_code=413, detail=f"At most {BATCH_MAX_IMAGES} images per request")
 
-        with torch.no_grad():
-            outputs = model(tensor)
-            _, predicted = torch.max(outputs, 1)
+    # Face detection runs on the executor in one job per worker, each taking a slice of the images,
+    # so a request takes at most max_workers of the executor's slots however many images it carries
+    jobs = min(executor.max_workers, len(images))
+    slices = [images[i * len(images) // jobs:(i + 1) * len(images) // jobs] for i in range(jobs)]
+    jobs = await asyncio.gather(*[executor.run(preprocess_many, [data for _, data in part]) for part in slices],
+                                return_exceptions=True)
 
-        return {"emotion": EMOTIONS[predicted.item()]}
+    batches, outcomes = [], []
+    for part, job in zip(slices, jobs):
+        if isinstance(job, HTTPException):
+            raise job
+        if isinstance(job, Exception):
+            outcomes += [f"Error processing image: {job}"] * len(part)
+            continue
+        batches.append(job[0])
+        outcomes += job[1]
+    for outcome in outcomes:
+        if isinstance(outcome, dict):
+            tracker.record(outcome)
 
+    valid = [i for i, outcome in enumerate(outcomes) if isinstance(outcome, dict)]
+    if not valid:
+        raise HTTPException(status_code=400, detail="None of the uploaded images could be read")
+
+    try:
+        # All crops go through the network as one batch
+        batch = batches[0] if len(batches) == 1 else torch.cat(batches)
+        probs = await executor.run(predict_batch, batch)
+    except HTTPException:
+        raise
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error processing image: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error processing images: {str(e)}")
+
+    results = [{"index": i, "filename": name, "error": outcomes[i]} for i, (name, _) in enumerate(images)]
+    for row, i in enumerate(valid):
+        results[i] = {
+            "index": i,
+            "filename": images[i][0],
+            "emotion": EMOTIONS[int(probs[row].argmax())],
+            "probabilities": probabilities(probs[row]),
+        }
+
+    mean = probs.mean(dim=0)
+    counts = torch.bincount(probs.argmax(dim=1), minlength=len(EMOTIONS))
+    return {
+        "results": results,
+        "processed": len(valid),
+        "failed": len(images) - len(valid),
+        "emotion": EMOTIONS[int(mean.argmax())],
+        "distribution": probabilities(mean),
+        "counts": {e: int(c) for e, c in zip(EMOTIONS, counts)},
+    }
+
+@emotion_router.websocket("/stream")
+async def emotion_stream(websocket: WebSocket, alpha: float = STREAM_ALPHA):
+    """
+    Binary JPEG/PNG frames in, one JSON prediction per processed frame out. Frames that arrive
+    while the previous one is still being processed replace each other, so a client sending
+    faster than the server keeps getting predictions for its newest frame.
+    """
+    await websocket.accept()
+    alpha = min(max(alpha, 0.01), 1.0)
+    session_id = f"stream-{uuid.uuid4().hex}"
+    latest = {"data": None, "seq": 0, "received_at": 0.0, "closed": False}
+    ready = asyncio.Event()
+    stream_stats["connections"] += 1
+    stream_stats["active"] += 1
+
+    async def receive():
+        try:
+            while True:
+                message = await websocket.receive()
+                if message["type"] == "websocket.disconnect":
+                    break
+                if not message.get("bytes"):
+                    continue
+                if latest["data"] is not None:
+                    stream_stats["dropped"] += 1
+                latest.update(data=message["bytes"], seq=latest["seq"] + 1, received_at=time.perf_counter())
+                ready.set()
+        finally:
+            latest["closed"] = True
+            ready.set()
+
+    receiver = asyncio.create_task(receive())
+    smoothed = None
+    try:
+        while True:
+            await ready.wait()
+            ready.clear()
+            if latest["data"] is None:
+                if latest["closed"]:
+                    break
+                continue
+
+            data, seq, received_at = latest["data"], latest["seq"], latest["received_at"]
+            latest["data"] = None
+            try:
+                probs, detection = await predict_frame(data, session_id)
+            except Exception as e:
+                detail = e.detail if isinstance(e, HTTPException) else f"Error processing image: {str(e)}"
+                await websocket.send_json({"frame": seq, "error": detail})
+                continue
+
+            smoothed = probs.clone() if smoothed is None else alpha * probs + (1 - alpha) * smoothed
+            stream_stats["frames"] += 1
+            await websocket.send_json({
+                "frame": seq,
+                "emotion": EMOTIONS[int(probs.argmax())],
+                "probabilities": probabilities(probs),
+                "smoothed_emotion": EMOTIONS[int(smoothed.argmax())],
+                "smoothed": probabilities(smoothed),
+                "detection": detection,
+                "latency_ms": round(1000.0 * (time.perf_counter() - received_at), 3),
+            })
+    except Exception:
+        # The client went away while a prediction was being sent
+        pass
+    finally:
+        receiver.cancel()
+        tracker.forget(session_id)
+        frame_cache.forget(session_id)
+        stream_stats["active"] -= 1
+
+@emotion_router.get("/stats")
+async def emotion_stats():
+    return {"backend": BACKEND, "batching": batcher.stats(), "executor": executor.stats(),
+            "tracking": tracker.stats(), "cache": frame_cache.stats(), "stream": dict(stream_stats)}
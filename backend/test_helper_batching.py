@@ -0,0 +1,59 @@
+# test_helper_batching.py
+#
+#   cd backend && python -m pytest -q test_helper_batching.py
+import asyncio
+from helper_batching import MicroBatcher
+
+
+def recording(run_batch=lambda items: [item * 10 for item in items]):
+    batches = []
+
+    def run(items):
+        batches.append(list(items))
+        return run_batch(items)
+    return run, batches
+
+
+def test_full_batch_is_flushed_without_waiting_for_the_timeout():
+    run, batches = recording()
+    # a wait long enough that only the size cap can end the first batch in time
+    batcher = MicroBatcher(run, max_batch_size=3, max_wait_ms=10_000)
+
+    async def scenario():
+        return await asyncio.wait_for(asyncio.gather(*[batcher.submit(i) for i in range(3)]), timeout=2)
+
+    assert asyncio.run(scenario()) == [0, 10, 20]
+    assert batches == [[0, 1, 2]]
+    assert batcher.stats()["max_batch_size_seen"] == 3
+
+
+def test_partial_batch_is_flushed_on_the_timeout():
+    run, batches = recording()
+    batcher = MicroBatcher(run, max_batch_size=16, max_wait_ms=20)
+
+    async def scenario():
+        first = await asyncio.gather(batcher.submit(1), batcher.submit(2))
+        return first, await batcher.submit(3)
+
+    assert asyncio.run(scenario()) == ([10, 20], 30)
+    assert batches == [[1, 2], [3]]
+    assert batcher.stats()["batches"] == 2
+
+
+def test_a_failing_batch_fails_every_caller_in_it():
+    def fail(items):
+        raise RuntimeError("forward pass failed")
+    run, batches = recording(fail)
+    batcher = MicroBatcher(run, max_batch_size=4, max_wait_ms=20)
+
+    async def scenario():
+        outcomes = await asyncio.gather(*[batcher.submit(i) for i in range(4)], return_exceptions=True)
+        # the worker survives the failure
+        batcher.run_batch = lambda items: items
+        return outcomes, await batcher.submit(5)
+
+    outcomes, after = asyncio.run(scenario())
+    assert batches == [[0, 1, 2, 3]]
+    assert all(isinstance(outcome, RuntimeError) and str(outcome) == "forward pass failed" for outcome in outcomes)
+    assert after == 5
+    assert batcher.stats()["errors"] == 1
@@ -0,0 +1,73 @@
+# test_helper_cache.py
+#
+#   cd backend && python -m pytest -q test_helper_cache.py
+import cv2
+import numpy as np
+import helper_cache
+from helper_cache import PerceptualCache, dhash
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def monotonic(self):
+        return self.now
+
+
+def frame(seed=0):
+    rng = np.random.default_rng(seed)
+    return cv2.resize(rng.integers(0, 256, (12, 16), dtype=np.uint8), (320, 240))
+
+
+def distance(a, b):
+    return bin(a ^ b).count("1")
+
+
+def test_dhash_tolerates_small_changes_only():
+    gray = frame()
+    assert distance(dhash(gray), dhash(cv2.add(gray, 20))) == 0
+    assert distance(dhash(gray), dhash(frame(seed=1))) > 4
+
+
+def test_lookup_hits_within_the_threshold_only():
+    cache = PerceptualCache(threshold=4)
+    cache.store("s", 0b10110000, "probs")
+    assert cache.lookup("s", 0b10110000 ^ 0b1111) == "probs"
+    assert cache.lookup("s", 0b10110000 ^ 0b11111) is None
+    assert (cache.stats()["hits"], cache.stats()["misses"]) == (1, 1)
+
+
+def test_entries_expire_after_the_ttl(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(helper_cache, "time", clock)
+    cache = PerceptualCache(ttl=2.0)
+    cache.store("s", 1, "probs")
+    clock.now = 1.5
+    assert cache.lookup("s", 1) == "probs"
+    clock.now = 2.5
+    assert cache.lookup("s", 1) is None
+    assert cache.stats()["expired"] == 1
+
+
+def test_each_session_keeps_its_most_recently_used_entries():
+    cache = PerceptualCache(threshold=0, entries_per_session=2)
+    cache.store("s", 1, "a")
+    cache.store("s", 2, "b")
+    assert cache.lookup("s", 1) == "a"  # 2 is now the least recently used
+    cache.store("s", 4, "c")
+    assert cache.lookup("s", 2) is None
+    assert (cache.lookup("s", 1), cache.lookup("s", 4)) == ("a", "c")
+    assert cache.stats()["evictions"] == 1
+
+
+def test_sessions_do_not_share_entries():
+    cache = PerceptualCache(threshold=0, entries_per_session=1)
+    cache.store("s", 1, "a")
+    cache.store("t", 1, "b")
+    cache.store("t", 2, "c")  # evicts only t's entry
+    assert cache.lookup("s", 1) == "a"
+    assert cache.lookup("t", 1) is None
+    assert cache.lookup("u", 1) is None
+    cache.forget("s")
+    assert cache.lookup("s", 1) is None
@@ -0,0 +1,25 @@
+# test_helper_executor.py
+#
+#   cd backend && python -m pytest -q test_helper_executor.py
+import asyncio
+import os
+import pytest
+from fastapi import HTTPException
+from helper_executor import BoundedExecutor
+
+
+def test_process_pool_is_rebuilt_after_a_worker_dies():
+    executor = BoundedExecutor("process", max_workers=1, name="test")
+
+    async def scenario():
+        assert await executor.run(abs, -1) == 1
+        with pytest.raises(HTTPException) as error:
+            await executor.run(os._exit, 1)
+        assert error.value.status_code == 503
+        return await executor.run(abs, -2)
+
+    try:
+        assert asyncio.run(scenario()) == 2
+        assert executor.stats()["restarts"] == 1
+    finally:
+        executor.shutdown()
@@ -0,0 +1,113 @@
+# test_route_emotion.py
+# Route-level checks for the emotion endpoints, run on a randomly initialised compact model
+# with the process executor (the configuration that breaks first when a worker misbehaves).
+#
+#   cd backend && python -m pytest -q test_route_emotion.py
+import io
+import os
+import sys
+import tempfile
+import zipfile
+import cv2
+import numpy as np
+import pytest
+import torch
+from PIL import Image
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "emotion-recognition")))
+import model_util
+
+# route_emotion reads its configuration at import time; spawned workers inherit the environment
+MODEL_DIR = tempfile.mkdtemp(prefix="emotion-test-")
+torch.manual_seed(0)
+torch.save(model_util.create_student("compact").state_dict(), os.path.join(MODEL_DIR, "model.pth"))
+os.environ.update({"EMOTION_MODEL_PATH": os.path.join(MODEL_DIR, "model.pth"), "EMOTION_EXECUTOR": "process",
+                   "EMOTION_EXECUTOR_WORKERS": "1", "EMOTION_INPUT_SIZE": "48", "EMOTION_CACHE": "0"})
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+import route_emotion
+
+
+@pytest.fixture(scope="module")
+def client():
+    app = FastAPI()
+    app.include_router(route_emotion.emotion_router, prefix="/emotion")
+    with TestClient(app) as client:
+        yield client
+    route_emotion.executor.shutdown()
+
+
+def jpeg(width=320, height=240, seed=0):
+    rng = np.random.default_rng(seed)
+    frame = cv2.resize(rng.integers(0, 256, (height // 16, width // 16), dtype=np.uint8), (width, height))
+    return cv2.imencode(".jpg", frame)[1].tobytes()
+
+
+def zip_of(*images):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as archive:
+        for i, data in enumerate(images):
+            archive.writestr(f"frame{i}.jpg", data)
+    return buffer.getvalue()
+
+
+def test_bad_archive_is_a_client_error_and_keeps_the_pool(client):
+    response = client.post("/emotion/predict-emotion/batch", files={"archive": ("bad.tar", b"not an archive")})
+    assert response.status_code == 400
+    assert "zip or tar" in response.json()["detail"]
+
+    response = client.post("/emotion/predict-emotion", files={"file": ("face.jpg", jpeg())})
+    assert response.status_code == 200, response.text
+    assert response.json()["emotion"] in route_emotion.EMOTIONS
+
+    response = client.post("/emotion/predict-emotion/batch", files={"archive": ("ok.zip", zip_of(jpeg(), jpeg(seed=1)))})
+    assert response.status_code == 200, response.text
+    assert response.json()["processed"] == 2
+
+
+def test_session_tracking_state_stays_on_the_event_loop(client):
+    before = route_emotion.tracker.stats()
+    for _ in range(2):
+        response = client.post("/emotion/predict-emotion", files={"file": ("face.jpg", jpeg())},
+                               data={"session_id": "tracked"})
+        assert response.status_code == 200, response.text
+
+    # The process workers detect, but the sessions and counters are the ones the route sees
+    after = route_emotion.tracker.stats()
+    assert after["sessions"] == before["sessions"] + 1
+    assert sum(after["frames"].values()) == sum(before["frames"].values()) + 2
+    assert route_emotion.tracker.checkout("tracked")["frames"] >= 1
+
+
+def test_batch_takes_one_job_per_worker_and_reports_each_failure(client):
+    before = route_emotion.executor.stats()["completed"]
+    images = [jpeg(seed=i) for i in range(5)]
+    images[2] = b"not an image"
+    response = client.post("/emotion/predict-emotion/batch", files={"archive": ("mixed.zip", zip_of(*images))})
+    assert response.status_code == 200, response.text
+
+    body = response.json()
+    assert (body["processed"], body["failed"]) == (4, 1)
+    assert [result["index"] for result in body["results"]] == list(range(5))
+    assert "error" in body["results"][2] and all("emotion" in body["results"][i] for i in (0, 1, 3, 4))
+    # read_archive, one preprocessing job for the single worker, one forward pass
+    assert route_emotion.executor.stats()["completed"] - before == 3
+
+
+@pytest.mark.parametrize("height,width", [(720, 1280), (180, 260), (260, 180), (150, 400), (300, 300), (30, 40)])
+def test_to_tensor_matches_the_reference_transform(height, width):
+    # Square Haar crops, ROI crops of any shape and the whole frame when no face is found
+    face = cv2.imdecode(np.frombuffer(jpeg(width, height), np.uint8), cv2.IMREAD_GRAYSCALE)
+    reference = route_emotion.TRANSFORM(Image.fromarray(face))
+    torch.testing.assert_close(route_emotion.to_tensor(face), reference, rtol=0, atol=1e-5)
+
+
+def test_stale_quantized_model_is_refused(monkeypatch, tmp_path):
+    quantized = tmp_path / "model.int8.ts"
+    quantized.write_bytes(b"")
+    checkpoint_time = os.path.getmtime(route_emotion.MODEL_PATH)
+    os.utime(quantized, (checkpoint_time - 60, checkpoint_time - 60))
+    monkeypatch.setattr(route_emotion, "QUANTIZED_MODEL_PATH", str(quantized))
+    with pytest.raises(RuntimeError, match="quantize_model.py"):
+        route_emotion.load_model("int8")
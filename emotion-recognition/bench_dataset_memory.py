@@ -0,0 +1,112 @@
+import os
+import time
+import argparse
+import numpy as np
+from PIL import Image
+from resnet_parameters import Parameters
+from torch.utils.data import DataLoader, Dataset
+from ferplus import FERPlusReader, FERPlusDataset
+from rect_util import Rect
+import model_util
+
+# Memory used by DataLoader workers over FERPlusDataset, for the old layout (a Python list of
+# (path, PIL image, emotion, Rect) tuples) and the shared-memory tensors FERPlusDataset uses now.
+# Reads /proc, so Linux only.
+#
+#   python bench_dataset_memory.py --workers 0,2,4 --start-method fork
+#
+# PSS charges each shared page to the processes sharing it, so the PSS sum is the real total;
+# USS is what a process holds on its own.
+
+class LegacyFERPlusDataset(Dataset):
+    '''
+    FERPlusDataset as it was before the arrays: one tuple of Python objects per sample.
+    '''
+    def __init__(self, reader, transform=None):
+        self.data = [(str(reader.paths[i]), Image.fromarray(np.array(reader.images[i])),
+                      reader.labels[i].tolist(), Rect(reader.rects[i].tolist())) for i in range(reader.size())]
+        self.transform = transform
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, idx):
+        image_path, image_data, emotion, face_rc = self.data[idx]
+        image = np.array(image_data)
+        if self.transform:
+            image = self.transform(image)
+        return {'image': image, 'emotion': np.array(emotion, dtype=np.float32)}
+
+def memory_kib(pid):
+    '''
+    (PSS, USS) of a process in KiB, from /proc/<pid>/smaps_rollup.
+    '''
+    fields = {}
+    with open(f"/proc/{pid}/smaps_rollup") as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == "kB":
+                fields[parts[0].rstrip(":")] = int(parts[1])
+    return fields["Pss"], fields["Private_Clean"] + fields["Private_Dirty"]
+
+def worker_pids():
+    '''
+    Child processes of this one, except multiprocessing's resource tracker.
+    '''
+    parent = str(os.getpid())
+    children = []
+    for name in os.listdir("/proc"):
+        if name.isdigit():
+            try:
+                with open(f"/proc/{name}/stat") as f:
+                    # the command name may contain spaces, the ppid is the second field after it
+                    if f.read().rsplit(")", 1)[1].split()[1] != parent:
+                        continue
+                with open(f"/proc/{name}/cmdline", "rb") as f:
+                    if b"resource_tracker" not in f.read():
+                        children.append(int(name))
+            except (OSError, IndexError):
+                pass
+    return children
+
+def measure(dataset, num_workers, batch_size, start_method):
+    loader = DataLoader(dataset, batch_size=batch_size, shuffle=True, num_workers=num_workers,
+                        multiprocessing_context=start_method if num_workers > 0 else None)
+    start = time.perf_counter()
+    for i, _ in enumerate(loader):
+        # Sample near the end of the epoch, while the workers are still alive and have touched most samples
+        if i == max(0, len(loader) - 2 - num_workers):
+            main_pss, main_uss = memory_kib(os.getpid())
+            workers = [memory_kib(pid) for pid in worker_pids()]
+    elapsed = time.perf_counter() - start
+
+    return {"total_pss": main_pss + sum(pss for pss, _ in workers), "main_uss": main_uss,
+            "worker_uss": np.mean([uss for _, uss in workers]) if workers else 0.0, "seconds": elapsed}
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare DataLoader worker memory for the FERPlus dataset layouts.")
+    parser.add_argument("--base-folder", default="Datasets/FERPlus-master/data")
+    parser.add_argument("--folder", default="FER2013Train")
+    parser.add_argument("--workers", default="0,2,4")
+    parser.add_argument("--start-method", choices=["fork", "spawn", "forkserver"], default="fork")
+    parser.add_argument("--input-size", type=int, default=48, help="transform output size, small to keep the run short")
+    parser.add_argument("--batch-size", type=int, default=64)
+    args = parser.parse_args()
+
+    reader = FERPlusReader.create(args.base_folder, [args.folder], "label.csv", Parameters())
+    transform = model_util.eval_transform(args.input_size, 1)
+    print(f"🟡 {args.folder}: {reader.size()} images, {reader.images.nbytes / 2**20:.1f} MiB of pixels | "
+          f"start method {args.start_method}")
+
+    # Shared tensors first: memory the legacy list returns to the allocator is not always returned to the OS
+    layouts = [("shared tensors", FERPlusDataset), ("legacy (list of PIL tuples)", LegacyFERPlusDataset)]
+    print(f"  {'layout':<30}{'workers':>8}{'total PSS MiB':>15}{'main USS MiB':>14}{'worker USS MiB':>16}{'epoch s':>9}")
+    for name, layout in layouts:
+        dataset = layout(reader, transform)
+        for num_workers in [int(w) for w in args.workers.split(",")]:
+            r = measure(dataset, num_workers, args.batch_size, args.start_method)
+            print(f"  {name:<30}{num_workers:>8}{r['total_pss'] / 1024:>15.1f}{r['main_uss'] / 1024:>14.1f}"
+                  f"{r['worker_uss'] / 1024:>16.1f}{r['seconds']:>9.2f}")
+
+if __name__ == "__main__":
+    main()
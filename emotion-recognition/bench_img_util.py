@@ -0,0 +1,107 @@
+import time
+import argparse
+import tracemalloc
+import numpy as np
+import torch
+from scipy import ndimage
+from rect_util import Rect
+import img_util as imgu
+
+# Throughput of the per-image augmentation path (distort_img, one scipy affine_transform per
+# image) against the batched one (distort_batch, one grid_sample per mini-batch), and how far
+# the batched warp is from scipy's for the same random parameters. Same comparison for the
+# preprocessing step: preproc_img with compute_norm_mat's pseudo-inverse against preproc_batch.
+#
+#   python bench_img_util.py --sizes 48,224 --batch-size 64
+
+def synthetic_faces(count, size=48, seed=0):
+    rng = np.random.RandomState(seed)
+    small = rng.randint(0, 256, (count, size // 4, size // 4)).astype(np.float32)
+    return np.stack([ndimage.zoom(image, 4, order=3) for image in small]).clip(0, 255).astype(np.uint8)
+
+def images_per_sec(fn, count, runs):
+    fn()
+    start = time.perf_counter()
+    for _ in range(runs):
+        fn()
+    return count * runs / (time.perf_counter() - start)
+
+def warp_parity(images, rois, out_size, augmentation):
+    '''
+    Largest difference (grey levels, before rounding) between grid_sample and ndimage for the same maps.
+    '''
+    params = imgu.distort_params(len(images), out_size, out_size, *augmentation)
+    matrix, offset = imgu.crop_matrices(rois, out_size, out_size, params)
+    batched = imgu.warp_batch(images, matrix, offset, out_size, out_size).numpy()
+    reference = np.stack([ndimage.affine_transform(image.astype(np.float64), m, o, output_shape=(out_size, out_size),
+                                                   order=1, mode='reflect', prefilter=False)
+                          for image, m, o in zip(images, matrix, offset)])
+    return float(np.abs(batched - reference).max())
+
+def peak_mib(fn):
+    '''
+    Peak of numpy/Python allocations while running fn, in MiB.
+    '''
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak / 2**20
+
+def bench_preproc(images_uint8, size, runs):
+    images = np.stack([ndimage.zoom(image, size / image.shape[0], order=1) for image in images_uint8])
+
+    # The reader computed the design matrix once at start-up: time it outside, but count its memory
+    A, A_pinv = imgu.compute_norm_mat(size, size)
+
+    def per_image():
+        return np.stack([imgu.preproc_img(image, A, A_pinv) for image in images])
+
+    def per_image_with_matrix():
+        imgu.compute_norm_mat(size, size)
+        return per_image()
+
+    def batched():
+        return imgu.preproc_batch(images)
+
+    diff = float(np.abs(per_image() - batched()).max())
+    old, new = images_per_sec(per_image, len(images), runs), images_per_sec(batched, len(images), runs)
+    print(f"  {size:>5}{old:>18.1f}{new:>20.1f}{new / old:>8.1f}x{peak_mib(per_image_with_matrix):>11.1f}{peak_mib(batched):>11.1f}{diff:>12.2e}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark FER+ augmentation, per image vs. batched.")
+    parser.add_argument("--sizes", default="48,224", help="comma separated output sizes")
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--threads", type=int, default=0, help="torch threads for the batched path, 0 keeps the default")
+    args = parser.parse_args()
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+
+    images = synthetic_faces(args.batch_size)
+    rois = np.tile([0, 0, 48, 48], (args.batch_size, 1))
+    # FERPlusReader's ranges when augmentation is on
+    augmentation = (0.08, 1.05, 20.0, 0.05, True)
+
+    print(f"Batch {args.batch_size}, torch threads {torch.get_num_threads()}")
+    print(f"  {'size':>5}{'distort_img img/s':>19}{'distort_batch img/s':>21}{'speedup':>9}{'max |diff|':>12}")
+    for size in [int(s) for s in args.sizes.split(",")]:
+        def per_image():
+            for image, roi in zip(images, rois):
+                imgu.distort_img(image, Rect(roi.tolist()), size, size, *augmentation)
+
+        def batched():
+            imgu.distort_batch(images, rois, size, size, *augmentation)
+
+        old = images_per_sec(per_image, args.batch_size, args.runs)
+        new = images_per_sec(batched, args.batch_size, args.runs)
+        diff = warp_parity(images, rois, size, augmentation)
+        print(f"  {size:>5}{old:>19.1f}{new:>21.1f}{new / old:>8.1f}x{diff:>12.5f}")
+
+    print("Preprocessing (equalization + plane removal), peak memory in MiB including the design matrix:")
+    print(f"  {'size':>5}{'preproc_img img/s':>18}{'preproc_batch img/s':>20}{'speedup':>9}{'old MiB':>11}{'new MiB':>11}{'max |diff|':>12}")
+    for size in [int(s) for s in args.sizes.split(",")]:
+        bench_preproc(images, size, args.runs)
+
+if __name__ == "__main__":
+    main()
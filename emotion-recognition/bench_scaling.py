@@ -0,0 +1,97 @@
+import os
+import time
+import socket
+import argparse
+import torch
+import torch.nn as nn
+import torch.optim as optim
+import torch.multiprocessing as mp
+from torch.optim.lr_scheduler import StepLR
+from resnet_parameters import Parameters
+from ferplus import FERPlusReader, FERPlusDataset
+from trainer import Trainer
+from bench_training import RandomFaces, create_model
+import model_util
+import dist_util
+
+# Time per training epoch of the data-parallel gloo mode (dist_util.py) at 1, 2, 4 and 8 processes
+# on this machine. Each process gets cpu_count / processes threads unless --threads is given.
+#
+#   python bench_scaling.py --arch resnet18 --input-size 48 --processes 1,2,4,8
+#
+# Uses FER2013Train when --base-folder exists, random images otherwise. The batch size is per
+# process, so every configuration runs the same number of images per epoch.
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def worker(rank, world_size, port, args, results):
+    os.environ.update({"MASTER_ADDR": "127.0.0.1", "MASTER_PORT": str(port), "RANK": str(rank),
+                       "WORLD_SIZE": str(world_size), "LOCAL_WORLD_SIZE": str(world_size)})
+    dist_util.init(args.threads)
+    if world_size == 1:
+        torch.set_num_threads(args.threads or os.cpu_count() or 1)
+
+    if os.path.isdir(args.base_folder):
+        with dist_util.main_first():
+            reader = FERPlusReader.create(args.base_folder, ["FER2013Train"], "label.csv", Parameters())
+        dataset = FERPlusDataset(reader, transform=model_util.train_transform(args.input_size, args.in_channels))
+    else:
+        dataset = RandomFaces(args.images, args.input_size, args.in_channels)
+    loader = dist_util.create_loader(dataset, args.batch_size, shuffle=True, num_workers=args.num_workers)
+
+    torch.manual_seed(0)
+    model = create_model(args.arch, args.input_size, args.in_channels)
+    optimizer = optim.Adam(model.parameters(), lr=1e-3)
+    trainer = Trainer(model, nn.CrossEntropyLoss(), optimizer, StepLR(optimizer, step_size=5),
+                      bf16=args.bf16, channels_last=args.channels_last)
+
+    seconds = []
+    for epoch in range(args.epochs):
+        dist_util.set_epoch(loader, epoch)
+        dist_util.barrier()
+        start = time.perf_counter()
+        trainer.train_epoch(loader)
+        seconds.append(time.perf_counter() - start)
+
+    if dist_util.is_main():
+        # the first epoch includes start-up (worker processes, first allocations)
+        measured = seconds[1:] or seconds
+        results.put((world_size, torch.get_num_threads(), sum(measured) / len(measured), len(dataset)))
+    dist_util.cleanup()
+
+def main():
+    parser = argparse.ArgumentParser(description="Time per epoch of data-parallel CPU training at several process counts.")
+    parser.add_argument("--processes", default="1,2,4,8")
+    parser.add_argument("--arch", choices=["resnet18", "efficientnet_b0"] + model_util.STUDENT_ARCHS, default="resnet18")
+    parser.add_argument("--input-size", type=int, default=48)
+    parser.add_argument("--in-channels", type=int, choices=[1, 3], default=1)
+    parser.add_argument("--batch-size", type=int, default=64, help="per process")
+    parser.add_argument("--epochs", type=int, default=2, help="timed epochs, the first one is reported only if it is the only one")
+    parser.add_argument("--images", type=int, default=4096, help="size of the random dataset")
+    parser.add_argument("--num-workers", type=int, default=0, help="DataLoader workers per process")
+    parser.add_argument("--threads", type=int, default=0, help="threads per process, 0 splits the cores evenly")
+    parser.add_argument("--bf16", action="store_true")
+    parser.add_argument("--channels-last", action="store_true")
+    parser.add_argument("--base-folder", default="Datasets/FERPlus-master/data")
+    args = parser.parse_args()
+
+    results = mp.get_context("spawn").SimpleQueue()
+    rows = []
+    for world_size in [int(p) for p in args.processes.split(",")]:
+        mp.spawn(worker, args=(world_size, free_port(), args, results), nprocs=world_size)
+        rows.append(results.get())
+        print(f"🟡 {world_size} process(es) done")
+
+    print(f"{args.arch} at {args.input_size}x{args.input_size}x{args.in_channels}, batch {args.batch_size} per process, "
+          f"{rows[0][3]} images per epoch, {os.cpu_count()} cores")
+    print(f"  {'processes':>10}{'threads each':>14}{'epoch s':>10}{'img/s':>10}{'speedup':>9}{'efficiency':>12}")
+    for world_size, threads, seconds, images in rows:
+        speedup = rows[0][2] / seconds
+        print(f"  {world_size:>10}{threads:>14}{seconds:>10.2f}{images / seconds:>10.1f}{speedup:>8.2f}x"
+              f"{100 * speedup * rows[0][0] / world_size:>11.0f}%")
+
+if __name__ == "__main__":
+    main()
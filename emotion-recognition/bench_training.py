@@ -0,0 +1,82 @@
+import os
+import argparse
+import torch
+import torch.nn as nn
+import torch.optim as optim
+from torch.utils.data import DataLoader, Dataset
+from torch.optim.lr_scheduler import StepLR
+from resnet_parameters import Parameters
+from ferplus import FERPlusReader, FERPlusDataset
+from trainer import Trainer
+import model_util
+
+# Training throughput of trainer.Trainer with its CPU options on and off, one epoch per configuration.
+#
+#   python bench_training.py --arch resnet18 --input-size 224 --steps 20
+#   python bench_training.py --configs fp32,bf16,bf16+channels_last,bf16+channels_last+compile
+#
+# Uses FER2013Train when --base-folder exists, random images otherwise (throughput does not
+# depend on the pixels). "fp32" is the original eager loop's configuration.
+
+class RandomFaces(Dataset):
+    def __init__(self, size, input_size, in_channels):
+        self.images = torch.rand(size, in_channels, input_size, input_size)
+        self.emotions = torch.softmax(torch.randn(size, model_util.EMOTION_COUNT), dim=1)
+
+    def __len__(self):
+        return len(self.images)
+
+    def __getitem__(self, idx):
+        return {'image': self.images[idx], 'emotion': self.emotions[idx]}
+
+def create_model(arch, input_size, in_channels):
+    if arch == "resnet18":
+        return model_util.create_resnet18(in_channels=in_channels, small_stem=model_util.use_small_stem(input_size))
+    if arch == "efficientnet_b0":
+        return model_util.create_efficientnet_b0(in_channels=in_channels)
+    return model_util.create_student(arch, in_channels=in_channels)
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare training throughput of the Trainer options.")
+    parser.add_argument("--arch", choices=["resnet18", "efficientnet_b0"] + model_util.STUDENT_ARCHS, default="resnet18")
+    parser.add_argument("--input-size", type=int, default=224)
+    parser.add_argument("--in-channels", type=int, choices=[1, 3], default=3)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--steps", type=int, default=20, help="training steps per configuration")
+    parser.add_argument("--accumulation-steps", type=int, default=1)
+    parser.add_argument("--threads", type=int, default=0)
+    parser.add_argument("--configs", default="fp32,bf16,channels_last,bf16+channels_last",
+                        help="comma separated, options joined with + (bf16, channels_last, compile)")
+    parser.add_argument("--base-folder", default="Datasets/FERPlus-master/data")
+    args = parser.parse_args()
+
+    if os.path.isdir(args.base_folder):
+        reader = FERPlusReader.create(args.base_folder, ["FER2013Train"], "label.csv", Parameters())
+        dataset = FERPlusDataset(reader, transform=model_util.eval_transform(args.input_size, args.in_channels))
+    else:
+        dataset = RandomFaces(args.batch_size * args.steps, args.input_size, args.in_channels)
+    loader = DataLoader(dataset, batch_size=args.batch_size, shuffle=True, num_workers=0)
+    # a fixed number of steps, taken from the front of the dataset
+    batches = [batch for _, batch in zip(range(args.steps), loader)]
+    print(f"🟡 {args.arch} at {args.input_size}x{args.input_size}x{args.in_channels}, batch {args.batch_size}, "
+          f"{len(batches)} steps, {torch.get_num_threads() if args.threads <= 0 else args.threads} threads")
+
+    rows = []
+    for config in args.configs.split(","):
+        options = set(config.split("+")) - {"fp32"}
+        torch.manual_seed(0)
+        model = create_model(args.arch, args.input_size, args.in_channels)
+        optimizer = optim.Adam(model.parameters(), lr=1e-3)
+        trainer = Trainer(model, nn.CrossEntropyLoss(), optimizer, StepLR(optimizer, step_size=5),
+                          bf16="bf16" in options, channels_last="channels_last" in options,
+                          compile="compile" in options, accumulation_steps=args.accumulation_steps, threads=args.threads)
+        trainer.train_epoch(batches[:2])  # warm-up, and compilation for compile
+        loss, _, images_per_second = trainer.train_epoch(batches)
+        rows.append((config, loss, images_per_second))
+
+    print(f"  {'config':<36}{'loss':>8}{'img/s':>10}{'speedup':>9}")
+    for config, loss, images_per_second in rows:
+        print(f"  {config:<36}{loss:>8.4f}{images_per_second:>10.1f}{images_per_second / rows[0][2]:>8.2f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+import os
+import re
+import queue
+import random
+import threading
+import numpy as np
+import torch
+import model_util
+
+# Resumable training checkpoints, written by a background thread (used by trainer.Trainer).
+#
+# A checkpoint holds everything fit() needs to continue where it stopped: model, optimizer and
+# scheduler state, the epoch, the early-stopping counters, which parameters are trainable (the
+# EfficientNet script unfreezes blocks as it goes) and the Python, NumPy and torch RNG states.
+# Checkpoints are taken at epoch boundaries, and the DataLoader shuffle order, worker seeds and
+# FERPlus augmentation all draw from those RNGs, so a resumed run sees the data in the order the
+# uninterrupted run would have.
+#
+# Files are <folder>/<run>-epoch<NNNN>.pt, where <run> is the best-model file name without its
+# extension, so runs sharing a folder do not touch each other's files. A fresh run (no resume)
+# deletes the files of an earlier run under the same name, and resuming checks that the checkpoint
+# was taken from a model built the same way (model_util.model_config), so a stale checkpoint is
+# never picked up silently.
+#
+# In distributed training only rank 0 writes (the other ranks pass main=False), but every process resumes from the
+# same file; the RNG states of all ranks are stored so each process gets its own back.
+
+def snapshot(state):
+    '''
+    Copy of a (nested) state dict with every tensor cloned to the CPU, so training can go on
+    modifying the live tensors while the copy is written.
+    '''
+    if torch.is_tensor(state):
+        return state.detach().to("cpu", copy=True)
+    if isinstance(state, dict):
+        return {key: snapshot(value) for key, value in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(snapshot(value) for value in state)
+    return state
+
+def rng_state():
+    return {"python": random.getstate(), "numpy": np.random.get_state(), "torch": torch.get_rng_state()}
+
+def set_rng_state(state):
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+
+class CheckpointWriter(object):
+    '''
+    Saves (state, path) pairs on a background thread, through a temporary file so a crash never
+    leaves a truncated checkpoint under the final name. At most one save waits in the queue;
+    a second one blocks until the writer catches up. Errors surface on the next call.
+    '''
+    def __init__(self):
+        self.queue = queue.Queue(maxsize=1)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is not None:
+                    state, path, on_saved = item
+                    torch.save(state, path + ".tmp")
+                    os.replace(path + ".tmp", path)
+                    if on_saved:
+                        on_saved()
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+            if item is None:
+                break
+
+    def _check(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def save(self, state, path, on_saved=None):
+        '''
+        Queue `state` (already a snapshot) for saving to `path`; `on_saved` runs on the writer thread after it.
+        '''
+        self._check()
+        self.queue.put((state, path, on_saved))
+
+    def flush(self):
+        self.queue.join()
+        self._check()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self._check()
+
+class Checkpoints(object):
+    '''
+    The checkpoints of one training run. `keep` is how many resumable checkpoints are retained
+    (0 keeps all); `every` writes one every N epochs, in addition to the epochs that improve.
+    With folder=None only the best model is saved, and with main=False nothing is. `input_size`
+    is recorded in the best model's config.
+    '''
+    def __init__(self, best_path, folder=None, every=1, keep=3, main=True, input_size=None):
+        self.best_path = best_path
+        self.input_size = input_size
+        self.folder = folder
+        self.every = max(1, every)
+        self.keep = keep
+        self.main = main
+        self.run = os.path.splitext(os.path.basename(best_path))[0]
+        self.writer = CheckpointWriter() if main else None
+
+    def paths(self):
+        '''
+        This run's resumable checkpoints, oldest first.
+        '''
+        if not self.folder or not os.path.isdir(self.folder):
+            return []
+        pattern = re.compile(r"%s-epoch(\d+)\.pt$" % re.escape(self.run))
+        found = [(int(m.group(1)), name) for name in os.listdir(self.folder) for m in [pattern.match(name)] if m]
+        return [os.path.join(self.folder, name) for _, name in sorted(found)]
+
+    def latest(self):
+        paths = self.paths()
+        return paths[-1] if paths else None
+
+    def clear(self):
+        '''
+        Delete this run's resumable checkpoints, before a fresh run writes its own. Returns how many there were.
+        '''
+        paths = self.paths()
+        if self.main:
+            for path in paths:
+                os.remove(path)
+        return len(paths)
+
+    def save_best(self, model):
+        '''
+        The model weights and their model_util.model_config, the format model_util.load_checkpoint reads.
+        '''
+        if self.main:
+            self.writer.save(snapshot(model_util.checkpoint_state(model, self.input_size)), self.best_path)
+
+    def due(self, epoch, improved):
+        return self.folder is not None and (improved or (epoch + 1) % self.every == 0)
+
+    def save(self, epoch, model, optimizer, scheduler, best_val_loss, patience_counter, stopped=False, rng=None):
+        '''
+        A resumable checkpoint taken after `epoch` (0-based) finished. `rng` is the list of every
+        rank's rng_state(), this process' alone by default.
+        '''
+        if not self.main:
+            return
+        state = snapshot({
+            "epoch": epoch + 1,
+            "model": model.state_dict(),
+            "optimizer": optimizer.state_dict(),
+            "scheduler": scheduler.state_dict(),
+            "best_val_loss": best_val_loss,
+            "patience_counter": patience_counter,
+            "stopped": stopped,
+            "requires_grad": {name: param.requires_grad for name, param in model.named_parameters()},
+            "config": model_util.model_config(model, self.input_size),
+            "rng": rng if rng is not None else [rng_state()],
+        })
+        os.makedirs(self.folder, exist_ok=True)
+        self.writer.save(state, os.path.join(self.folder, "%s-epoch%04d.pt" % (self.run, epoch + 1)), self._prune)
+
+    def _prune(self):
+        if self.keep > 0:
+            for path in self.paths()[:-self.keep]:
+                os.remove(path)
+
+    def load(self, path, model, optimizer, scheduler, rank=0):
+        '''
+        Restore a checkpoint written by save(), with the RNG state of process `rank` (rank 0's if
+        the checkpoint came from fewer processes). Returns (next epoch, best_val_loss, patience_counter, stopped).
+        '''
+        # numpy's RNG state is not a tensor, so this needs the full unpickler; only load your own checkpoints
+        state = torch.load(path, map_location="cpu", weights_only=False)
+        config = model_util.model_config(model, self.input_size)
+        if state.get("config", config) != config:
+            raise ValueError(f"{path} was taken from a different model ({state['config']}, this run is {config}); "
+                             f"train from scratch or remove it")
+        model.load_state_dict(state["model"])
+        for name, param in model.named_parameters():
+            param.requires_grad = state["requires_grad"].get(name, param.requires_grad)
+        optimizer.load_state_dict(state["optimizer"])
+        scheduler.load_state_dict(state["scheduler"])
+        set_rng_state(state["rng"][rank] if rank < len(state["rng"]) else state["rng"][0])
+        return state["epoch"], state["best_val_loss"], state["patience_counter"], state["stopped"]
+
+    def close(self):
+        if self.writer:
+            self.writer.close()
@@ -0,0 +1,46 @@
+import os
+import time
+import argparse
+import logging
+from resnet_parameters import Parameters
+from ferplus import FERPlusReader
+
+# Compile the FERPlus splits into the binary .npy cache that FERPlusReader memory-maps, so the
+# first training run does not pay for decoding ~35k PNGs. Readers also compile on demand; this
+# only moves the cost up front (e.g. into a Docker build or a CI step).
+#
+#   python compile_ferplus.py --modes crossentropy,majority
+
+def main():
+    parser = argparse.ArgumentParser(description="Compile FERPlus folders into the binary dataset cache.")
+    parser.add_argument("--base-folder", default="Datasets/FERPlus-master/data")
+    parser.add_argument("--folders", default="FER2013Train,FER2013Valid,FER2013Test")
+    parser.add_argument("--modes", default="crossentropy", help="comma separated training modes to compile labels for")
+    parser.add_argument("--cache-folder", default=None, help="defaults to <base-folder>/cache")
+    parser.add_argument("--force", action="store_true", help="recompile even if the cache looks current")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    parameters = Parameters()
+    parameters.cache_folder = args.cache_folder
+    cache_folder = args.cache_folder or os.path.join(args.base_folder, "cache")
+    if args.force and os.path.isdir(cache_folder):
+        for name in os.listdir(cache_folder):
+            if name.endswith(".npy"):
+                os.remove(os.path.join(cache_folder, name))
+
+    for mode in args.modes.split(","):
+        parameters.training_mode = mode
+        for folder in args.folders.split(","):
+            start = time.perf_counter()
+            reader = FERPlusReader.create(args.base_folder, [folder], "label.csv", parameters)
+            first = time.perf_counter() - start
+
+            start = time.perf_counter()
+            FERPlusReader.create(args.base_folder, [folder], "label.csv", parameters)
+            cached = time.perf_counter() - start
+            print(f"🟡 {folder} ({mode}): {reader.size()} images, {reader.images.nbytes / 2**20:.1f} MiB | "
+                  f"first load {first:.2f} s | cached load {1000 * cached:.1f} ms")
+
+if __name__ == "__main__":
+    main()
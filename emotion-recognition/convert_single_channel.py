@@ -0,0 +1,82 @@
+import os
+import argparse
+import torch
+from resnet_parameters import Parameters
+from torch.utils.data import DataLoader
+from ferplus import FERPlusReader, FERPlusDataset
+from tune_loader import synthetic_reader
+import model_util
+
+# Convert a 3-channel best_model.pth into a model whose first convolution reads the grayscale
+# face directly, and check that both give the same predictions.
+#
+#   python convert_single_channel.py --checkpoint best_model.pth   # writes best_model_1ch.pth
+#
+# The fold is exact for the input size the checkpoint was trained at (see
+# model_util.fold_to_single_channel). The converted model is compared with the original on
+# FER2013Test, or on random faces without the dataset, and saved only if they agree on at least
+# --min-agreement percent of the top-1 predictions.
+
+FOLDS = {"resnet18": model_util.resnet_to_single_channel, "efficientnet_b0": model_util.efficientnet_to_single_channel}
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Fold a FERPlus ResNet-18 or EfficientNet-B0 to a single input channel.")
+    parser.add_argument("--checkpoint", default="best_model.pth")
+    parser.add_argument("--output", default=None, help="defaults to <checkpoint>_1ch.pth")
+    parser.add_argument("--input-size", type=int, default=None,
+                        help="resolution the checkpoint was trained at, if it does not record it (224 otherwise)")
+    parser.add_argument("--approximate", action="store_true",
+                        help="plain folded convolution that accepts any input size, inexact at the image border")
+    parser.add_argument("--min-agreement", type=float, default=99.9, help="top-1 agreement in percent required to save")
+    parser.add_argument("--base-folder", default="Datasets/FERPlus-master/data")
+    parser.add_argument("--synthetic", type=int, default=512, help="random faces to compare on when --base-folder is missing")
+    parser.add_argument("--batch-size", type=int, default=64)
+    return parser.parse_args()
+
+def compare(model_rgb, model_gray, reader, batch_size, input_size=224):
+    '''
+    Run the faces of `reader` through both models, each with its own transform.
+    Returns (max |logit difference|, top-1 agreement in percent, number of faces).
+    '''
+    loader_rgb = DataLoader(FERPlusDataset(reader, transform=model_util.eval_transform(input_size, 3)), batch_size=batch_size)
+    loader_gray = DataLoader(FERPlusDataset(reader, transform=model_util.eval_transform(input_size, 1)), batch_size=batch_size)
+
+    max_diff, agree, total = 0.0, 0, 0
+    with torch.no_grad():
+        for batch_rgb, batch_gray in zip(loader_rgb, loader_gray):
+            outputs_rgb = model_rgb(batch_rgb['image'])
+            outputs_gray = model_gray(batch_gray['image'])
+            max_diff = max(max_diff, (outputs_rgb - outputs_gray).abs().max().item())
+            agree += outputs_rgb.argmax(dim=1).eq(outputs_gray.argmax(dim=1)).sum().item()
+            total += outputs_rgb.size(0)
+    return max_diff, 100 * agree / total, total
+
+def main():
+    args = parse_args()
+    output = args.output or os.path.splitext(args.checkpoint)[0] + "_1ch.pth"
+
+    config = model_util.checkpoint_config(args.checkpoint)
+    if config["in_channels"] != 3 or config["arch"] not in FOLDS:
+        raise SystemExit(f"{args.checkpoint} is not a 3-channel ResNet-18 or EfficientNet-B0")
+    input_size = model_util.checkpoint_input_size(args.checkpoint, args.input_size)
+
+    model_rgb = model_util.load_checkpoint(args.checkpoint)
+    model_gray = FOLDS[config["arch"]](model_util.load_checkpoint(args.checkpoint),
+                                       input_size=None if args.approximate else input_size)
+
+    if os.path.isdir(args.base_folder):
+        reader, faces = FERPlusReader.create(args.base_folder, ["FER2013Test"], "label.csv", Parameters()), "FER2013Test"
+    else:
+        reader, faces = synthetic_reader(args.synthetic), "random faces"
+        print(f"🟡 {args.base_folder} not found, comparing on {args.synthetic} random faces")
+    max_diff, agreement, total = compare(model_rgb, model_gray, reader, args.batch_size, input_size)
+    print(f"{faces} ({total} images at {input_size}x{input_size}): Max |logit diff|: {max_diff:.2e} | "
+          f"Top-1 agreement: {agreement:.2f}%")
+    if agreement < args.min_agreement:
+        raise SystemExit(f"Top-1 agreement {agreement:.2f}% is below --min-agreement {args.min_agreement}%, not saving")
+
+    torch.save(model_util.checkpoint_state(model_gray, input_size), output)
+    print(f"🟡 Single-channel model saved to {output}")
+
+if __name__ == "__main__":
+    main()
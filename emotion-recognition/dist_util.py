@@ -0,0 +1,121 @@
+import os
+import contextlib
+import torch
+import torch.distributed as dist
+from torch.utils.data import DataLoader, DistributedSampler
+from torch.nn.parallel import DistributedDataParallel
+
+# Multi-process data-parallel CPU training with torch.distributed and the gloo backend.
+#
+#   torchrun --nproc_per_node 4 resnet_model_train.py            (add --resume to continue an interrupted run)
+#
+# Every process trains a replica of the model on its shard of the training set; gradients are
+# averaged across processes during backward (DistributedDataParallel), validation and test
+# metrics are summed over all shards, and only rank 0 writes checkpoints. The effective batch
+# size is the per-process batch size times the number of processes.
+#
+# Without torchrun's environment (WORLD_SIZE unset or 1) every function here is a no-op and
+# training runs in a single process as before.
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+def rank():
+    return dist.get_rank() if is_distributed() else 0
+
+def world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+def is_main():
+    return rank() == 0
+
+def init(threads=0):
+    '''
+    Join the process group described by torchrun's environment variables (RANK, WORLD_SIZE,
+    MASTER_ADDR, MASTER_PORT) and split the machine's cores between the local processes, unless
+    `threads` sets the per-process thread count. Returns (rank, world size).
+    '''
+    if int(os.environ.get("WORLD_SIZE", "1")) > 1 and not is_distributed():
+        dist.init_process_group("gloo")
+        # torchrun defaults OMP_NUM_THREADS to 1, which leaves most cores idle
+        local_processes = int(os.environ.get("LOCAL_WORLD_SIZE", world_size()))
+        torch.set_num_threads(threads or max(1, (os.cpu_count() or 1) // local_processes))
+    return rank(), world_size()
+
+def cleanup():
+    if is_distributed():
+        # let every process finish its last collective before the group goes away
+        dist.barrier()
+        dist.destroy_process_group()
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+@contextlib.contextmanager
+def main_first():
+    '''
+    Run the block on rank 0 first and on the other processes once it is done, e.g. to build a
+    shared cache once instead of in every process at the same time.
+    '''
+    if not is_main():
+        barrier()
+    yield
+    if is_main():
+        barrier()
+
+def create_loader(dataset, batch_size, shuffle, **kwargs):
+    '''
+    DataLoader over this process' shard of `dataset` when distributed, over all of it otherwise.
+    DistributedSampler pads the shards to equal length by repeating a few samples, so distributed
+    metrics can count up to world_size - 1 samples twice.
+    '''
+    if is_distributed():
+        return DataLoader(dataset, batch_size=batch_size, sampler=DistributedSampler(dataset, shuffle=shuffle), **kwargs)
+    return DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, **kwargs)
+
+def set_epoch(loader, epoch):
+    '''
+    Reshuffle a distributed loader's shards for `epoch` (the same permutation on every process).
+    '''
+    if isinstance(getattr(loader, "sampler", None), DistributedSampler):
+        loader.sampler.set_epoch(epoch)
+
+def parallel(model):
+    '''
+    The model wrapped for gradient averaging when distributed. DistributedDataParallel only
+    synchronizes the parameters that were trainable when it was built, so wrap again after
+    unfreezing layers.
+    '''
+    if is_distributed():
+        return DistributedDataParallel(model)
+    return model
+
+def sync_buffers(model):
+    '''
+    Copy rank 0's buffers (BatchNorm running statistics) to every process. DistributedDataParallel
+    broadcasts them before each forward pass, so the updates of the last training step differ.
+    '''
+    if is_distributed():
+        for buffer in model.buffers():
+            dist.broadcast(buffer, 0)
+
+def all_reduce(values, op="sum"):
+    '''
+    Numbers summed (or maxed, op="max") over all processes, as a list of floats.
+    '''
+    if not is_distributed():
+        return [float(value) for value in values]
+    tensor = torch.tensor([float(value) for value in values], dtype=torch.float64)
+    dist.all_reduce(tensor, op=dist.ReduceOp.MAX if op == "max" else dist.ReduceOp.SUM)
+    return tensor.tolist()
+
+def all_gather(obj):
+    '''
+    List of `obj` from every process, indexed by rank.
+    '''
+    if not is_distributed():
+        return [obj]
+    gathered = [None] * world_size()
+    dist.all_gather_object(gathered, obj)
+    return gathered
@@ -0,0 +1,177 @@
+import os
+import argparse
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import torch.optim as optim
+from resnet_parameters import Parameters
+from torch.utils.data import DataLoader
+from ferplus import FERPlusReader, FERPlusDataset
+from torch.optim.lr_scheduler import StepLR
+from resnet_model_train import validate_model, test_model
+import model_util
+
+# Distill the trained teacher(s) into a small grayscale student for CPU serving.
+#
+#   python distill_model.py --teacher best_model.pth --student compact --input-size 48
+#   python distill_model.py --teacher best_model.pth --teacher efficientnet.pth --student mobilenet_v3_small
+#
+# The student learns from the teachers' softened logits and from the FER+ vote distribution
+# (Parameters.training_mode = "crossentropy"). It is saved like best_model.pth, with its input
+# size recorded, so model_util.load_checkpoint and the backend load it as is; serve it with
+# EMOTION_MODEL_PATH=best_student.pth. Each teacher sees the resolution its checkpoint records.
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Distill the FERPlus emotion model into a small CPU student.")
+    parser.add_argument("--teacher", action="append", default=None,
+                        help="teacher checkpoint, can be repeated to average several teachers (default best_model.pth)")
+    parser.add_argument("--teacher-size", type=int, default=None,
+                        help="resolution the teachers were trained at, if they do not record it (224 otherwise)")
+    parser.add_argument("--student", choices=model_util.STUDENT_ARCHS, default="compact")
+    parser.add_argument("--input-size", type=int, default=48, help="student resolution")
+    parser.add_argument("--output", default="best_student.pth")
+    parser.add_argument("--temperature", type=float, default=4.0)
+    parser.add_argument("--alpha", type=float, default=0.7, help="weight of the teacher term, the rest goes to the FER+ votes")
+    parser.add_argument("--epochs", type=int, default=30)
+    parser.add_argument("--lr", type=float, default=1e-3)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--base-folder", default="Datasets/FERPlus-master/data")
+    return parser.parse_args()
+
+def teacher_inputs(images, input_size, in_channels):
+    '''
+    Student batches hold the grayscale face in [0, 1]. Resize them to the teacher's resolution and,
+    for a 3-channel teacher, replicate and ImageNet-normalize as eval_transform would.
+    '''
+    if images.shape[-1] != input_size:
+        images = F.interpolate(images, size=(input_size, input_size), mode="bilinear", align_corners=False)
+    if in_channels == 3:
+        mean = torch.tensor(model_util.IMAGENET_MEAN, device=images.device).view(1, 3, 1, 1)
+        std = torch.tensor(model_util.IMAGENET_STD, device=images.device).view(1, 3, 1, 1)
+        images = (images.expand(-1, 3, -1, -1) - mean) / std
+    return images
+
+def teacher_logits(teachers, images, input_sizes):
+    with torch.no_grad():
+        logits = [teacher(teacher_inputs(images, input_size, model_util.input_channels(teacher)))
+                  for teacher, input_size in zip(teachers, input_sizes)]
+    return torch.stack(logits).mean(dim=0)
+
+def distillation_loss(student_logits, teacher_logits, soft_labels, temperature, alpha):
+    '''
+    alpha * T^2 * KL(teacher_T || student_T) + (1 - alpha) * cross entropy against the FER+ votes.
+    The T^2 factor keeps the gradient scale of the softened term independent of the temperature.
+    '''
+    kd = F.kl_div(F.log_softmax(student_logits / temperature, dim=1),
+                  F.softmax(teacher_logits / temperature, dim=1),
+                  reduction="batchmean") * temperature ** 2
+    ce = -(soft_labels * F.log_softmax(student_logits, dim=1)).sum(dim=1).mean()
+    return alpha * kd + (1 - alpha) * ce
+
+def train_student(student, teachers, teacher_sizes, train_loader, val_loader, args, device="cpu"):
+    criterion = nn.CrossEntropyLoss()
+    optimizer = optim.AdamW(student.parameters(), lr=args.lr, weight_decay=1e-4)
+    scheduler = StepLR(optimizer, step_size=10, gamma=0.1)
+
+    best_val_loss = float("inf")
+    patience = 5
+    patience_counter = 0
+
+    for epoch in range(args.epochs):
+        student.train()
+        running_loss = 0.0
+        correct = 0
+        total = 0
+
+        for batch in train_loader:
+            images = batch['image'].to(device)
+            soft_labels = batch['emotion'].to(device)
+
+            targets = teacher_logits(teachers, images, teacher_sizes)
+            optimizer.zero_grad()
+            outputs = student(images)
+            loss = distillation_loss(outputs, targets, soft_labels, args.temperature, args.alpha)
+            loss.backward()
+            optimizer.step()
+
+            running_loss += loss.item()
+            total += images.size(0)
+            correct += outputs.argmax(dim=1).eq(soft_labels.argmax(dim=1)).sum().item()
+
+        val_loss, val_acc = validate_model(student, val_loader, criterion, device)
+
+        if val_loss < best_val_loss:
+            best_val_loss = val_loss
+            patience_counter = 0
+            torch.save(model_util.checkpoint_state(student, args.input_size), args.output)
+        else:
+            patience_counter += 1
+            if patience_counter >= patience:
+                print(f"🟡 Early stopping at epoch {epoch+1}.")
+                break
+
+        scheduler.step()
+
+        print(f"Epoch [{epoch+1}/{args.epochs}] | Distill Loss: {running_loss / len(train_loader):.4f} | "
+              f"Train Acc: {100 * correct / total:.2f}% | Val Loss: {val_loss:.4f} | Val Acc: {val_acc:.2f}% | "
+              f"LR: {scheduler.get_last_lr()[0]:.6f}")
+
+    print(f"Distillation complete. Best student saved as '{args.output}'.")
+
+def report(models, args, test_reader):
+    '''
+    FER2013Test accuracy, size and CPU latency of each teacher and the student, at their own resolution.
+    '''
+    criterion = nn.CrossEntropyLoss()
+    rows = []
+    for name, model, input_size in models:
+        model = model.cpu().eval()
+        in_channels = model_util.input_channels(model)
+        loader = DataLoader(FERPlusDataset(test_reader, transform=model_util.eval_transform(input_size, in_channels)),
+                            batch_size=args.batch_size, shuffle=False, num_workers=2)
+        single = model_util.measure_latency(model, batch_size=1, input_size=input_size, in_channels=in_channels)
+        batched = model_util.measure_latency(model, batch_size=16, input_size=input_size, in_channels=in_channels)
+        rows.append((name, input_size, sum(p.numel() for p in model.parameters()), test_model(model, loader, criterion),
+                     single["median_ms"], 16 * 1000.0 / batched["median_ms"]))
+
+    reference_ms = rows[0][4]
+    print(f"CPU report ({torch.get_num_threads()} threads, speedup is batch 1 latency relative to {rows[0][0]}):")
+    for name, input_size, params, accuracy, ms, throughput in rows:
+        print(f"  {name:<24} | {input_size:>3}px | {params / 1e6:6.2f}M params | {accuracy} | "
+              f"batch 1 {ms:8.2f} ms | batch 16 {throughput:8.1f} img/s | {reference_ms / ms:5.1f}x")
+
+def main():
+    args = parse_args()
+    teacher_paths = args.teacher or ["best_model.pth"]
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    print(f"🟡 Using Device: {device}")
+
+    parameters = Parameters()
+    train_reader = FERPlusReader.create(args.base_folder, ["FER2013Train"], "label.csv", parameters)
+    valid_reader = FERPlusReader.create(args.base_folder, ["FER2013Valid"], "label.csv", parameters)
+    test_reader = FERPlusReader.create(args.base_folder, ["FER2013Test"], "label.csv", parameters)
+
+    # Students read the grayscale face directly; teacher inputs are derived from the same batch
+    train_dataset = FERPlusDataset(train_reader, transform=model_util.train_transform(args.input_size, 1))
+    valid_dataset = FERPlusDataset(valid_reader, transform=model_util.eval_transform(args.input_size, 1))
+    train_loader = DataLoader(train_dataset, batch_size=args.batch_size, shuffle=True, num_workers=4, pin_memory=True)
+    valid_loader = DataLoader(valid_dataset, batch_size=args.batch_size, shuffle=False, num_workers=4, pin_memory=True)
+
+    teachers = [model_util.load_checkpoint(path, device) for path in teacher_paths]
+    teacher_sizes = [model_util.checkpoint_input_size(path, args.teacher_size) for path in teacher_paths]
+    for teacher in teachers:
+        for param in teacher.parameters():
+            param.requires_grad = False
+    print(f"🟡 Loaded {len(teachers)} teacher(s): {', '.join(teacher_paths)}")
+
+    student = model_util.create_student(args.student, in_channels=1).to(device)
+    print(f"🟡 {args.student} student with {sum(p.numel() for p in student.parameters()) / 1e6:.2f}M parameters")
+
+    train_student(student, teachers, teacher_sizes, train_loader, valid_loader, args, device)
+
+    student = model_util.load_checkpoint(args.output)
+    models = [(os.path.basename(path), teacher, size) for path, teacher, size in zip(teacher_paths, teachers, teacher_sizes)]
+    report(models + [(f"student ({args.student})", student, args.input_size)], args, test_reader)
+
+if __name__ == "__main__":
+    main()
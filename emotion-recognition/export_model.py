@@ -0,0 +1,99 @@
+import os
+import argparse
+import torch
+from resnet_parameters import Parameters
+from torch.utils.data import DataLoader
+from ferplus import FERPlusReader, FERPlusDataset
+import model_util
+
+# Export best_model.pth to TorchScript and/or ONNX, then check the exported graphs against eager PyTorch.
+#
+#   python export_model.py --format all --parity --latency
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Export the FERPlus emotion model for serving.")
+    parser.add_argument("--checkpoint", default="best_model.pth")
+    parser.add_argument("--output-dir", default=".")
+    parser.add_argument("--format", choices=["torchscript", "onnx", "all"], default="all")
+    parser.add_argument("--input-size", type=int, default=None,
+                        help="resolution the checkpoint was trained at, if it does not record it (224 otherwise)")
+    parser.add_argument("--parity", action="store_true", help="compare exported outputs to eager on FER2013Test")
+    parser.add_argument("--latency", action="store_true", help="compare CPU latency of eager and exported models")
+    parser.add_argument("--base-folder", default="Datasets/FERPlus-master/data")
+    parser.add_argument("--batch-size", type=int, default=64)
+    return parser.parse_args()
+
+def export(args, eager):
+    name = os.path.splitext(os.path.basename(args.checkpoint))[0]
+    exported = {}
+
+    if args.format in ("torchscript", "all"):
+        path = os.path.join(args.output_dir, name + ".ts")
+        model_util.export_torchscript(eager, path, args.input_size)
+        exported["torchscript"] = model_util.load_torchscript(path)
+        print(f"🟡 TorchScript (frozen, conv+bn fused) saved to {path}")
+
+    if args.format in ("onnx", "all"):
+        path = os.path.join(args.output_dir, name + ".onnx")
+        optimized_path = os.path.join(args.output_dir, name + ".opt.onnx")
+        model_util.export_onnx(eager, path, args.input_size)
+        model_util.optimize_onnx(path, optimized_path)
+        exported["onnx"] = model_util.OnnxModel(optimized_path, optimized=True)
+        print(f"🟡 ONNX saved to {path}, ORT-optimized graph saved to {optimized_path}")
+
+    return exported
+
+def parity_check(args, eager, exported):
+    parameters = Parameters()
+    test_reader = FERPlusReader.create(args.base_folder, ["FER2013Test"], "label.csv", parameters)
+    test_dataset = FERPlusDataset(test_reader, transform=model_util.eval_transform(args.input_size, model_util.input_channels(eager)))
+    test_loader = DataLoader(test_dataset, batch_size=args.batch_size, shuffle=False, num_workers=2)
+
+    max_diff = {name: 0.0 for name in exported}
+    agree = {name: 0 for name in exported}
+    correct = {name: 0 for name in ["eager", *exported]}
+    total = 0
+
+    with torch.no_grad():
+        for batch in test_loader:
+            images = batch['image']
+            labels = batch['emotion'].argmax(dim=1)
+            reference = eager(images)
+            correct["eager"] += reference.argmax(dim=1).eq(labels).sum().item()
+
+            for name, model in exported.items():
+                outputs = model(images)
+                max_diff[name] = max(max_diff[name], (outputs - reference).abs().max().item())
+                agree[name] += outputs.argmax(dim=1).eq(reference.argmax(dim=1)).sum().item()
+                correct[name] += outputs.argmax(dim=1).eq(labels).sum().item()
+            total += labels.size(0)
+
+    print(f"Parity on FER2013Test ({total} images):")
+    print(f"  eager        | Test Acc: {100 * correct['eager'] / total:.2f}%")
+    for name in exported:
+        print(f"  {name.ljust(12)} | Test Acc: {100 * correct[name] / total:.2f}% | "
+              f"Max |logit diff|: {max_diff[name]:.2e} | Top-1 agreement: {100 * agree[name] / total:.2f}%")
+
+def latency_check(eager, exported, input_size):
+    print("CPU latency (median / p95 ms):")
+    for batch_size in (1, 16):
+        for name, model in [("eager", eager), *exported.items()]:
+            result = model_util.measure_latency(model, batch_size=batch_size, input_size=input_size,
+                                                in_channels=model_util.input_channels(eager))
+            print(f"  {name.ljust(12)} | batch {batch_size:>2} | {result['median_ms']:8.2f} / {result['p95_ms']:8.2f}")
+
+def main():
+    args = parse_args()
+    args.input_size = model_util.checkpoint_input_size(args.checkpoint, args.input_size)
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    eager = model_util.load_checkpoint(args.checkpoint)
+    exported = export(args, eager)
+
+    if args.parity:
+        parity_check(args, eager, exported)
+    if args.latency:
+        latency_check(eager, exported, args.input_size)
+
+if __name__ == "__main__":
+    main()
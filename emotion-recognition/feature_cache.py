@@ -0,0 +1,150 @@
+import os
+import copy
+import math
+import hashlib
+import logging
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.utils.data import DataLoader, RandomSampler
+from torchvision import models
+
+# Head-only training on cached backbone outputs (Parameters.feature_cache, used by trainer.Trainer).
+#
+# While the leading modules of a model are frozen their output for a given image never changes,
+# so it is computed once per split, stored in <folder>/<model>-<split>-<key>.*.npy (memory-mapped, float16)
+# and the trainable rest of the model trains on that. The frozen prefix is whatever leads the
+# module order with no trainable parameter: all of EfficientNet-B0's features plus pooling (1280
+# pooled features per image) in EfficientNet_model_train.py, conv1 to layer1 in resnet_model_train.py
+# (64-channel feature maps, about 400 KB per image at 224px, 74 KB at 48px). The small stems
+# (model_util.resnet_small_stem, efficientnet_small_stem) are trainable by default, which leaves no
+# frozen prefix, so the training scripts keep them frozen when feature caching is requested.
+#
+# Caching runs the prefix in eval mode with the validation transform, so the head sees neither
+# augmentation nor batch-statistics BatchNorm in the frozen layers while it trains from the cache.
+# As soon as a parameter in the prefix is unfrozen, training goes back to full forward passes.
+
+def module_sequence(model):
+    '''
+    The model as an ordered list of modules whose composition is the forward pass.
+    '''
+    if isinstance(model, models.EfficientNet):
+        return [*model.features.children(), model.avgpool, nn.Flatten(1), model.classifier]
+    if isinstance(model, models.ResNet):
+        return [model.conv1, model.bn1, model.relu, model.maxpool, model.layer1, model.layer2,
+                model.layer3, model.layer4, model.avgpool, nn.Flatten(1), model.fc]
+    raise ValueError("Feature caching supports ResNet and EfficientNet models, not %s" % type(model).__name__)
+
+def split_frozen(model):
+    '''
+    (prefix, head): the longest leading run of modules without trainable parameters, and the rest.
+    Both share the model's modules, so training the head trains the model.
+    '''
+    sequence = module_sequence(model)
+    length = 0
+    while length < len(sequence) - 1 and not any(p.requires_grad for p in sequence[length].parameters()):
+        length += 1
+    return nn.Sequential(*sequence[:length]), nn.Sequential(*sequence[length:])
+
+class FeatureLoader(object):
+    '''
+    Batches of cached features as {'image', 'emotion'} dicts, gathered with one fancy index per
+    batch instead of one __getitem__ per sample.
+    '''
+    def __init__(self, features, labels, batch_size, shuffle):
+        self.features = features
+        self.labels = labels
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+
+    def __len__(self):
+        return math.ceil(len(self.labels) / self.batch_size)
+
+    def __iter__(self):
+        order = np.random.permutation(len(self.labels)) if self.shuffle else np.arange(len(self.labels))
+        for start in range(0, len(order), self.batch_size):
+            # sorted indices read the memory-mapped file front to back
+            indices = np.sort(order[start:start + self.batch_size])
+            yield {'image': torch.from_numpy(self.features[indices].astype(np.float32)),
+                   'emotion': torch.from_numpy(np.array(self.labels[indices]))}
+
+class FeatureCache(object):
+    '''
+    Cached prefix outputs for one model. `active()` tells whether the prefix cached at the first
+    `loaders()` call is still frozen; `head` is the module that trains on the cached features.
+    '''
+    def __init__(self, model, folder, batch_size=256, dtype=np.float16):
+        self.name = type(model).__name__.lower()
+        self.prefix, self.head = split_frozen(model)
+        self.folder = folder
+        self.batch_size = batch_size
+        self.dtype = np.dtype(dtype)
+        self.cached = None
+
+    def active(self):
+        return len(self.prefix) > 0 and not any(p.requires_grad for p in self.prefix.parameters())
+
+    def _key(self, dataset, transform):
+        '''
+        Hash of what the features depend on: the prefix weights, the transform and the split's labels.
+        '''
+        digest = hashlib.sha1(("%s:%s:%d" % (repr(transform), self.dtype.str, len(dataset))).encode())
+        for name, tensor in self.prefix.state_dict().items():
+            digest.update(name.encode())
+            digest.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+        if hasattr(dataset, 'labels'):
+            digest.update(np.asarray(dataset.labels).tobytes())
+        return digest.hexdigest()[:16]
+
+    def features(self, name, dataset, transform, device="cpu"):
+        '''
+        (features, labels) of `dataset` through the prefix, from <folder>/<model>-<name>-<key>.*.npy,
+        computing them first if the prefix, transform or split changed. Stale caches are removed.
+        '''
+        prefix = "%s-%s-" % (self.name, name)
+        stem = os.path.join(self.folder, prefix + self._key(dataset, transform))
+
+        if not all(os.path.exists("%s.%s.npy" % (stem, part)) for part in ("features", "labels")):
+            os.makedirs(self.folder, exist_ok=True)
+            for old in os.listdir(self.folder):
+                if old.startswith(prefix):
+                    os.remove(os.path.join(self.folder, old))
+
+            dataset = copy.copy(dataset)
+            dataset.transform = transform
+            loader = DataLoader(dataset, batch_size=self.batch_size, shuffle=False, num_workers=2)
+            self.prefix.eval()
+            features, labels, offset = None, None, 0
+            # write under a temporary name first so an interrupted run is never picked up
+            with torch.no_grad():
+                for batch in loader:
+                    output = self.prefix(batch['image'].to(device)).cpu().numpy()
+                    if features is None:
+                        features = np.lib.format.open_memmap("%s.features.tmp" % stem, mode="w+", dtype=self.dtype,
+                                                             shape=(len(dataset),) + output.shape[1:])
+                        labels = np.empty((len(dataset), batch['emotion'].shape[1]), dtype=np.float32)
+                    features[offset:offset + len(output)] = output
+                    labels[offset:offset + len(output)] = batch['emotion'].numpy()
+                    offset += len(output)
+            features.flush()
+            del features
+            with open("%s.labels.tmp" % stem, "wb") as f:
+                np.save(f, labels)
+            for part in ("features", "labels"):
+                os.replace("%s.%s.tmp" % (stem, part), "%s.%s.npy" % (stem, part))
+            logging.info("Cached %s features to %s" % (name, stem))
+
+        return np.load("%s.features.npy" % stem, mmap_mode="r"), np.load("%s.labels.npy" % stem)
+
+    def loaders(self, train_loader, val_loader, device="cpu"):
+        '''
+        FeatureLoaders standing in for train_loader and val_loader. Both splits are cached with the
+        validation loader's (deterministic) transform.
+        '''
+        if self.cached is None:
+            transform = val_loader.dataset.transform
+            train = self.features("train", train_loader.dataset, transform, device)
+            val = self.features("val", val_loader.dataset, transform, device)
+            self.cached = (FeatureLoader(*train, train_loader.batch_size, isinstance(train_loader.sampler, RandomSampler)),
+                           FeatureLoader(*val, val_loader.batch_size, False))
+        return self.cached
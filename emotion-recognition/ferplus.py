@@ -6,18 +6,26 @@
 import sys
 import os
 import csv
+import hashlib
+import time
+import uuid
 import numpy as np
 import logging
 import random as rnd
 from collections import namedtuple
 
 from PIL import Image
-from rect_util import Rect
+from rect_util import RectArray
 import img_util as imgu
 import matplotlib.pyplot as plt
 from torch.utils.data import Dataset
 import torch
 
+# Part of the binary cache key; bump it when the way the compiled arrays are produced changes
+CACHE_VERSION = 1
+# Temporary files of an interrupted compile are removed once they are this old
+STALE_TMP_SECONDS = 3600
+
 def display_summary(train_data_reader, val_data_reader, test_data_reader):
     '''
     Summarize the data in a tabular format.
@@ -36,13 +44,14 @@ class FERPlusParameters():
     '''
     FER+ reader parameters
     '''
-    def __init__(self, target_size, width, height, training_mode = "majority", determinisitc = False, shuffle = True):
+    def __init__(self, target_size, width, height, training_mode = "majority", determinisitc = False, shuffle = True, cache_folder = None):
         self.target_size   = target_size
         self.width         = width
         self.height        = height
         self.training_mode = training_mode
         self.determinisitc = determinisitc
         self.shuffle       = shuffle
+        self.cache_folder  = cache_folder
                      
 class FERPlusReader(object):
     '''
@@ -72,6 +81,10 @@ class FERPlusReader(object):
         self.shuffle         = parameters.shuffle
         self.training_mode   = parameters.training_mode
 
+        # compiled .npy cache of each sub folder, None means <base_folder>/cache and "" disables it
+        cache_folder = getattr(parameters, "cache_folder", None)
+        self.cache_folder = os.path.join(base_folder, "cache") if cache_folder is None else cache_folder
+
         # data augmentation parameters.determinisitc
         if parameters.determinisitc:
             self.max_shift = 0.0
@@ -86,18 +99,19 @@ class FERPlusReader(object):
             self.max_skew = 0.05
             self.do_flip = True
         
-        self.data              = None
+        self.paths             = None
+        self.images            = None
+        self.labels            = None
+        self.rects             = None
         self.per_emotion_count = None
         self.batch_start       = 0
         self.indices           = 0
-
-        self.A, self.A_pinv = imgu.compute_norm_mat(self.width, self.height)
         
     def has_more(self):
         '''
         Return True if there is more min-batches.
         '''
-        if self.batch_start < len(self.data):
+        if self.batch_start < len(self.labels):
             return True
         return False
 
@@ -111,13 +125,20 @@ class FERPlusReader(object):
         '''
         Return the number of images read by this reader.
         '''
-        return len(self.data)
+        return len(self.labels)
+
+    @property
+    def data(self):
+        '''
+        The samples as (image_path, image, emotion, face_rc) tuples, built on access from the arrays.
+        '''
+        return FERPlusSamples(self)
         
     def next_minibatch(self, batch_size):
         '''
         Return the next mini-batch, we do data augmentation during constructing each mini-batch.
         '''
-        data_size = len(self.data)
+        data_size = len(self.labels)
         batch_end = min(self.batch_start + batch_size, data_size)
         current_batch_size = batch_end - self.batch_start
         if current_batch_size < 0:
@@ -125,154 +146,307 @@ class FERPlusReader(object):
         
         inputs = np.empty(shape=(current_batch_size, 1, self.width, self.height), dtype=np.float32)
         targets = np.empty(shape=(current_batch_size, self.emotion_count), dtype=np.float32)
-        for idx in range(self.batch_start, batch_end):
-            index = self.indices[idx]
-            distorted_image = imgu.distort_img(self.data[index][1], 
-                                               self.data[index][3], 
-                                               self.width, 
-                                               self.height, 
-                                               self.max_shift, 
-                                               self.max_scale, 
-                                               self.max_angle, 
-                                               self.max_skew, 
-                                               self.do_flip)
-            final_image = imgu.preproc_img(distorted_image, A=self.A, A_pinv=self.A_pinv)
-
-            inputs[idx-self.batch_start]    = final_image
-            targets[idx-self.batch_start,:] = self._process_target(self.data[index][2])
+
+        # the whole mini-batch is distorted with one batched warp (see img_util.distort_batch)
+        indices = self.indices[self.batch_start:batch_end]
+        distorted_images = imgu.distort_batch(self.images[indices], 
+                                              RectArray(self.rects[indices]), 
+                                              self.width, 
+                                              self.height, 
+                                              self.max_shift, 
+                                              self.max_scale, 
+                                              self.max_angle, 
+                                              self.max_skew, 
+                                              self.do_flip)
+        inputs[:, 0] = imgu.preproc_batch(distorted_images)
+        targets[:] = process_targets(self.labels[indices], self.training_mode)
 
         self.batch_start += current_batch_size
         return inputs, targets, current_batch_size
         
     def load_folders(self, mode):
         '''
-        Load the actual images from disk. While loading, we normalize the input data.
+        Load the actual images from disk. While loading, we normalize the input data. Each sub folder is
+        compiled once into contiguous arrays (see _load_folder_cached); later loads memory-map them.
         '''
         self.reset()
-        self.data = []
-        self.per_emotion_count = np.zeros(self.emotion_count, dtype=int)
-        
-        for folder_name in self.sub_folders: 
-            logging.info("Loading %s" % (os.path.join(self.base_folder, folder_name)))
-            folder_path = os.path.join(self.base_folder, folder_name)
-            in_label_path = os.path.join(self.base_folder, folder_name, self.label_file_name)
-            with open(in_label_path) as csvfile: 
-                emotion_label = csv.reader(csvfile) 
-                for row in emotion_label: 
-                    # load the image
-                    image_path = os.path.join(folder_path, row[0])
-                    image_data = Image.open(image_path)
-                    image_data.load()
-
-                    # face rectangle 
-                    box = list(map(int, row[1][1:-1].split(',')))
-                    face_rc = Rect(box)
-
-                    emotion_raw = list(map(float, row[2:len(row)]))
-                    emotion = self._process_data(emotion_raw, mode) 
-                    idx = np.argmax(emotion)
-                    if idx < self.emotion_count: # not unknown or non-face 
-                        emotion = emotion[:-2]
-                        emotion = [float(i)/sum(emotion) for i in emotion]
-                        self.data.append((image_path, image_data, emotion, face_rc))
-                        self.per_emotion_count[idx] += 1
-        
-        self.indices = np.arange(len(self.data))
+        parts = [self._load_folder_cached(folder_name, mode) if self.cache_folder else self._load_folder(folder_name, mode)
+                 for folder_name in self.sub_folders]
+        if len(parts) == 1:
+            self.paths, self.images, self.labels, self.rects = parts[0]
+        else:
+            self.paths, self.images, self.labels, self.rects = [np.concatenate(arrays) for arrays in zip(*parts)]
+
+        self.per_emotion_count = np.bincount(np.argmax(self.labels, axis=1), minlength=self.emotion_count)
+        self.indices = np.arange(len(self.labels))
         if self.shuffle:
             np.random.shuffle(self.indices)
+
+    def _load_folder(self, folder_name, mode):
+        '''
+        Decode every image of one sub folder and process its labels. Returns the arrays
+        (paths, images uint8 N x H x W, labels float32 N x emotion_count, rects int32 N x 4).
+        '''
+        logging.info("Loading %s" % (os.path.join(self.base_folder, folder_name)))
+        folder_path = os.path.join(self.base_folder, folder_name)
+        in_label_path = os.path.join(self.base_folder, folder_name, self.label_file_name)
+        with open(in_label_path) as csvfile: 
+            rows = list(csv.reader(csvfile))
+
+        # face rectangles and raw votes of the whole folder, labels are processed in one pass
+        boxes = np.array([list(map(int, row[1][1:-1].split(','))) for row in rows], dtype=np.int32).reshape(-1, 4)
+        votes = np.array([list(map(float, row[2:len(row)])) for row in rows], dtype=np.float64).reshape(len(rows), -1)
+        emotion = process_votes(votes, mode)
+        keep = np.argmax(emotion, axis=1) < self.emotion_count # not unknown or non-face 
+        emotion = emotion[keep, :-2]
+        labels = emotion / sequential_sum(emotion)[:, None]
+
+        paths, images = [], []
+        for row in (row for row, kept in zip(rows, keep) if kept):
+            image_path = os.path.join(folder_path, row[0])
+            with Image.open(image_path) as image_data:
+                images.append(np.asarray(image_data))
+            paths.append(image_path)
+
+        return (np.array(paths, dtype=str),
+                np.stack(images) if images else np.empty((0, self.height, self.width), dtype=np.uint8),
+                labels.astype(np.float32).reshape(-1, self.emotion_count),
+                boxes[keep])
+
+    def _source_key(self, folder_name, mode):
+        '''
+        Hash of what the compiled arrays depend on: the label file, the folder's modification time
+        (which changes when images are added, removed or replaced) and the training mode. Stat-ing
+        every image instead would cost more than loading the cache; images edited in place without
+        touching the folder need compile_ferplus.py --force.
+        '''
+        folder_path = os.path.join(self.base_folder, folder_name)
+        digest = hashlib.sha1(("%s:%d" % (mode, CACHE_VERSION)).encode())
+        with open(os.path.join(folder_path, self.label_file_name), "rb") as f:
+            digest.update(f.read())
+        digest.update(str(os.stat(folder_path).st_mtime_ns).encode())
+        return digest.hexdigest()[:16]
+
+    def _load_folder_cached(self, folder_name, mode):
+        '''
+        Load one sub folder from <cache_folder>/<folder>-<mode>-<key>.*.npy, memory-mapped, compiling
+        it first if the source changed since the cache was written. Stale caches are removed.
+        '''
+        prefix = "%s-%s-" % (folder_name, mode)
+        stem = os.path.join(self.cache_folder, prefix + self._source_key(folder_name, mode))
+        names = ("paths", "images", "labels", "rects")
+
+        if not all(os.path.exists("%s.%s.npy" % (stem, name)) for name in names):
+            arrays = self._load_folder(folder_name, mode)
+            os.makedirs(self.cache_folder, exist_ok=True)
+            # Several processes may compile the same folder at once (one per torchrun rank), so each
+            # writes its own temporary files. Stale are finished arrays of other keys and temporary
+            # files old enough that no compile can still be writing them.
+            for old in os.listdir(self.cache_folder):
+                path = os.path.join(self.cache_folder, old)
+                if old.startswith(prefix) and old.endswith(".npy") and not old.startswith(os.path.basename(stem) + "."):
+                    _remove(path)
+                elif old.startswith(prefix) and old.endswith(".tmp") and _age(path) > STALE_TMP_SECONDS:
+                    _remove(path)
+            # write under a temporary name first so an interrupted compile is never picked up
+            tmp = "%s.%d-%s" % (stem, os.getpid(), uuid.uuid4().hex[:8])
+            for name, array in zip(names, arrays):
+                with open("%s.%s.tmp" % (tmp, name), "wb") as f:
+                    np.save(f, array)
+            for name in names:
+                try:
+                    os.replace("%s.%s.tmp" % (tmp, name), "%s.%s.npy" % (stem, name))
+                except OSError:
+                    # another process put the same arrays in place first (Windows refuses to replace them while mapped)
+                    if not os.path.exists("%s.%s.npy" % (stem, name)):
+                        raise
+                    _remove("%s.%s.tmp" % (tmp, name))
+            logging.info("Compiled %s to %s" % (os.path.join(self.base_folder, folder_name), stem))
+
+        return tuple(np.load("%s.%s.npy" % (stem, name), mmap_mode="r" if name != "paths" else None) for name in names)
     
     def _process_target(self, target):
         '''
-        Based on https://arxiv.org/abs/1608.01041 the target depend on the training mode.
-
-        Majority or crossentropy: return the probability distribution generated by "_process_data"
-        Probability: pick one emotion based on the probability distribtuion.
-        Multi-target: 
+        Based on https://arxiv.org/abs/1608.01041 the target depend on the training mode (see process_targets).
         '''
-        if self.training_mode == 'majority' or self.training_mode == 'crossentropy': 
-            return target
-        elif self.training_mode == 'probability': 
-            idx             = np.random.choice(len(target), p=target) 
-            new_target      = np.zeros_like(target)
-            new_target[idx] = 1.0
-            return new_target
-        elif self.training_mode == 'multi_target': 
-            new_target = np.array(target) 
-            new_target[new_target>0] = 1.0
-            epsilon = 0.001     # add small epsilon in order to avoid ill-conditioned computation
-            return (1-epsilon)*new_target + epsilon*np.ones_like(target)
+        return process_targets(np.asarray(target)[None, :], self.training_mode)[0]
 
     def _process_data(self, emotion_raw, mode):
         '''
-        Based on https://arxiv.org/abs/1608.01041, we process the data differently depend on the training mode:
-
-        Majority: return the emotion that has the majority vote, or unknown if the count is too little.
-        Probability or Crossentropty: convert the count into probability distribution.abs
-        Multi-target: treat all emotion with 30% or more votes as equal.
-        '''        
-        size = len(emotion_raw)
-        emotion_unknown     = [0.0] * size
-        emotion_unknown[-2] = 1.0
-
-        # remove emotions with a single vote (outlier removal) 
-        for i in range(size):
-            if emotion_raw[i] < 1.0 + sys.float_info.epsilon:
-                emotion_raw[i] = 0.0
-
-        sum_list = sum(emotion_raw)
-        emotion = [0.0] * size 
-
-        if mode == 'majority': 
-            # find the peak value of the emo_raw list 
-            maxval = max(emotion_raw) 
-            if maxval > 0.5*sum_list: 
-                emotion[np.argmax(emotion_raw)] = maxval 
-            else: 
-                emotion = emotion_unknown   # force setting as unknown 
-        elif (mode == 'probability') or (mode == 'crossentropy'):
-            sum_part = 0
-            count = 0
-            valid_emotion = True
-            while sum_part < 0.75*sum_list and count < 3 and valid_emotion:
-                maxval = max(emotion_raw) 
-                for i in range(size): 
-                    if emotion_raw[i] == maxval: 
-                        emotion[i] = maxval
-                        emotion_raw[i] = 0
-                        sum_part += emotion[i]
-                        count += 1
-                        if i >= 8:  # unknown or non-face share same number of max votes 
-                            valid_emotion = False
-                            if sum(emotion) > maxval:   # there have been other emotions ahead of unknown or non-face
-                                emotion[i] = 0
-                                count -= 1
-                            break
-            if sum(emotion) <= 0.5*sum_list or count > 3: # less than 50% of the votes are integrated, or there are too many emotions, we'd better discard this example
-                emotion = emotion_unknown   # force setting as unknown 
-        elif mode == 'multi_target':
-            threshold = 0.3
-            for i in range(size): 
-                if emotion_raw[i] >= threshold*sum_list: 
-                    emotion[i] = emotion_raw[i] 
-            if sum(emotion) <= 0.5 * sum_list: # less than 50% of the votes are integrated, we discard this example 
-                emotion = emotion_unknown   # set as unknown 
-                                
-        return [float(i)/sum(emotion) for i in emotion]
+        Based on https://arxiv.org/abs/1608.01041, we process the data differently depend on the training mode
+        (see process_votes).
+        '''
+        return process_votes(np.asarray(emotion_raw, dtype=np.float64)[None, :], mode)[0].tolist()
+
+def _age(path):
+    '''
+    Seconds since `path` was last modified, 0 if it is gone.
+    '''
+    try:
+        return time.time() - os.path.getmtime(path)
+    except FileNotFoundError:
+        return 0.0
+
+def _remove(path):
+    '''
+    os.remove that tolerates another process having removed the file already.
+    '''
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+def sequential_sum(values):
+    '''
+    Row sums accumulated left to right like Python's sum(), which np.sum's pairwise summation is not.
+    '''
+    return values.cumsum(axis=1)[:, -1]
+
+def process_votes(votes, mode):
+    '''
+    Turn an N x 10 matrix of raw votes (8 emotions, unknown, non-face) into target distributions,
+    depending on the training mode (https://arxiv.org/abs/1608.01041):
+
+    Majority: return the emotion that has the majority vote, or unknown if the count is too little.
+    Probability or Crossentropty: convert the count into probability distribution.
+    Multi-target: treat all emotion with 30% or more votes as equal.
+
+    Rows without a usable distribution become "unknown". Results are identical to the former per-row loop.
+    '''
+    count, size = votes.shape
+    rows = np.arange(count)
+    emotion_unknown = np.zeros(size)
+    emotion_unknown[-2] = 1.0
+
+    # remove emotions with a single vote (outlier removal) 
+    raw = np.where(votes < 1.0 + sys.float_info.epsilon, 0.0, votes)
+    sum_list = sequential_sum(raw)
+    emotion = np.zeros_like(raw)
+
+    if mode == 'majority': 
+        # find the peak value of the emo_raw list 
+        maxval = raw.max(axis=1)
+        valid = maxval > 0.5*sum_list
+        emotion[rows[valid], np.argmax(raw[valid], axis=1)] = maxval[valid]
+        unknown = ~valid
+    elif (mode == 'probability') or (mode == 'crossentropy'):
+        # Take the most voted emotions (all ties at once) in rounds until they hold 75% of the votes or 3 are
+        # taken. Reaching unknown or non-face stops the row; that column is kept only if nothing was taken before.
+        sum_part = np.zeros(count)
+        taken = np.zeros(count, dtype=int)
+        valid_emotion = np.ones(count, dtype=bool)
+        active = (sum_part < 0.75*sum_list) & (taken < 3) & valid_emotion
+        while active.any():
+            maxval = np.where(active, raw.max(axis=1), np.nan)
+            ties = raw == maxval[:, None]
+            ties_other = ties[:, -2:].copy()
+            ties_emotion = ties
+            ties_emotion[:, -2:] = False
+
+            # emotions come before unknown and non-face in the original index order
+            emotion[ties_emotion] = raw[ties_emotion]
+            raw[ties_emotion] = 0.0
+            sum_part += np.where(active, maxval*ties_emotion.sum(axis=1), 0.0)
+            taken += ties_emotion.sum(axis=1)
+
+            hit = ties_other.any(axis=1)
+            other = size - 2 + np.argmax(ties_other, axis=1)
+            had_emotion = emotion[:, :-2].any(axis=1)
+            keep_other = hit & ~had_emotion
+            emotion[rows[keep_other], other[keep_other]] = maxval[keep_other]
+            raw[rows[hit], other[hit]] = 0.0
+            sum_part += np.where(hit, maxval, 0.0)
+            taken += keep_other
+            valid_emotion &= ~hit
+
+            active = (sum_part < 0.75*sum_list) & (taken < 3) & valid_emotion
+        unknown = (sequential_sum(emotion) <= 0.5*sum_list) | (taken > 3)
+    elif mode == 'multi_target':
+        threshold = 0.3
+        emotion = np.where(raw >= threshold*sum_list[:, None], raw, 0.0)
+        unknown = sequential_sum(emotion) <= 0.5*sum_list
+    else:
+        raise ValueError("Unknown training mode: %s" % mode)
+
+    emotion[unknown] = emotion_unknown
+    return emotion / sequential_sum(emotion)[:, None]
+
+def process_targets(targets, mode, rng=np.random):
+    '''
+    Per-batch targets from an N x emotion_count array of label distributions (https://arxiv.org/abs/1608.01041):
+
+    Majority or crossentropy: the distributions as they are.
+    Probability: one emotion per sample, drawn from its distribution. Draws the same random numbers
+    as one np.random.choice per sample, so results match the former per-sample loop for a given seed.
+    Multi-target: every emotion with votes, equally weighted (plus a small epsilon).
+    '''
+    if mode == 'majority' or mode == 'crossentropy': 
+        return targets
+    elif mode == 'probability': 
+        targets = np.asarray(targets, dtype=np.float64)
+        cdf = (targets / targets.sum(axis=1, keepdims=True)).cumsum(axis=1)
+        cdf /= cdf[:, -1:]
+        idx = (cdf <= rng.random_sample(len(targets))[:, None]).sum(axis=1)
+        new_target = np.zeros_like(targets)
+        new_target[np.arange(len(targets)), idx] = 1.0
+        return new_target
+    elif mode == 'multi_target': 
+        new_target = (np.asarray(targets) > 0).astype(np.float64)
+        epsilon = 0.001     # add small epsilon in order to avoid ill-conditioned computation
+        return (1-epsilon)*new_target + epsilon*np.ones_like(new_target)
+
+def shared_tensor(array, dtype):
+    '''
+    Copy a (possibly read-only, memory-mapped) array into a new tensor in shared memory.
+    '''
+    tensor = torch.empty(array.shape, dtype=dtype).share_memory_()
+    tensor.numpy()[...] = array
+    return tensor
 
 # Converting the loaded data into pytorch dataset
 class FERPlusDataset(Dataset):
+    '''
+    The reader's arrays as tensors in shared memory: one contiguous uint8 pixel buffer plus the label
+    and rect arrays. DataLoader workers attach to the same pages instead of copying them, whether
+    they are forked (no refcount writes, so copy-on-write never triggers) or spawned (tensors are
+    pickled as shared-memory handles).
+    '''
     def __init__(self, reader, transform=None):
         self.reader = reader
         self.transform = transform
+        self.images = shared_tensor(reader.images, torch.uint8)
+        self.labels = shared_tensor(reader.labels, torch.float32)
+        self.rects = shared_tensor(reader.rects, torch.int32)
+
+    def __getstate__(self):
+        # Workers only need the shared tensors; pickling the reader would copy its memory-mapped arrays
+        state = self.__dict__.copy()
+        state['reader'] = None
+        return state
 
     def __len__(self):
-        return len(self.reader.data)
+        return len(self.labels)
 
     def __getitem__(self, idx):
-        image_path, image_data, emotion, face_rc = self.reader.data[idx]
-        image = np.array(image_data)
+        image = self.images[idx].numpy().copy()
+        emotion = self.labels[idx].clone()
 
         if self.transform:
             image = self.transform(image)
 
-        return {'image': image, 'emotion': torch.tensor(emotion, dtype=torch.float32)}
\ No newline at end of file
+        return {'image': image, 'emotion': emotion}
+
+class FERPlusSamples(object):
+    '''
+    Read-only sequence of (image_path, image, emotion, face_rc) tuples over a reader's arrays,
+    the layout FERPlusReader.data had before the arrays were introduced.
+    '''
+    def __init__(self, reader):
+        self.reader = reader
+
+    def __len__(self):
+        return self.reader.size()
+
+    def __getitem__(self, idx):
+        reader = self.reader
+        return (str(reader.paths[idx]), reader.images[idx], reader.labels[idx].tolist(), RectArray(reader.rects)[idx])
@@ -3,11 +3,14 @@
 # Licensed under the MIT license. See LICENSE.md file in the project root for full license information.
 #
 
+import functools
 import numpy as np
 import random as rnd
 from PIL import Image
+import torch
+import torch.nn.functional as F
 from scipy import ndimage
-from rect_util import Rect
+from rect_util import Rect, RectArray
 
 def compute_norm_mat(base_width, base_height): 
     # normalization matrix used in image pre-processing 
@@ -40,6 +43,49 @@ def preproc_img(img, A, A_pinv):
         diff = diff/std
     return diff.reshape(img.shape)
 
+@functools.lru_cache(maxsize=None)
+def plane_moments(width, height):
+    '''
+    Centered pixel coordinates of a width x height grid and their sums of squares over the grid.
+    On a full grid the centered X and Y are orthogonal to each other and to the constant, so the
+    least-squares plane of compute_norm_mat separates into three independent projections.
+    '''
+    xc = np.arange(width) - (width - 1)/2.0
+    yc = np.arange(height) - (height - 1)/2.0
+    return xc, yc, height*np.dot(xc, xc), width*np.dot(yc, yc)
+
+def preproc_batch(images, dtype=np.float32):
+    '''
+    preproc_img for an N x H x W uint8 batch: per-image histogram equalization, then removal of
+    the best-fit plane a + b*x + c*y for the whole batch from the closed-form projections of
+    plane_moments instead of the (H*W) x 3 pseudo-inverse, and scaling to unit standard deviation.
+    Works in place on a single output array.
+    '''
+    images = np.asarray(images)
+    count, height, width = images.shape
+    out = np.empty((count, height, width), dtype=dtype)
+
+    # histogram equalization, a 256-entry lookup table per image
+    for image, image_eq in zip(images, out):
+        cdf = np.bincount(image.ravel(), minlength=256).cumsum()
+        lut = (cdf*(2.0/cdf[-1]) - 1.0).astype(dtype)
+        np.take(lut, image, out=image_eq)
+
+    # plane removal: the mean and the projections on the centered x and y coordinates
+    xc, yc, sxx, syy = plane_moments(width, height)
+    xc, yc = xc.astype(dtype), yc.astype(dtype)
+    col_sums = out.sum(axis=1)
+    mean = col_sums.sum(axis=1)/(height*width)
+    slope_x = col_sums @ xc/sxx
+    slope_y = out.sum(axis=2) @ yc/syy
+    out -= (mean[:, None] + slope_x[:, None]*xc)[:, None, :]
+    out -= (slope_y[:, None]*yc)[:, :, None]
+
+    # after plane fitting, the mean of diff is already 0
+    std = np.sqrt(np.einsum('nij,nij->n', out, out)/(height*width))
+    out /= np.where(std > 1e-6, std, 1.0).astype(dtype)[:, None, None]
+    return out
+
 def distort_img(img, roi, out_width, out_height, max_shift, max_scale, max_angle, max_skew, flip=True): 
     shift_y = out_height*max_shift*rnd.uniform(-1.0,1.0)
     shift_x = out_width*max_shift*rnd.uniform(-1.0,1.0)
@@ -88,3 +134,96 @@ def crop_img(img, roi, crop_width, crop_height, shift_x, shift_y, scale_x, scale
                                                   mode = 'reflect', 
                                                   prefilter = False)
     return T_im
+
+def distort_params(count, out_width, out_height, max_shift, max_scale, max_angle, max_skew, flip=True, rng=np.random):
+    '''
+    Random augmentation parameters for `count` images, drawn from the same ranges as distort_img.
+    Returns a dict of arrays: shift_x, shift_y, scale_x, scale_y, angle, skew_x, skew_y and flip.
+    '''
+    def scale():
+        s = rng.uniform(1.0, max_scale, count)
+        return np.where(rng.uniform(0.0, 1.0, count) < 0.5, 1.0/s, s)
+
+    return {
+        'shift_x': out_width*max_shift*rng.uniform(-1.0, 1.0, count),
+        'shift_y': out_height*max_shift*rng.uniform(-1.0, 1.0, count),
+        'angle':   max_angle*rng.uniform(-1.0, 1.0, count),
+        'skew_x':  max_skew*rng.uniform(-1.0, 1.0, count),
+        'skew_y':  max_skew*rng.uniform(-1.0, 1.0, count),
+        'scale_x': scale(),
+        'scale_y': scale(),
+        'flip':    (rng.uniform(0.0, 1.0, count) < 0.5) if flip else np.zeros(count, dtype=bool),
+    }
+
+def crop_matrices(rois, crop_width, crop_height, params):
+    '''
+    The affine maps of crop_img (plus the horizontal flip of distort_img) for a batch: rois is a
+    RectArray or an N x 4 array of (left, top, right, bottom). Returns (matrix N x 2 x 2, offset N x 2) in
+    ndimage.affine_transform's (row, col) convention: input = matrix . output + offset.
+    '''
+    if not isinstance(rois, RectArray):
+        rois = RectArray(rois)
+    count = len(rois)
+    ctr_in = rois.centers()[:, ::-1]
+    ctr_out = np.stack([crop_height/2.0 + params['shift_y'], crop_width/2.0 + params['shift_x']], axis=1)
+    s_y = params['scale_y']*(rois.heights() - 1)/(crop_height - 1)
+    s_x = params['scale_x']*(rois.widths() - 1)/(crop_width - 1)
+
+    # rotation, skew and scale, composed in the same order as crop_img
+    ang = params['angle']*np.pi/180.0
+    rotation = np.stack([np.stack([np.cos(ang), -np.sin(ang)], axis=1), np.stack([np.sin(ang), np.cos(ang)], axis=1)], axis=1)
+    skew_y = np.tile(np.eye(2), (count, 1, 1))
+    skew_y[:, 0, 1] = params['skew_y']
+    skew_x = np.tile(np.eye(2), (count, 1, 1))
+    skew_x[:, 1, 0] = params['skew_x']
+    scale = np.zeros((count, 2, 2))
+    scale[:, 0, 0] = s_y
+    scale[:, 1, 1] = s_x
+    transform = rotation @ skew_y @ skew_x @ scale
+
+    matrix = transform.transpose(0, 2, 1)
+    offset = ctr_in - np.einsum('ni,nij->nj', ctr_out, transform)
+
+    # a flipped output column c reads what column (crop_width - 1 - c) would have read
+    flip = params['flip']
+    offset[flip] += matrix[flip][:, :, 1]*(crop_width - 1)
+    matrix[flip, :, 1] *= -1.0
+    return matrix, offset
+
+def warp_batch(images, matrix, offset, out_width, out_height):
+    '''
+    Apply per-image affine maps (as returned by crop_matrices) to an N x H x W batch in one
+    grid_sample call: bilinear, with half-sample reflection at the borders like ndimage's 'reflect'.
+    Returns a float32 N x out_height x out_width tensor.
+    '''
+    images = torch.as_tensor(np.asarray(images), dtype=torch.float32)
+    count, height, width = images.shape
+
+    # (row, col) -> (x, y) order, then pixel -> normalized coordinates (align_corners=False):
+    # p = n*size/2 + (size - 1)/2
+    matrix = torch.as_tensor(matrix, dtype=torch.float64).flip(1).flip(2)
+    offset = torch.as_tensor(offset, dtype=torch.float64).flip(1)
+    out_scale = torch.tensor([out_width/2.0, out_height/2.0], dtype=torch.float64)
+    out_center = torch.tensor([(out_width - 1)/2.0, (out_height - 1)/2.0], dtype=torch.float64)
+    in_scale = torch.tensor([width/2.0, height/2.0], dtype=torch.float64)
+    in_center = torch.tensor([(width - 1)/2.0, (height - 1)/2.0], dtype=torch.float64)
+
+    theta = torch.empty(count, 2, 3, dtype=torch.float64)
+    theta[:, :, :2] = matrix*out_scale.view(1, 1, 2)/in_scale.view(1, 2, 1)
+    theta[:, :, 2] = (torch.einsum('nij,j->ni', matrix, out_center) + offset - in_center)/in_scale
+
+    grid = F.affine_grid(theta.float(), (count, 1, out_height, out_width), align_corners=False)
+    return F.grid_sample(images.unsqueeze(1), grid, mode='bilinear', padding_mode='reflection',
+                         align_corners=False).squeeze(1)
+
+def distort_batch(images, rois, out_width, out_height, max_shift, max_scale, max_angle, max_skew, flip=True, rng=np.random):
+    '''
+    Batched distort_img: draw parameters for every image, then warp the whole batch at once.
+    The result is rounded back to uint8 like ndimage's output for uint8 input.
+    '''
+    if len(rois) == 0:
+        return np.empty((0, out_height, out_width), dtype=np.uint8)
+    params = distort_params(len(rois), out_width, out_height, max_shift, max_scale, max_angle, max_skew, flip, rng)
+    matrix, offset = crop_matrices(rois, out_width, out_height, params)
+    warped = warp_batch(images, matrix, offset, out_width, out_height)
+    return warped.round_().clamp_(0, 255).to(torch.uint8).numpy()
@@ -6,6 +6,7 @@ import cv2
 from fastapi import FastAPI, UploadFile, File
 from torchvision import models, transforms
 from PIL import Image
+import model_util
 
 # -------------------- Config & Globals -------------------- #
 
@@ -27,7 +28,7 @@ TRANSFORM = transforms.Compose([
 def load_model():
     model = models.resnet18(weights=None)
     model.fc = torch.nn.Linear(model.fc.in_features, len(EMOTIONS))
-    model.load_state_dict(torch.load(MODEL_PATH, map_location=DEVICE, weights_only=True))
+    model_util.load_weights(model, MODEL_PATH, DEVICE)
     model.to(DEVICE)
     model.eval()
     return model
@@ -0,0 +1,519 @@
+import os
+import time
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torchvision import models, transforms
+from torch.fx.experimental.optimization import fuse as fx_fuse
+
+EMOTION_COUNT = 8
+IMAGENET_MEAN = [0.485, 0.456, 0.406]
+IMAGENET_STD = [0.229, 0.224, 0.225]
+
+# -------------------- Models -------------------- #
+
+# Below this input size the training scripts use a small stem (see resnet_small_stem)
+SMALL_STEM_MAX_SIZE = 96
+
+def create_resnet18(num_classes=EMOTION_COUNT, in_channels=3, small_stem=False):
+    '''
+    ResNet-18 with the classification head replaced for FERPlus, as trained by resnet_model_train.py.
+    With in_channels=1 the first convolution takes the grayscale face directly, and small_stem
+    builds the low-resolution variant.
+    '''
+    model = models.resnet18(weights=None)
+    if in_channels != 3:
+        model.conv1 = nn.Conv2d(in_channels, 64, kernel_size=7, stride=2, padding=3, bias=False)
+    if small_stem:
+        resnet_small_stem(model)
+    model.fc = nn.Linear(model.fc.in_features, num_classes)
+    return model
+
+def create_efficientnet_b0(num_classes=EMOTION_COUNT, in_channels=3):
+    '''
+    EfficientNet-B0 with the classifier replaced for FERPlus, as trained by EfficientNet_model_train.py.
+    '''
+    model = models.efficientnet_b0(weights=None)
+    if in_channels != 3:
+        stem = model.features[0][0]
+        model.features[0][0] = nn.Conv2d(in_channels, stem.out_channels, stem.kernel_size, stem.stride,
+                                         stem.padding, bias=False)
+    model.classifier[1] = nn.Linear(model.classifier[1].in_features, num_classes)
+    return model
+
+def conv_bn(in_channels, out_channels, kernel_size=3, stride=1, groups=1):
+    return nn.Sequential(
+        nn.Conv2d(in_channels, out_channels, kernel_size, stride, kernel_size // 2, groups=groups, bias=False),
+        nn.BatchNorm2d(out_channels),
+        nn.ReLU(inplace=True),
+    )
+
+def separable(in_channels, out_channels, stride=1):
+    '''
+    Depthwise 3x3 followed by a pointwise 1x1 convolution, each with BatchNorm and ReLU.
+    '''
+    return nn.Sequential(
+        conv_bn(in_channels, in_channels, 3, stride, groups=in_channels),
+        conv_bn(in_channels, out_channels, 1),
+    )
+
+class CompactCNN(nn.Module):
+    '''
+    Small CNN for 48-64px grayscale faces, trained as a distillation student by distill_model.py.
+    A full-resolution 3x3 stem followed by three stages of depthwise-separable blocks, each
+    halving the resolution.
+    '''
+    def __init__(self, num_classes=EMOTION_COUNT, in_channels=1, widths=(32, 64, 128, 256)):
+        super().__init__()
+        layers = [conv_bn(in_channels, widths[0])]
+        for width_in, width_out in zip(widths[:-1], widths[1:]):
+            layers += [separable(width_in, width_out, stride=2), separable(width_out, width_out)]
+        self.features = nn.Sequential(*layers)
+        self.pool = nn.AdaptiveAvgPool2d(1)
+        self.dropout = nn.Dropout(0.2)
+        self.classifier = nn.Linear(widths[-1], num_classes)
+
+    def forward(self, x):
+        x = self.pool(self.features(x)).flatten(1)
+        return self.classifier(self.dropout(x))
+
+STUDENT_ARCHS = ["compact", "mobilenet_v3_small"]
+
+def create_student(arch="compact", num_classes=EMOTION_COUNT, in_channels=1):
+    '''
+    Student models for distill_model.py. Both are meant for the low-resolution input of small-stem
+    teachers, so MobileNetV3-small runs its stem at stride 1 (16x total downsampling instead of 32).
+    '''
+    if arch == "compact":
+        return CompactCNN(num_classes, in_channels)
+    if arch == "mobilenet_v3_small":
+        model = models.mobilenet_v3_small(weights=None, num_classes=num_classes)
+        stem = model.features[0][0]
+        model.features[0][0] = nn.Conv2d(in_channels, stem.out_channels, 3, stride=1, padding=1, bias=False)
+        return model
+    raise ValueError(f"Unknown student architecture: {arch}")
+
+def checkpoint_arch(state):
+    '''
+    Architecture of a saved state dict, told apart by its parameter names.
+    '''
+    if "conv1.weight" in state:
+        return "resnet18"
+    if "classifier.3.weight" in state:
+        return "mobilenet_v3_small"
+    if "classifier.1.weight" in state:
+        return "efficientnet_b0"
+    return "compact"
+
+# Saved state dicts carry the build settings the weights do not show under this key (see model_config)
+CONFIG_KEY = "_config"
+
+def model_config(model, input_size=None):
+    '''
+    Settings load_checkpoint needs to rebuild `model`: architecture, input channels, whether it has
+    the small stem (an EfficientNet's stride-1 stem looks like the standard one in the weights) and,
+    if given, the input size it was trained at.
+    '''
+    arch = checkpoint_arch(dict(model.named_parameters()))
+    if arch == "resnet18":
+        small_stem = isinstance(model.maxpool, nn.Identity)
+    elif arch == "efficientnet_b0":
+        small_stem = tuple(model.features[0][0].stride) == (1, 1)
+    else:
+        small_stem = False
+    return {"arch": arch, "in_channels": input_channels(model), "small_stem": small_stem, "input_size": input_size}
+
+def checkpoint_state(model, input_size=None):
+    '''
+    The state dict to save for `model`: its weights plus model_config under CONFIG_KEY.
+    '''
+    state = model.state_dict()
+    state[CONFIG_KEY] = model_config(model, input_size)
+    return state
+
+def checkpoint_config(state):
+    '''
+    The model_config of a saved state dict (or of the file at that path). Checkpoints from before
+    the config was saved get one derived from their weights, with input_size None.
+    '''
+    if isinstance(state, str):
+        state = torch.load(state, map_location="cpu", weights_only=True)
+    if CONFIG_KEY in state:
+        return dict(state[CONFIG_KEY])
+    arch = checkpoint_arch(state)
+    first = next((tensor for name, tensor in state.items() if name.endswith("weight") and tensor.dim() == 4), None)
+    return {"arch": arch, "in_channels": first.shape[1] if first is not None else 3,
+            "small_stem": arch == "resnet18" and first.shape[-1] == 3, "input_size": None}
+
+def checkpoint_input_size(path, input_size=None):
+    '''
+    `input_size` if given, else the input size recorded in the checkpoint at `path`, else 224.
+    '''
+    return input_size or checkpoint_config(path)["input_size"] or 224
+
+def load_weights(model, path, device="cpu"):
+    '''
+    Load a saved state dict into an existing model of the same build.
+    '''
+    state = torch.load(path, map_location=device, weights_only=True)
+    state.pop(CONFIG_KEY, None)
+    restore_folded(model, state)
+    model.load_state_dict(state)
+    return model
+
+def load_checkpoint(path, device="cpu"):
+    '''
+    Build the model matching a state dict saved by the training scripts (or distill_model.py) and
+    load it. Returns it in eval mode.
+    '''
+    state = torch.load(path, map_location=device, weights_only=True)
+    config = checkpoint_config(state)
+    state.pop(CONFIG_KEY, None)
+    arch = config["arch"]
+    if arch == "resnet18":
+        model = create_resnet18(in_channels=config["in_channels"], small_stem=config["small_stem"])
+        # Pruned checkpoints (prune_model.py) have narrower blocks
+        for name, block in resnet_blocks(model):
+            width = state[f"{name}.conv1.weight"].shape[0]
+            if width != block.conv1.out_channels:
+                prune_block(block, torch.arange(width))
+    elif arch == "efficientnet_b0":
+        model = create_efficientnet_b0(in_channels=config["in_channels"])
+        if config["small_stem"]:
+            efficientnet_small_stem(model)
+    else:
+        model = create_student(arch, in_channels=config["in_channels"])
+    # exactly folded single-channel models (convert_single_channel.py)
+    restore_folded(model, state)
+    model.load_state_dict(state)
+    model.to(device)
+    model.eval()
+    return model
+
+def input_channels(model):
+    '''
+    Number of channels the model expects, read from its first convolution.
+    '''
+    for module in model.modules():
+        if isinstance(module, nn.Conv2d):
+            return module.in_channels
+    return 3
+
+def checkpoint_input_channels(path):
+    '''
+    Number of input channels of a saved state dict, without building the model.
+    '''
+    return checkpoint_config(path)["in_channels"]
+
+class FoldedConv2d(nn.Conv2d):
+    '''
+    A Conv2d plus a fixed per-position map, the `border` correction of fold_to_single_channel for
+    one input size. Inputs of any other size fail to broadcast against it.
+    '''
+    def __init__(self, *args, border_size=(1, 1), **kwargs):
+        super().__init__(*args, **kwargs)
+        self.register_buffer("border", torch.zeros(self.out_channels, *border_size))
+
+    def forward(self, x):
+        return super().forward(x) + self.border
+
+def fold_to_single_channel(conv, bn, mean=IMAGENET_MEAN, std=IMAGENET_STD, input_size=None):
+    '''
+    Replace a conv that reads 3 identical, per-channel normalized grayscale copies by one that reads
+    the raw grayscale image in [0, 1] (plain ToTensor, no Normalize).
+
+    Since (g - m_c) / s_c is linear in g, the new kernel is sum_c W_c / s_c and the constant
+    sum_c (m_c / s_c) * sum(W_c) moves into the bias or the following BatchNorm's running mean.
+    That constant is only right away from the border: where the kernel overlaps the zero padding,
+    the 3-channel model saw normalized zeros and so received less of it. Without `input_size` the
+    fold is approximate there, which is fine as a starting point for training. With it, the result
+    is a FoldedConv2d whose border map adds the excess back for input_size x input_size inputs,
+    and outputs match the 3-channel model up to float rounding.
+    '''
+    weight = conv.weight.detach()
+    scale = torch.tensor([1.0 / s for s in std], dtype=weight.dtype).view(1, -1, 1, 1)
+    shift = torch.tensor([m / s for m, s in zip(mean, std)], dtype=weight.dtype).view(1, -1, 1, 1)
+    shift_weight = (weight * shift).sum(dim=1, keepdim=True)
+    offset = shift_weight.sum(dim=(1, 2, 3))
+
+    geometry = (1, conv.out_channels, conv.kernel_size, conv.stride, conv.padding, conv.dilation, conv.groups)
+    if input_size is None:
+        folded = nn.Conv2d(*geometry, bias=conv.bias is not None)
+    else:
+        # offset each output position actually received: the shift kernel over the taps that hit the image
+        received = F.conv2d(torch.ones(1, 1, input_size, input_size, dtype=weight.dtype), shift_weight,
+                            None, conv.stride, conv.padding, conv.dilation, conv.groups)[0]
+        folded = FoldedConv2d(*geometry, bias=conv.bias is not None, border_size=received.shape[1:])
+        folded.border.copy_(offset.view(-1, 1, 1) - received)
+    with torch.no_grad():
+        folded.weight.copy_((weight * scale).sum(dim=1, keepdim=True))
+        if conv.bias is not None:
+            folded.bias.copy_(conv.bias - offset)
+        else:
+            bn.running_mean.add_(offset)
+    folded.weight.requires_grad = conv.weight.requires_grad
+    return folded
+
+def restore_folded(model, state):
+    '''
+    Swap in a FoldedConv2d for every convolution that has a border map in `state`, so it loads.
+    '''
+    for name, module in list(model.named_modules()):
+        if isinstance(module, nn.Conv2d) and f"{name}.border" in state:
+            folded = FoldedConv2d(module.in_channels, module.out_channels, module.kernel_size, module.stride,
+                                  module.padding, module.dilation, module.groups, bias=module.bias is not None,
+                                  border_size=state[f"{name}.border"].shape[1:])
+            parent, _, attr = name.rpartition(".")
+            setattr(model.get_submodule(parent), attr, folded)
+    return model
+
+def resnet_to_single_channel(model, input_size=None):
+    model.conv1 = fold_to_single_channel(model.conv1, model.bn1, input_size=input_size)
+    return model
+
+def efficientnet_to_single_channel(model, input_size=None):
+    stem = model.features[0]
+    stem[0] = fold_to_single_channel(stem[0], stem[1], input_size=input_size)
+    return model
+
+def use_small_stem(input_size):
+    return input_size <= SMALL_STEM_MAX_SIZE
+
+def resnet_small_stem(model, trainable=True):
+    '''
+    Adapt ResNet-18 to native FER2013 resolution (48-96px). The 7x7 stride-2 conv1 followed by a
+    max-pool divides the input by 4 before the first residual block, leaving a 48px face with a
+    2x2 map at layer4. Here conv1 becomes 3x3 stride 2 and the max-pool is dropped, so the stem
+    divides by 2 only. The new conv1 starts from the centre of the old kernel and is trainable
+    unless trainable=False (keeping it frozen lets feature_cache.py cache the layers after it).
+    '''
+    old = model.conv1
+    model.conv1 = nn.Conv2d(old.in_channels, old.out_channels, kernel_size=3, stride=2, padding=1, bias=False)
+    with torch.no_grad():
+        model.conv1.weight.copy_(old.weight[:, :, 2:5, 2:5])
+    model.maxpool = nn.Identity()
+    for param in [*model.conv1.parameters(), *model.bn1.parameters()]:
+        param.requires_grad = trainable
+    return model
+
+def resnet_blocks(model):
+    '''
+    (name, BasicBlock) pairs of a ResNet-18, e.g. ("layer2.1", block).
+    '''
+    return [(f"layer{i}.{j}", block) for i in range(1, 5) for j, block in enumerate(getattr(model, f"layer{i}"))]
+
+def channel_importance(block):
+    '''
+    Importance of each inner channel of a BasicBlock: the L1 norm of its conv1 filter scaled by
+    bn1's |gamma| / sqrt(var + eps), i.e. the norm of the filter once BatchNorm is folded into it.
+    '''
+    filter_norm = block.conv1.weight.detach().abs().sum(dim=(1, 2, 3))
+    bn_scale = block.bn1.weight.detach().abs() / torch.sqrt(block.bn1.running_var + block.bn1.eps)
+    return filter_norm * bn_scale
+
+def prune_block(block, keep):
+    '''
+    Physically remove inner channels of a BasicBlock: conv1's output channels, bn1 and conv2's
+    input channels, keeping the indices in `keep`. The block's input and output widths (and so
+    the residual connection) do not change.
+    '''
+    keep = keep.sort().values
+    conv1, bn1, conv2 = block.conv1, block.bn1, block.conv2
+
+    new_conv1 = nn.Conv2d(conv1.in_channels, len(keep), conv1.kernel_size, conv1.stride, conv1.padding, bias=False)
+    new_bn1 = nn.BatchNorm2d(len(keep), eps=bn1.eps, momentum=bn1.momentum)
+    new_conv2 = nn.Conv2d(len(keep), conv2.out_channels, conv2.kernel_size, conv2.stride, conv2.padding, bias=False)
+    with torch.no_grad():
+        new_conv1.weight.copy_(conv1.weight[keep])
+        for name in ("weight", "bias", "running_mean", "running_var"):
+            getattr(new_bn1, name).copy_(getattr(bn1, name)[keep])
+        new_conv2.weight.copy_(conv2.weight[:, keep])
+
+    block.conv1, block.bn1, block.conv2 = new_conv1, new_bn1, new_conv2
+    return block
+
+def prune_resnet(model, ratio, multiple=8):
+    '''
+    Remove the `ratio` least important inner channels of every BasicBlock (see channel_importance).
+    Widths are rounded up to a multiple of `multiple`, which CPU convolution kernels handle best.
+    '''
+    for _, block in resnet_blocks(model):
+        width = block.conv1.out_channels
+        keep = min(width, max(multiple, int(np.ceil(width * (1 - ratio) / multiple)) * multiple))
+        if keep < width:
+            prune_block(block, channel_importance(block).topk(keep).indices)
+    return model
+
+def efficientnet_small_stem(model, trainable=True):
+    '''
+    Same idea for EfficientNet-B0: the stem convolution runs at stride 1, so the network divides
+    the input by 16 instead of 32. The stem keeps its pretrained weights and is made trainable
+    unless trainable=False.
+    '''
+    stem = model.features[0]
+    stem[0].stride = (1, 1)
+    for param in stem.parameters():
+        param.requires_grad = trainable
+    return model
+
+# -------------------- Preprocessing -------------------- #
+
+def train_transform(input_size=224, in_channels=3):
+    '''
+    Augmenting transform used by the training scripts.
+    '''
+    steps = [transforms.ToPILImage()]
+    if in_channels == 3:
+        steps.append(transforms.Grayscale(num_output_channels=3))
+    steps += [
+        transforms.Resize((input_size, input_size)),
+        transforms.RandomHorizontalFlip(p=0.2),
+        transforms.RandomRotation(10),
+        transforms.ToTensor(),
+    ]
+    if in_channels == 3:
+        steps.append(transforms.Normalize(mean=IMAGENET_MEAN, std=IMAGENET_STD))
+    return transforms.Compose(steps)
+
+def eval_transform(input_size=224, in_channels=3):
+    '''
+    The deterministic transform used for validation, testing and serving. Single-channel models
+    take the grayscale face in [0, 1] without normalization (see fold_to_single_channel).
+    '''
+    steps = [transforms.ToPILImage()]
+    if in_channels == 3:
+        steps.append(transforms.Grayscale(num_output_channels=3))
+    steps += [
+        transforms.Resize((input_size, input_size)),
+        transforms.ToTensor(),
+    ]
+    if in_channels == 3:
+        steps.append(transforms.Normalize(mean=IMAGENET_MEAN, std=IMAGENET_STD))
+    return transforms.Compose(steps)
+
+# -------------------- Export -------------------- #
+
+def fuse_for_inference(model):
+    '''
+    Fold every BatchNorm into the convolution in front of it. The model must be in eval mode.
+    '''
+    return fx_fuse(model.eval())
+
+def export_torchscript(model, path, input_size=224):
+    '''
+    Trace the fused model, freeze it and save it to `path`. Load it back with load_torchscript.
+    '''
+    example = torch.randn(1, input_channels(model), input_size, input_size)
+    with torch.no_grad():
+        traced = torch.jit.trace(fuse_for_inference(model).cpu(), example)
+        frozen = torch.jit.freeze(traced)
+    torch.jit.save(frozen, path)
+    return path
+
+def load_torchscript(path, device="cpu"):
+    '''
+    Load a frozen TorchScript model. CPU-specific rewrites from optimize_for_inference cannot be
+    serialized, so they are applied here after loading rather than at export time.
+    '''
+    model = torch.jit.load(path, map_location=device)
+    model.eval()
+    if torch.device(device).type == "cpu":
+        model = torch.jit.optimize_for_inference(model)
+    return model
+
+def export_onnx(model, path, input_size=224, opset=17):
+    '''
+    Export the fused model to ONNX with a dynamic batch dimension.
+    '''
+    example = torch.randn(1, input_channels(model), input_size, input_size)
+    with torch.no_grad():
+        torch.onnx.export(fuse_for_inference(model).cpu(), example, path,
+                          input_names=["input"], output_names=["logits"],
+                          dynamic_axes={"input": {0: "batch"}, "logits": {0: "batch"}},
+                          opset_version=opset, do_constant_folding=True, dynamo=False)
+    return path
+
+def optimize_onnx(path, optimized_path, num_threads=0):
+    '''
+    Run ONNX Runtime's full graph optimization once and write the result to `optimized_path`,
+    so later sessions can load it without optimizing again. The optimized graph may contain
+    CPU-specific kernels, so it should be rebuilt rather than copied to a different host.
+    '''
+    import onnxruntime as ort
+
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    options.optimized_model_filepath = optimized_path
+    if num_threads > 0:
+        options.intra_op_num_threads = num_threads
+    ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+    return optimized_path
+
+class OnnxModel:
+    '''
+    Wraps an ONNX Runtime session so it can be called like the eager model on a batch tensor.
+    '''
+    def __init__(self, path, num_threads=0, optimized=False):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        # An already optimized graph does not need to go through the optimizer again
+        options.graph_optimization_level = (ort.GraphOptimizationLevel.ORT_DISABLE_ALL if optimized
+                                            else ort.GraphOptimizationLevel.ORT_ENABLE_ALL)
+        if num_threads > 0:
+            options.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def __call__(self, batch):
+        outputs = self.session.run(None, {self.input_name: batch.detach().cpu().numpy().astype(np.float32)})
+        return torch.from_numpy(outputs[0])
+
+def is_stale(artifact_path, source_path):
+    '''
+    True if the derived artifact is missing or older than the checkpoint it was built from.
+    '''
+    return (not os.path.exists(artifact_path)
+            or os.path.getmtime(artifact_path) < os.path.getmtime(source_path))
+
+# -------------------- Measurement -------------------- #
+
+def count_macs(model, input_size=224, in_channels=3):
+    '''
+    Multiply-accumulates of one forward pass on a single image, counted over Conv2d and Linear layers.
+    '''
+    total = [0]
+
+    def hook(module, inputs, output):
+        if isinstance(module, nn.Conv2d):
+            kernel = module.kernel_size[0] * module.kernel_size[1] * module.in_channels // module.groups
+            total[0] += output[0].numel() * kernel
+        else:
+            total[0] += module.in_features * module.out_features
+
+    handles = [m.register_forward_hook(hook) for m in model.modules() if isinstance(m, (nn.Conv2d, nn.Linear))]
+    was_training = model.training
+    model.eval()
+    with torch.no_grad():
+        model(torch.zeros(1, in_channels, input_size, input_size))
+    model.train(was_training)
+    for handle in handles:
+        handle.remove()
+    return total[0]
+
+def measure_latency(model, batch_size=1, input_size=224, in_channels=3, warmup=5, runs=30):
+    '''
+    Median and p95 wall time in milliseconds of one forward pass on CPU.
+    '''
+    batch = torch.randn(batch_size, in_channels, input_size, input_size)
+    timings = []
+    with torch.no_grad():
+        for i in range(warmup + runs):
+            start = time.perf_counter()
+            model(batch)
+            if i >= warmup:
+                timings.append(1000.0 * (time.perf_counter() - start))
+    return {"batch_size": batch_size,
+            "median_ms": float(np.median(timings)),
+            "p95_ms": float(np.percentile(timings, 95))}
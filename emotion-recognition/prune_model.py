@@ -0,0 +1,122 @@
+import os
+import copy
+import argparse
+import torch
+import torch.nn as nn
+import torch.optim as optim
+from resnet_parameters import Parameters
+from torch.utils.data import DataLoader
+from ferplus import FERPlusReader, FERPlusDataset
+from torch.optim.lr_scheduler import StepLR
+from resnet_model_train import train_model, validate_model
+import model_util
+
+# Structured channel pruning of the trained ResNet-18, followed by fine-tuning.
+#
+#   python prune_model.py --ratios 0.25,0.5,0.75        # one pruned model per sparsity level
+#   python prune_model.py --target-macs 0.5             # prune until half of the MACs are left
+#   python prune_model.py --target-latency 20           # prune until batch 1 CPU latency is under 20 ms
+#
+# Pruned channels are removed from the weights, so each result is a smaller dense ResNet-18
+# saved as <checkpoint>_pruned<percent>.pth; model_util.load_checkpoint rebuilds it from the shapes.
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Prune and fine-tune the FERPlus ResNet-18.")
+    parser.add_argument("--checkpoint", default="best_model.pth")
+    parser.add_argument("--output-dir", default=".")
+    parser.add_argument("--ratios", default="0.25,0.5,0.75", help="comma separated fractions of inner channels to remove")
+    parser.add_argument("--target-macs", type=float, default=None, help="fraction of the original MACs to keep")
+    parser.add_argument("--target-latency", type=float, default=None, help="batch 1 CPU latency budget in ms")
+    parser.add_argument("--finetune-epochs", type=int, default=5)
+    parser.add_argument("--lr", type=float, default=1e-4)
+    parser.add_argument("--input-size", type=int, default=None,
+                        help="resolution the checkpoint was trained at, if it does not record it (224 otherwise)")
+    parser.add_argument("--base-folder", default="Datasets/FERPlus-master/data")
+    parser.add_argument("--batch-size", type=int, default=64)
+    return parser.parse_args()
+
+def ratio_for_budget(model, budget, measure, steps=10):
+    '''
+    Smallest pruning ratio whose pruned model measures at or under `budget`, by bisection.
+    '''
+    low, high = 0.0, 0.95
+    for _ in range(steps):
+        middle = (low + high) / 2
+        if measure(model_util.prune_resnet(copy.deepcopy(model), middle)) > budget:
+            low = middle
+        else:
+            high = middle
+    return high
+
+def create_loaders(args, in_channels):
+    parameters = Parameters()
+    readers = [FERPlusReader.create(args.base_folder, [sub_folder], "label.csv", parameters)
+               for sub_folder in ("FER2013Train", "FER2013Valid", "FER2013Test")]
+    train_dataset = FERPlusDataset(readers[0], transform=model_util.train_transform(args.input_size, in_channels))
+    valid_dataset = FERPlusDataset(readers[1], transform=model_util.eval_transform(args.input_size, in_channels))
+    test_dataset = FERPlusDataset(readers[2], transform=model_util.eval_transform(args.input_size, in_channels))
+    return (DataLoader(train_dataset, batch_size=args.batch_size, shuffle=True, num_workers=4, pin_memory=True),
+            DataLoader(valid_dataset, batch_size=args.batch_size, shuffle=False, num_workers=4, pin_memory=True),
+            DataLoader(test_dataset, batch_size=args.batch_size, shuffle=False, num_workers=4, pin_memory=True))
+
+def main():
+    args = parse_args()
+    args.input_size = model_util.checkpoint_input_size(args.checkpoint, args.input_size)
+    os.makedirs(args.output_dir, exist_ok=True)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    print(f"🟡 Using Device: {device}")
+
+    original = model_util.load_checkpoint(args.checkpoint)
+    in_channels = model_util.input_channels(original)
+    size = (args.input_size, in_channels)
+
+    def macs(model):
+        return model_util.count_macs(model, *size)
+
+    def latency(model):
+        return model_util.measure_latency(model.eval(), batch_size=1, input_size=args.input_size, in_channels=in_channels)["median_ms"]
+
+    if args.target_macs is not None:
+        ratios = [ratio_for_budget(original, args.target_macs * macs(original), macs)]
+    elif args.target_latency is not None:
+        ratios = [ratio_for_budget(original, args.target_latency, latency, steps=6)]
+    else:
+        ratios = [float(r) for r in args.ratios.split(",")]
+    print(f"🟡 Pruning ratios: {', '.join(f'{r:.3f}' for r in ratios)}")
+
+    train_loader, valid_loader, test_loader = create_loaders(args, in_channels)
+    criterion = nn.CrossEntropyLoss()
+    name = os.path.splitext(os.path.basename(args.checkpoint))[0]
+    # the pruned checkpoints record the input size they are fine-tuned and served at
+    parameters = Parameters()
+    parameters.input_size, parameters.in_channels = args.input_size, in_channels
+
+    _, original_acc = validate_model(original, test_loader, criterion)
+    rows = [("original", 0.0, macs(original), original_acc, original_acc, latency(original))]
+
+    for ratio in ratios:
+        model = model_util.prune_resnet(copy.deepcopy(original), ratio)
+        _, pruned_acc = validate_model(model, test_loader, criterion)
+        print(f"🟡 Pruned {100 * ratio:.0f}% of block channels: {macs(model) / 1e9:.3f} GMACs | Test Acc before fine-tuning: {pruned_acc:.2f}%")
+
+        path = os.path.join(args.output_dir, f"{name}_pruned{round(100 * ratio)}.pth")
+        model.to(device)
+        for param in model.parameters():
+            param.requires_grad = True
+        optimizer = optim.Adam(model.parameters(), lr=args.lr, weight_decay=1e-4)
+        scheduler = StepLR(optimizer, step_size=3, gamma=0.1)
+        train_model(model, train_loader, valid_loader, test_loader, criterion, optimizer, scheduler,
+                    num_epochs=args.finetune_epochs, device=device, checkpoint_path=path, parameters=parameters)
+
+        model = model_util.load_checkpoint(path)
+        _, finetuned_acc = validate_model(model, test_loader, criterion)
+        rows.append((os.path.basename(path), ratio, macs(model), pruned_acc, finetuned_acc, latency(model)))
+
+    print(f"CPU report at {args.input_size}x{args.input_size} ({torch.get_num_threads()} threads):")
+    print(f"  {'model':<28}{'pruned':>8}{'GMACs':>8}{'acc pruned':>12}{'acc tuned':>11}{'batch 1 ms':>12}{'speedup':>9}")
+    for model_name, ratio, model_macs, pruned_acc, finetuned_acc, ms in rows:
+        print(f"  {model_name:<28}{100 * ratio:>7.0f}%{model_macs / 1e9:>8.3f}{pruned_acc:>11.2f}%{finetuned_acc:>10.2f}%"
+              f"{ms:>12.2f}{rows[0][5] / ms:>8.1f}x")
+
+if __name__ == "__main__":
+    main()
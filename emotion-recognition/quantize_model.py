@@ -0,0 +1,96 @@
+import os
+import copy
+import argparse
+import torch
+import torch.nn as nn
+from resnet_parameters import Parameters
+from torch.utils.data import DataLoader
+from ferplus import FERPlusReader, FERPlusDataset
+from torch.ao.quantization import get_default_qconfig_mapping, quantize_dynamic
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+from resnet_model_train import test_model
+import model_util
+
+# Post-training int8 quantization of best_model.pth for CPU serving.
+#
+#   python quantize_model.py                  # static, calibrated on FER2013Valid
+#   python quantize_model.py --mode dynamic   # dynamic (Linear layers only), no calibration
+#
+# The result is saved as TorchScript (best_model.int8.ts) and served with EMOTION_BACKEND=int8.
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Quantize the FERPlus emotion model to int8.")
+    parser.add_argument("--checkpoint", default="best_model.pth")
+    parser.add_argument("--output", default=None, help="defaults to <checkpoint>.int8.ts")
+    parser.add_argument("--mode", choices=["static", "dynamic"], default="static")
+    parser.add_argument("--input-size", type=int, default=None,
+                        help="resolution the checkpoint was trained at, if it does not record it (224 otherwise)")
+    parser.add_argument("--calibration-batches", type=int, default=32)
+    parser.add_argument("--engine", default="x86", help="quantized engine, e.g. x86, fbgemm or qnnpack")
+    parser.add_argument("--base-folder", default="Datasets/FERPlus-master/data")
+    parser.add_argument("--batch-size", type=int, default=64)
+    return parser.parse_args()
+
+def create_loader(base_folder, sub_folder, batch_size, input_size, in_channels, shuffle=False):
+    parameters = Parameters()
+    reader = FERPlusReader.create(base_folder, [sub_folder], "label.csv", parameters)
+    dataset = FERPlusDataset(reader, transform=model_util.eval_transform(input_size, in_channels))
+    return DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, num_workers=2)
+
+def quantize_static(model, calibration_loader, num_batches, engine, input_size=224):
+    '''
+    FX graph mode static quantization: observers are inserted, fed with validation images to
+    record activation ranges, and the model is converted to int8 kernels.
+    '''
+    torch.backends.quantized.engine = engine
+    example = torch.randn(1, model_util.input_channels(model), input_size, input_size)
+    prepared = prepare_fx(copy.deepcopy(model).eval(), get_default_qconfig_mapping(engine), (example,))
+
+    with torch.no_grad():
+        for i, batch in enumerate(calibration_loader):
+            if i >= num_batches:
+                break
+            prepared(batch['image'])
+
+    return convert_fx(prepared)
+
+def main():
+    args = parse_args()
+    args.input_size = model_util.checkpoint_input_size(args.checkpoint, args.input_size)
+    output = args.output or os.path.splitext(args.checkpoint)[0] + ".int8.ts"
+    criterion = nn.CrossEntropyLoss()
+
+    fp32 = model_util.load_checkpoint(args.checkpoint)
+    in_channels = model_util.input_channels(fp32)
+    test_loader = create_loader(args.base_folder, "FER2013Test", args.batch_size, args.input_size, in_channels)
+
+    mode = args.mode
+    quantized = None
+    if mode == "static":
+        try:
+            valid_loader = create_loader(args.base_folder, "FER2013Valid", args.batch_size, args.input_size, in_channels, shuffle=True)
+            quantized = quantize_static(fp32, valid_loader, args.calibration_batches, args.engine, args.input_size)
+        except Exception as e:
+            print(f"🟡 Static quantization failed ({e}), falling back to dynamic quantization")
+            mode = "dynamic"
+
+    if mode == "dynamic":
+        quantized = quantize_dynamic(copy.deepcopy(fp32), {nn.Linear}, dtype=torch.qint8)
+
+    example = torch.randn(1, in_channels, args.input_size, args.input_size)
+    with torch.no_grad():
+        scripted = torch.jit.freeze(torch.jit.trace(quantized, example))
+    torch.jit.save(scripted, output)
+    print(f"🟡 {mode.capitalize()} int8 model saved to {output}")
+
+    print(f"fp32 | {test_model(fp32, test_loader, criterion)}")
+    print(f"int8 | {test_model(scripted, test_loader, criterion)}")
+
+    print("CPU latency (median / p95 ms):")
+    for batch_size in (1, 16):
+        for name, model in [("fp32", fp32), ("int8", scripted)]:
+            result = model_util.measure_latency(model, batch_size=batch_size, input_size=args.input_size, in_channels=in_channels)
+            print(f"  {name} | batch {batch_size:>2} | {result['median_ms']:8.2f} / {result['p95_ms']:8.2f}")
+
+if __name__ == "__main__":
+    main()
@@ -4,8 +4,11 @@
 #
 
 import math
+import numpy as np
   
 class Point(object):
+    __slots__ = ('x', 'y')
+
     def __init__(self, x=0.0, y=0.0):
         self.x = x
         self.y = y
@@ -98,6 +101,7 @@ class Rect(object):
     v                                  |
     y increases                      bottom
     """
+    __slots__ = ('left', 'top', 'right', 'bottom')
 
     def __init__(self, box):
         """Initialize a rectangle from two points."""
@@ -219,4 +223,98 @@ class Rect(object):
     def __str__( self ):
         return "<Rect (%s,%s)-(%s,%s)>" % (self.left,self.top,
                                         self.right,self.bottom)
-     
\ No newline at end of file
+
+class RectArray(object):
+    """N rectangles as one N x 4 array of (left, top, right, bottom), the struct-of-arrays
+    counterpart of Rect. Geometry is computed for all rectangles in one call; the methods that
+    return rectangles return a new RectArray. Wrapping an array (or memmap) does not copy it.
+    """
+    __slots__ = ('boxes',)
+
+    def __init__(self, boxes):
+        self.boxes = np.asarray(boxes).reshape(-1, 4)
+
+    @classmethod
+    def from_rects(cls, rects):
+        """Build from a sequence of Rect."""
+        return cls(np.array([rect.as_tuple() for rect in rects], dtype=np.float64))
+
+    def __len__(self):
+        return len(self.boxes)
+
+    def __getitem__(self, index):
+        """A single index gives a Rect, anything else (slice, index or mask array) a RectArray."""
+        if np.ndim(index) == 0 and not isinstance(index, slice):
+            return Rect(self.boxes[index].tolist())
+        return RectArray(self.boxes[index])
+
+    @property
+    def left(self):
+        return self.boxes[:, 0]
+
+    @property
+    def top(self):
+        return self.boxes[:, 1]
+
+    @property
+    def right(self):
+        return self.boxes[:, 2]
+
+    @property
+    def bottom(self):
+        return self.boxes[:, 3]
+
+    def widths(self):
+        """Widths"""
+        return self.right - self.left
+
+    def heights(self):
+        """Heights"""
+        return self.bottom - self.top
+
+    def centers(self):
+        """Centers as an N x 2 array of (x, y)."""
+        return np.stack([(self.left + self.right)/2.0, (self.top + self.bottom)/2.0], axis=1)
+
+    def contains(self, points):
+        """True where the i-th point (N x 2 array of (x, y)) is inside the i-th rectangle."""
+        points = np.asarray(points)
+        return ((self.left <= points[:, 0]) & (points[:, 0] <= self.right) &
+                (self.top <= points[:, 1]) & (points[:, 1] <= self.bottom))
+
+    def overlaps(self, other):
+        """True where the i-th rectangles of both arrays overlap."""
+        return ((self.right > other.left) & (self.left < other.right) &
+                (self.top < other.bottom) & (self.bottom > other.top))
+
+    def intersect(self, other):
+        """Pairwise intersections, not checked for validity (see Rect.intersect)."""
+        return RectArray(np.stack([np.maximum(self.left, other.left), np.maximum(self.top, other.top),
+                                   np.minimum(self.right, other.right), np.minimum(self.bottom, other.bottom)], axis=1))
+
+    def clamp(self, xmin, ymin, xmax, ymax):
+        """Rectangles clamped to the given bounds, not checked for validity (see Rect.clamp)."""
+        return RectArray(np.stack([np.maximum(self.left, xmin), np.maximum(self.top, ymin),
+                                   np.minimum(self.right, xmax), np.minimum(self.bottom, ymax)], axis=1))
+
+    def mult(self, xmul, ymul):
+        """Rectangles with all coordinates multiplied by a number."""
+        return RectArray(self.boxes * np.array([xmul, ymul, xmul, ymul]))
+
+    def scale(self, scale):
+        """Scaled rectangles with identical centers; scale is a number or one per rectangle."""
+        return self.cocenter(self.widths()*scale, self.heights()*scale)
+
+    def cocenter(self, new_width, new_height):
+        """Rectangles of the given size (numbers or one per rectangle) with identical centers."""
+        centers = self.centers()
+        xstart = centers[:, 0] - np.asarray(new_width)/2.0
+        ystart = centers[:, 1] - np.asarray(new_height)/2.0
+        return RectArray(np.stack([xstart, ystart, xstart + new_width, ystart + new_height], axis=1))
+
+    def integerize(self):
+        """Coordinates rounded to integers."""
+        return RectArray(np.floor(self.boxes + 0.5).astype(np.int64))
+
+    def __str__(self):
+        return "<RectArray of %d>" % len(self)
@@ -1,14 +1,27 @@
 import torch
+import argparse
 import numpy as np
 import torch.nn as nn
 import torch.optim as optim
 from resnet_parameters import Parameters
-from torch.utils.data import DataLoader
 from ferplus import FERPlusReader, FERPlusDataset
-from torchvision import transforms, models
+from torchvision import models
+import model_util
+import dist_util
+from tune_loader import loader_options
 from torch.optim.lr_scheduler import StepLR
+from trainer import Trainer
 
 def main():
+    parser = argparse.ArgumentParser(description="Train on FERPlus.")
+    parser.add_argument("--resume", action="store_true",
+                        help="continue this run from its latest checkpoint in Parameters.checkpoint_folder "
+                             "instead of training from scratch")
+    parser.add_argument("--test-only", action="store_true", help="skip training and test the saved best_model.pth")
+    args = parser.parse_args()
+
+    # One process per torchrun worker, sharing the training set (see dist_util.py); a no-op otherwise
+    dist_util.init()
         
     # Assigning processor
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
@@ -19,30 +32,18 @@ def main():
     label_file_name = "label.csv"
     parameters = Parameters()
 
-    train_reader = FERPlusReader.create(base_folder, ["FER2013Train"], label_file_name, parameters)
-    valid_reader = FERPlusReader.create(base_folder, ["FER2013Valid"], label_file_name, parameters)
-    test_reader = FERPlusReader.create(base_folder, ["FER2013Test"], label_file_name, parameters)
+    # rank 0 compiles the image cache, the other processes then load it
+    with dist_util.main_first():
+        train_reader = FERPlusReader.create(base_folder, ["FER2013Train"], label_file_name, parameters)
+        valid_reader = FERPlusReader.create(base_folder, ["FER2013Valid"], label_file_name, parameters)
+        test_reader = FERPlusReader.create(base_folder, ["FER2013Test"], label_file_name, parameters)
 
     print(f"🟡 Loaded {train_reader.size(), valid_reader.size(), test_reader.size()} images for training.")
 
-    # Define transformations (ResNet-18 expects 224x224 images normalized)
-    train_transform = transforms.Compose([
-        transforms.ToPILImage(),  
-        transforms.Grayscale(num_output_channels=3),
-        transforms.Resize((224, 224)), 
-        transforms.RandomHorizontalFlip(p=0.2), 
-        transforms.RandomRotation(10),  
-        transforms.ToTensor(),  
-        transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
-    ])
-
-    eval_transform = transforms.Compose([
-        transforms.ToPILImage(),  
-        transforms.Grayscale(num_output_channels=3),
-        transforms.Resize((224, 224)), 
-        transforms.ToTensor(),  
-        transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
-    ])
+    # Define transformations (ResNet-18 expects 224x224 images normalized, or parameters.input_size)
+    # 3 channels: grayscale copied 3x and ImageNet-normalized; 1 channel: the grayscale face in [0, 1]
+    train_transform = model_util.train_transform(parameters.input_size, parameters.in_channels)
+    eval_transform = model_util.eval_transform(parameters.input_size, parameters.in_channels)
 
     # Creating dataset instances after Converting the loaded data into pytorch dataset using FERPlusDataset
     train_dataset = FERPlusDataset(train_reader, transform=train_transform)
@@ -53,12 +54,12 @@ def main():
     print(f"🟡 Validation dataset size: {len(valid_dataset)}")
     print(f"🟡 Test dataset size: {len(test_dataset)}")
 
-    # Create DataLoaders
-    batch_size = 64
+    # Create DataLoaders (batch size and worker settings from Parameters, or from tune_loader.py)
+    options = loader_options(parameters, "resnet18")
 
-    train_loader = DataLoader(train_dataset, batch_size=batch_size, shuffle=True, num_workers=4, pin_memory=True)
-    valid_loader = DataLoader(valid_dataset, batch_size=batch_size, shuffle=False, num_workers=4, pin_memory=True)
-    test_loader = DataLoader(test_dataset, batch_size=batch_size, shuffle=False, num_workers=4, pin_memory=True)
+    train_loader = dist_util.create_loader(train_dataset, shuffle=True, **options)
+    valid_loader = dist_util.create_loader(valid_dataset, shuffle=False, **options)
+    test_loader = dist_util.create_loader(test_dataset, shuffle=False, **options)
 
     print("🟡 DataLoaders created successfully")
 
@@ -69,6 +70,15 @@ def main():
         param.requires_grad = False
     print("🟡 Froze all layers")
 
+    if parameters.in_channels == 1:
+        model = model_util.resnet_to_single_channel(model)
+        print("🟡 Folded conv1 to a single grayscale input channel")
+
+    if model_util.use_small_stem(parameters.input_size):
+        # a trainable stem would leave no frozen layers to cache features from
+        model = model_util.resnet_small_stem(model, trainable=not parameters.feature_cache)
+        print(f"🟡 Small stem for {parameters.input_size}x{parameters.input_size} input: 3x3 stride-2 conv1, no max-pool")
+
     for param in model.layer2.parameters():
         param.requires_grad = True
 
@@ -99,123 +109,34 @@ def main():
 
     print("🟡 Loss Function & Optimizer Defined")
 
-    # Train Function to train the model
-    # train_model(model, train_loader, valid_loader, test_loader, criterion, optimizer, scheduler, num_epochs=10, device=device)
-
-    # External Test
-    model.load_state_dict(torch.load("best_model.pth", weights_only=True))
-    print(test_model(model, test_loader, criterion, device))
-
-# Model Training Function
-def train_model(model, train_loader, val_loader, test_loader, criterion, optimizer, scheduler, num_epochs=10, device="cpu"):
-    
-    best_val_loss = float("inf")
-    patience = 5  # Number of epochs to wait for improvement
-    patience_counter = 0
-
-    for epoch in range(num_epochs):
-        model.train() 
-        running_loss = 0.0
-        correct = 0
-        total = 0
-
-        # Training loop
-        for batch in train_loader:
-            images = batch['image']  
-            labels = batch['emotion'] 
-            labels = labels.argmax(dim=1)
-            images, labels = images.to(device), labels.to(device)
-
-            optimizer.zero_grad()  # Reset gradients
-            outputs = model(images)  # Forward pass
-            loss = criterion(outputs, labels)  # Compute loss
-            loss.backward()  # Backpropagation
-            optimizer.step()  # Update weights
-
-            running_loss += loss.item()
-            _, predicted = torch.max(outputs, 1)
-            total += labels.size(0)
-            correct += predicted.eq(labels).sum().item()
-
-        train_loss = running_loss / len(train_loader)
-        train_acc = 100 * correct / total
-
-        # Run Validation
-        val_loss, val_acc = validate_model(model, val_loader, criterion, device)
-
-        # Save Best Model
-        if val_loss < best_val_loss:
-            best_val_loss = val_loss
-            patience_counter = 0
-            torch.save(model.state_dict(), "best_model.pth") 
-        else:
-            patience_counter += 1
-            if patience_counter >= patience:
-                print(f"🟡 Early stopping at epoch {epoch+1}.")
-                break
-
-        scheduler.step()
-
-        print(f"Epoch [{epoch+1}/{num_epochs}] | Train Loss: {train_loss:.4f} | Train Acc: {train_acc:.2f}% | Val Loss: {val_loss:.4f} | Val Acc: {val_acc:.2f}% | LR: {scheduler.get_last_lr()[0]:.6f}")
-
-    print("Training complete. Best model saved as 'best_model.pth'.")
+    # Train Function to train the model (from scratch, or continuing the interrupted run with --resume); it tests the best weights
+    if not args.test_only:
+        train_model(model, train_loader, valid_loader, test_loader, criterion, optimizer, scheduler, num_epochs=10,
+                    device=device, parameters=parameters, resume=args.resume)
+    else:
+        # External Test
+        model_util.load_weights(model, "best_model.pth")
+        print(test_model(model, test_loader, criterion, device))
+    dist_util.cleanup()
+
+# Model Training Function (the loop itself is trainer.Trainer, configured from Parameters)
+def train_model(model, train_loader, val_loader, test_loader, criterion, optimizer, scheduler, num_epochs=10, device="cpu",
+                checkpoint_path="best_model.pth", parameters=None, resume=False):
+    trainer = Trainer.from_parameters(model, criterion, parameters or Parameters(), optimizer=optimizer,
+                                      scheduler=scheduler, device=device)
+    trainer.fit(train_loader, val_loader, num_epochs, checkpoint_path, resume=resume)
 
     # Load Best Model and Run Testing
-    model.load_state_dict(torch.load("best_model.pth", weights_only=True))
-    print(test_model(model, test_loader, criterion, device))
+    model_util.load_weights(model, checkpoint_path)
+    print(trainer.test(test_loader))
 
 
 def validate_model(model, val_loader, criterion, device="cpu"):
-    model.eval()  # Set model to evaluation mode
-    val_loss = 0.0
-    val_correct = 0
-    val_total = 0
-
-    with torch.no_grad():  # No need to compute gradients
-        for batch in val_loader:
-            images = batch['image']  
-            labels = batch['emotion'] 
-            labels = labels.argmax(dim=1)
-            images, labels = images.to(device), labels.to(device)
-
-            outputs = model(images)
-            loss = criterion(outputs, labels)
-
-            val_loss += loss.item()
-            _, predicted = torch.max(outputs, 1)
-            val_total += labels.size(0)
-            val_correct += predicted.eq(labels).sum().item()
-
-    val_loss /= len(val_loader)
-    val_acc = 100 * val_correct / val_total
-
-    return val_loss, val_acc
+    return Trainer(model, criterion, device=device).evaluate(val_loader)
 
 
 def test_model(model, test_loader, criterion, device="cpu"):
-    model.eval()  # Set model to evaluation mode
-    test_loss = 0.0
-    test_correct = 0
-    test_total = 0
-
-    with torch.no_grad():
-        for batch in test_loader:
-            images = batch['image']  
-            labels = batch['emotion'] 
-            labels = labels.argmax(dim=1)
-            images, labels = images.to(device), labels.to(device)
-            outputs = model(images)
-            loss = criterion(outputs, labels)
-
-            test_loss += loss.item()
-            _, predicted = torch.max(outputs, 1)
-            test_total += labels.size(0)
-            test_correct += predicted.eq(labels).sum().item()
-
-    test_loss /= len(test_loader)
-    test_acc = 100 * test_correct / test_total
-
-    return f"Final Test Loss: {test_loss:.4f} | Final Test Accuracy: {test_acc:.2f}%"
+    return Trainer(model, criterion, device=device).test(test_loader)
 
 # To ensure script is ran correctly for multiprocessing
 if __name__ == "__main__":
@@ -1,11 +1,34 @@
 class Parameters:
     def __init__(self):
         self.target_size = 8  # FERPlus has 8 emotions
-        self.width = 224      # Resize for ResNet-18
-        self.height = 224     # Resize for ResNet-18
+        self.input_size = 224 # Resize for ResNet-18; 48-96 trains near FER2013's native 48px with a small stem
+        self.width = self.input_size
+        self.height = self.input_size
         self.shuffle = True   # Shuffle data for training
         self.training_mode = "crossentropy"  # crossentropy
         self.determinisitc = True  # Enable data augmentation
+        self.cache_folder = None  # compiled .npy dataset cache, None means <base_folder>/cache, "" disables it
+        self.in_channels = 3  # 1 feeds the grayscale face directly (see model_util.fold_to_single_channel)
+
+        # Training loop performance settings (see trainer.Trainer)
+        self.bf16 = False             # bfloat16 autocast
+        self.channels_last = False    # NHWC memory format
+        self.compile = False          # torch.compile the model
+        self.accumulation_steps = 1   # batches per optimizer step
+        self.threads = 0              # torch CPU threads, 0 keeps the default
+        self.feature_cache = None     # folder for cached frozen-layer features, None runs full forward passes
+        self.checkpoint_folder = "checkpoints"  # resumable checkpoints, None saves the best model only
+        self.checkpoint_every = 1     # epochs between resumable checkpoints (improving epochs always write one)
+        self.checkpoint_keep = 3      # resumable checkpoints retained per run, 0 keeps all
+        self.step_log = None          # JSON-lines file for per-step data/forward/backward/optimizer timings
+
+        # DataLoader settings; tune_loader.py measures the fastest ones and saves them to loader_tuning,
+        # which then takes precedence (see tune_loader.loader_options)
+        self.batch_size = 64
+        self.num_workers = 4
+        self.prefetch_factor = 2
+        self.persistent_workers = False
+        self.loader_tuning = "loader_tuning.json"
 
         # Data augmentation settings
         self.max_shift = 0.1  
@@ -0,0 +1,83 @@
+import os
+import argparse
+import torch
+from resnet_parameters import Parameters
+from torch.utils.data import DataLoader
+from ferplus import FERPlusReader, FERPlusDataset
+import model_util
+
+# Accuracy vs. CPU latency of models trained at different input resolutions, on FER2013Test.
+# Each checkpoint is evaluated at the resolution it was trained at (Parameters.input_size), which
+# newer checkpoints record themselves; SIZE= overrides or supplies it.
+#
+#   python resolution_sweep.py --model 224=best_model.pth --model 64=best_model_64.pth --model 48=best_model_48.pth
+#
+# Prints a markdown table; --output also writes it to a file.
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Compare FERPlus models trained at different resolutions.")
+    parser.add_argument("--model", action="append", required=True, metavar="[SIZE=]CHECKPOINT",
+                        help="input size and checkpoint, can be repeated")
+    parser.add_argument("--base-folder", default="Datasets/FERPlus-master/data")
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--threads", type=int, default=0, help="torch CPU threads for the latency runs, 0 keeps the default")
+    parser.add_argument("--output", default=None, help="markdown file for the table")
+    return parser.parse_args()
+
+def test_accuracy(model, reader, input_size, batch_size):
+    dataset = FERPlusDataset(reader, transform=model_util.eval_transform(input_size, model_util.input_channels(model)))
+    loader = DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=2)
+
+    correct, total = 0, 0
+    with torch.no_grad():
+        for batch in loader:
+            labels = batch['emotion'].argmax(dim=1)
+            correct += model(batch['image']).argmax(dim=1).eq(labels).sum().item()
+            total += labels.size(0)
+    return 100 * correct / total
+
+def main():
+    args = parse_args()
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+
+    reader = FERPlusReader.create(args.base_folder, ["FER2013Test"], "label.csv", Parameters()) \
+        if os.path.isdir(args.base_folder) else None
+    if reader is None:
+        print(f"🟡 {args.base_folder} not found, reporting latency only")
+
+    rows = []
+    for spec in args.model:
+        size, path = spec.split("=", 1) if "=" in spec else (None, spec)
+        config = model_util.checkpoint_config(path)
+        size = int(size or config["input_size"] or 0)
+        if not size:
+            raise SystemExit(f"{path} does not record its input size, pass it as SIZE={path}")
+        model = model_util.load_checkpoint(path)
+        in_channels = model_util.input_channels(model)
+        accuracy = test_accuracy(model, reader, size, args.batch_size) if reader else None
+        single = model_util.measure_latency(model, batch_size=1, input_size=size, in_channels=in_channels)
+        batched = model_util.measure_latency(model, batch_size=16, input_size=size, in_channels=in_channels)
+        rows.append({"size": size, "checkpoint": os.path.basename(path), "channels": in_channels,
+                     "stem": "small" if config["small_stem"] else "standard",
+                     "accuracy": accuracy, "batch1_ms": single["median_ms"],
+                     "batch16_img_s": 16 * 1000.0 / batched["median_ms"]})
+        print(f"🟡 {path} at {size}x{size} done")
+
+    reference = max(rows, key=lambda r: r["size"])
+    lines = ["| input | checkpoint | channels | stem | FER2013Test acc | batch 1 ms | batch 16 img/s | speedup |",
+             "|---|---|---|---|---|---|---|---|"]
+    for r in sorted(rows, key=lambda r: r["size"]):
+        accuracy = f"{r['accuracy']:.2f}%" if r["accuracy"] is not None else "n/a"
+        lines.append(f"| {r['size']}x{r['size']} | {r['checkpoint']} | {r['channels']} | {r['stem']} | {accuracy} | "
+                     f"{r['batch1_ms']:.2f} | {r['batch16_img_s']:.1f} | {reference['batch1_ms'] / r['batch1_ms']:.1f}x |")
+    table = "\n".join(lines)
+    print(f"Threads: {torch.get_num_threads()} | speedup is batch 1 latency relative to {reference['size']}x{reference['size']}")
+    print(table)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(table + "\n")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+# test_checkpoint.py
+#
+#   cd emotion-recognition && python -m pytest -q test_checkpoint.py
+import os
+import pytest
+import torch
+import torch.nn as nn
+import torch.optim as optim
+from torch.optim.lr_scheduler import StepLR
+from torch.utils.data import DataLoader
+import model_util
+from checkpoint import Checkpoints
+from trainer import Trainer
+
+
+def random_faces(count=8, size=48):
+    return [{"image": torch.rand(1, size, size), "emotion": torch.eye(model_util.EMOTION_COUNT)[i % model_util.EMOTION_COUNT]}
+            for i in range(count)]
+
+
+def trainer(folder, input_size=48):
+    model = model_util.create_student("compact")
+    optimizer = optim.Adam(model.parameters(), lr=1e-3)
+    return Trainer(model, nn.CrossEntropyLoss(), optimizer, StepLR(optimizer, step_size=1),
+                   checkpoint_folder=folder, input_size=input_size)
+
+
+def test_fresh_run_replaces_an_earlier_runs_checkpoints(tmp_path):
+    loader = DataLoader(random_faces(), batch_size=4)
+    best = str(tmp_path / "best_model.pth")
+    trainer(str(tmp_path)).fit(loader, loader, 3, best)
+    assert len(Checkpoints(best, str(tmp_path)).paths()) == 3
+
+    trainer(str(tmp_path)).fit(loader, loader, 1, best)
+    assert [os.path.basename(p) for p in Checkpoints(best, str(tmp_path)).paths()] == ["best_model-epoch0001.pt"]
+
+
+def test_resume_rejects_a_checkpoint_of_another_model(tmp_path):
+    loader = DataLoader(random_faces(), batch_size=4)
+    best = str(tmp_path / "best_model.pth")
+    trainer(str(tmp_path), input_size=48).fit(loader, loader, 1, best)
+
+    with pytest.raises(ValueError, match="different model"):
+        trainer(str(tmp_path), input_size=64).fit(loader, loader, 2, best, resume=True)
+
+    resumed = trainer(str(tmp_path), input_size=48)
+    resumed.fit(loader, loader, 2, best, resume=True)
+    assert resumed.epoch == 1
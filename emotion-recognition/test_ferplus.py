@@ -0,0 +1,95 @@
+# test_ferplus.py
+#
+#   cd emotion-recognition && python -m pytest -q test_ferplus.py
+import numpy as np
+import pytest
+from ferplus import process_votes, process_targets
+
+# 8 emotions, unknown, non-face
+VOTES = np.array([
+    [6, 2, 1, 1, 0, 0, 0, 0, 0, 0],     # clear majority, single votes are dropped as outliers
+    [4, 4, 2, 0, 0, 0, 0, 0, 0, 0],     # tie between two emotions
+    [5, 3, 2, 0, 0, 0, 0, 0, 0, 0],     # two rounds to reach 75% of the votes
+    [3, 0, 0, 0, 0, 0, 0, 0, 3, 2],     # emotion tied with unknown
+    [0, 0, 0, 0, 0, 0, 0, 0, 0, 10],    # not a face
+], dtype=np.float64)
+
+UNKNOWN = [0, 0, 0, 0, 0, 0, 0, 0, 1, 0]
+NOT_A_FACE = [0, 0, 0, 0, 0, 0, 0, 0, 0, 1]
+PROBABILITY = [
+    [1, 0, 0, 0, 0, 0, 0, 0, 0, 0],
+    [0.5, 0.5, 0, 0, 0, 0, 0, 0, 0, 0],
+    [0.625, 0.375, 0, 0, 0, 0, 0, 0, 0, 0],
+    UNKNOWN,                            # the emotion alone holds too few votes
+    NOT_A_FACE,
+]
+EXPECTED = {
+    "majority": [
+        [1, 0, 0, 0, 0, 0, 0, 0, 0, 0],
+        UNKNOWN,                        # no emotion holds more than half the votes
+        UNKNOWN,
+        UNKNOWN,
+        NOT_A_FACE,
+    ],
+    "probability": PROBABILITY,
+    "crossentropy": PROBABILITY,
+    "multi_target": [
+        [1, 0, 0, 0, 0, 0, 0, 0, 0, 0],
+        [0.5, 0.5, 0, 0, 0, 0, 0, 0, 0, 0],
+        [0.625, 0.375, 0, 0, 0, 0, 0, 0, 0, 0],
+        [0.5, 0, 0, 0, 0, 0, 0, 0, 0.5, 0],
+        NOT_A_FACE,
+    ],
+}
+# FERPlusReader keeps the rows whose most likely label is an emotion
+KEPT = {
+    "majority": [True, False, False, False, False],
+    "probability": [True, True, True, False, False],
+    "crossentropy": [True, True, True, False, False],
+    "multi_target": [True, True, True, True, False],
+}
+
+
+@pytest.mark.parametrize("mode", sorted(EXPECTED))
+def test_process_votes(mode):
+    votes = VOTES.copy()
+    emotion = process_votes(votes, mode)
+    np.testing.assert_array_equal(votes, VOTES)
+    np.testing.assert_allclose(emotion, EXPECTED[mode], rtol=0, atol=1e-12)
+    assert (np.argmax(emotion, axis=1) < 8).tolist() == KEPT[mode]
+
+
+def test_process_votes_rejects_an_unknown_mode():
+    with pytest.raises(ValueError):
+        process_votes(VOTES, "vote")
+
+
+TARGETS = np.array([
+    [1, 0, 0, 0, 0, 0, 0, 0],
+    [0.5, 0.5, 0, 0, 0, 0, 0, 0],
+    [0.625, 0.375, 0, 0, 0, 0, 0, 0],
+    [0, 0, 0, 0, 0, 0, 0.25, 0.75],
+])
+
+
+@pytest.mark.parametrize("mode", ["majority", "crossentropy"])
+def test_process_targets_passes_distributions_through(mode):
+    np.testing.assert_array_equal(process_targets(TARGETS, mode), TARGETS)
+
+
+def test_process_targets_multi_target():
+    expected = np.full(TARGETS.shape, 0.001)
+    expected[TARGETS > 0] = 1.0
+    np.testing.assert_allclose(process_targets(TARGETS, "multi_target"), expected, rtol=0, atol=1e-12)
+
+
+def test_process_targets_probability_draws_like_random_choice():
+    targets = np.tile(TARGETS, (50, 1))
+    drawn = process_targets(targets, "probability", np.random.RandomState(0))
+
+    rng = np.random.RandomState(0)
+    expected = np.zeros_like(targets)
+    for row, target in enumerate(targets):
+        expected[row, rng.choice(len(target), p=target)] = 1.0
+    np.testing.assert_array_equal(drawn, expected)
+    assert (drawn[::4, 0] == 1).all()
@@ -0,0 +1,78 @@
+# test_model_util.py
+#
+#   cd emotion-recognition && python -m pytest -q test_model_util.py
+import copy
+import pytest
+import torch
+import model_util
+from checkpoint import Checkpoints
+from feature_cache import split_frozen
+
+
+def small_stem_models():
+    resnet = model_util.create_resnet18(in_channels=1, small_stem=True)
+    efficientnet = model_util.efficientnet_small_stem(model_util.create_efficientnet_b0(in_channels=1))
+    return [("resnet18", resnet), ("efficientnet_b0", efficientnet)]
+
+
+@pytest.mark.parametrize("arch,model", small_stem_models())
+def test_small_stem_survives_a_checkpoint_round_trip(tmp_path, arch, model):
+    model.eval()
+    path = str(tmp_path / "best_model.pth")
+    checkpoints = Checkpoints(path, input_size=48)
+    checkpoints.save_best(model)
+    checkpoints.close()
+
+    assert model_util.checkpoint_config(path) == {"arch": arch, "in_channels": 1, "small_stem": True, "input_size": 48}
+    loaded = model_util.load_checkpoint(path)
+    assert model_util.model_config(loaded, 48) == model_util.checkpoint_config(path)
+
+    images = torch.rand(2, 1, 48, 48)
+    with torch.no_grad():
+        torch.testing.assert_close(loaded(images), model(images))
+
+
+def test_plain_state_dicts_still_load(tmp_path):
+    model = model_util.create_resnet18(in_channels=3, small_stem=True).eval()
+    path = str(tmp_path / "legacy.pth")
+    torch.save(model.state_dict(), path)
+
+    assert model_util.checkpoint_config(path) == {"arch": "resnet18", "in_channels": 3, "small_stem": True, "input_size": None}
+    assert model_util.model_config(model_util.load_checkpoint(path))["small_stem"]
+    model_util.load_weights(model_util.create_resnet18(in_channels=3, small_stem=True), path)
+
+
+def normalized(gray):
+    mean = torch.tensor(model_util.IMAGENET_MEAN).view(1, 3, 1, 1)
+    std = torch.tensor(model_util.IMAGENET_STD).view(1, 3, 1, 1)
+    return (gray.repeat(1, 3, 1, 1) - mean) / std
+
+
+@pytest.mark.parametrize("create,fold", [(model_util.create_resnet18, model_util.resnet_to_single_channel),
+                                         (model_util.create_efficientnet_b0, model_util.efficientnet_to_single_channel)])
+def test_single_channel_fold_is_exact_for_its_input_size(tmp_path, create, fold):
+    torch.manual_seed(0)
+    model = create().eval()
+    # non-trivial BatchNorm statistics, so the folded offset matters
+    for module in model.modules():
+        if isinstance(module, torch.nn.BatchNorm2d):
+            module.running_mean.uniform_(-1, 1)
+    gray = torch.rand(4, 1, 64, 64)
+    with torch.no_grad():
+        reference = model(normalized(gray))
+        exact = fold(copy.deepcopy(model), input_size=64)
+        torch.testing.assert_close(exact(gray), reference, rtol=1e-4, atol=1e-4)
+
+    path = str(tmp_path / "model_1ch.pth")
+    torch.save(model_util.checkpoint_state(exact, 64), path)
+    with torch.no_grad():
+        torch.testing.assert_close(model_util.load_checkpoint(path)(gray), reference, rtol=1e-4, atol=1e-4)
+
+
+@pytest.mark.parametrize("stem", [model_util.resnet_small_stem, model_util.efficientnet_small_stem])
+def test_frozen_small_stem_leaves_a_prefix_to_cache(stem):
+    model = model_util.create_resnet18() if stem is model_util.resnet_small_stem else model_util.create_efficientnet_b0()
+    for param in model.parameters():
+        param.requires_grad = False
+    assert len(split_frozen(stem(copy.deepcopy(model)))[0]) == 0
+    assert len(split_frozen(stem(model, trainable=False))[0]) > 0
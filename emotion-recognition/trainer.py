@@ -0,0 +1,289 @@
+import time
+import json
+import contextlib
+import torch
+import dist_util
+from feature_cache import FeatureCache
+from checkpoint import Checkpoints, rng_state
+
+# The training loop shared by resnet_model_train.py and EfficientNet_model_train.py (and the
+# scripts built on their train_model / validate_model / test_model).
+#
+# CPU options, all off by default so a plain Trainer behaves like the original fp32 eager loops:
+#   bf16                bfloat16 autocast for forward and loss (weights and optimizer stay fp32)
+#   channels_last       NHWC weights and batches, which oneDNN convolutions prefer
+#   compile             torch.compile the model (the first epoch pays for compilation)
+#   accumulation_steps  step the optimizer every N batches, for larger effective batches
+#   threads             torch intra-op threads, 0 keeps the default
+#   feature_cache       folder for cached frozen-prefix outputs: while the leading layers are
+#                       frozen, only the rest of the model trains, on cached features (see feature_cache.py)
+#
+# Checkpoints are written by a background thread: the best weights whenever the validation loss
+# improves, and with checkpoint_folder set, resumable checkpoints every checkpoint_every epochs
+# and on improvement, the last checkpoint_keep of them retained (see checkpoint.py). The best
+# weights are saved with the model's build config and input_size (see model_util.model_config).
+#
+# Loss and accuracy are accumulated in tensors and read once per epoch, so the loop does not
+# synchronize on loss.item() every step.
+#
+# Each training step is timed by phase: waiting on the DataLoader (including the copy to the
+# device), forward with loss, backward, optimizer. The epoch line reports the share of time spent
+# waiting on data; with step_log set, every step and an epoch summary are also appended to that
+# file as JSON lines (one file per rank when distributed), e.g.
+#   {"event": "step", "epoch": 1, "step": 12, "rank": 0, "images": 64, "data_s": 0.003, "forward_s": 0.041,
+#    "backward_s": 0.083, "optimizer_s": 0.006, "step_s": 0.134, "images_per_s": 477.6}
+#
+# Under torchrun (see dist_util.py) the same loop trains data-parallel: the model is wrapped in
+# DistributedDataParallel, metrics are summed over all processes, only rank 0 prints and writes
+# checkpoints. Feature caching is single-process only and is skipped there.
+
+class Trainer:
+    '''
+    Trains, validates and tests one model. `on_epoch_start(epoch, model)` is called before each
+    training epoch, e.g. for progressive unfreezing.
+    '''
+    def __init__(self, model, criterion, optimizer=None, scheduler=None, device="cpu", bf16=False,
+                 channels_last=False, compile=False, accumulation_steps=1, threads=0, patience=5,
+                 on_epoch_start=None, feature_cache=None, checkpoint_folder=None, checkpoint_every=1,
+                 checkpoint_keep=3, step_log=None, input_size=None):
+        self.device = torch.device(device)
+        self.memory_format = torch.channels_last if channels_last else torch.preserve_format
+        self.model = model.to(self.device, memory_format=self.memory_format)
+        # checkpoints are taken from self.model, the compiled wrapper prefixes its state dict keys
+        self.compile = compile
+        self.forward_model = torch.compile(self.model) if compile else self.model
+        self.parallel_model, self.trainable = None, None
+        self.criterion = criterion
+        self.optimizer = optimizer
+        self.scheduler = scheduler
+        self.bf16 = bf16
+        self.accumulation_steps = max(1, accumulation_steps)
+        self.patience = patience
+        self.on_epoch_start = on_epoch_start
+        self.feature_cache = FeatureCache(self.model, feature_cache) \
+            if feature_cache and not dist_util.is_distributed() else None
+        if feature_cache and not (self.feature_cache and self.feature_cache.active()):
+            self.log(f"🟡 Feature cache {feature_cache} unused: " + ("not supported with DDP" if dist_util.is_distributed()
+                     else "the model's leading layers are trainable") + ", training runs full forward passes")
+        self.checkpoint_options = {"folder": checkpoint_folder, "every": checkpoint_every, "keep": checkpoint_keep,
+                                   "input_size": input_size}
+        self.step_log = step_log
+        self.epoch = 0
+        self.last_timings = None
+        if threads > 0:
+            torch.set_num_threads(threads)
+
+    @classmethod
+    def from_parameters(cls, model, criterion, parameters, **kwargs):
+        '''
+        Trainer with the performance options of a resnet_parameters.Parameters.
+        '''
+        return cls(model, criterion, bf16=parameters.bf16, channels_last=parameters.channels_last,
+                   compile=parameters.compile, accumulation_steps=parameters.accumulation_steps,
+                   threads=parameters.threads, feature_cache=parameters.feature_cache,
+                   checkpoint_folder=parameters.checkpoint_folder, checkpoint_every=parameters.checkpoint_every,
+                   checkpoint_keep=parameters.checkpoint_keep, step_log=parameters.step_log,
+                   input_size=parameters.input_size, **kwargs)
+
+    def autocast(self):
+        if not self.bf16:
+            return contextlib.nullcontext()
+        return torch.autocast(device_type=self.device.type, dtype=torch.bfloat16)
+
+    def batch(self, batch):
+        images = batch['image'].to(self.device, non_blocking=True)
+        if images.dim() == 4:
+            images = images.to(memory_format=self.memory_format)
+        labels = batch['emotion'].argmax(dim=1).to(self.device, non_blocking=True)
+        return images, labels
+
+    def training_model(self):
+        '''
+        The model to train through: forward_model, or when distributed a DistributedDataParallel
+        wrapper, rebuilt whenever the set of trainable parameters changed.
+        '''
+        if not dist_util.is_distributed():
+            return self.forward_model
+        trainable = tuple(param.requires_grad for param in self.model.parameters())
+        if trainable != self.trainable:
+            self.trainable = trainable
+            model = dist_util.parallel(self.model)
+            self.parallel_model = torch.compile(model) if self.compile else model
+        return self.parallel_model
+
+    def clock(self):
+        # CUDA runs asynchronously, so its phases are only separated when every step is logged
+        if self.step_log and self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+        return time.perf_counter()
+
+    def train_epoch(self, loader, model=None):
+        '''
+        One pass over `loader`, through `model` (default: the whole model).
+        Returns (mean batch loss, accuracy %, images per second), over all processes when distributed.
+        The phase breakdown of this process is left in last_timings.
+        '''
+        model = model or self.training_model()
+        model.train()
+        loss_sum = torch.zeros((), device=self.device)
+        correct = torch.zeros((), dtype=torch.long, device=self.device)
+        total = 0
+        steps = len(loader)
+        timings = {"data_s": 0.0, "forward_s": 0.0, "backward_s": 0.0, "optimizer_s": 0.0}
+        log = open(self.step_log_path(), "a") if self.step_log else None
+
+        start = time.perf_counter()
+        tick = start
+        self.optimizer.zero_grad(set_to_none=True)
+        try:
+            for step, batch in enumerate(loader, 1):
+                images, labels = self.batch(batch)
+                loaded = self.clock()
+                with self.autocast():
+                    outputs = model(images)
+                    loss = self.criterion(outputs.float(), labels)
+                forwarded = self.clock()
+                (loss / self.accumulation_steps).backward()
+                backwarded = self.clock()
+
+                # the last batches still step when the epoch does not divide into accumulation_steps
+                if step % self.accumulation_steps == 0 or step == steps:
+                    self.optimizer.step()
+                    self.optimizer.zero_grad(set_to_none=True)
+
+                loss_sum += loss.detach()
+                correct += outputs.detach().argmax(dim=1).eq(labels).sum()
+                total += labels.size(0)
+                done = self.clock()
+
+                phases = {"data_s": loaded - tick, "forward_s": forwarded - loaded,
+                          "backward_s": backwarded - forwarded, "optimizer_s": done - backwarded}
+                for name, seconds in phases.items():
+                    timings[name] += seconds
+                if log:
+                    log.write(json.dumps({"event": "step", "epoch": self.epoch + 1, "step": step, "rank": dist_util.rank(),
+                                          "images": labels.size(0), **phases, "step_s": done - tick,
+                                          "images_per_s": labels.size(0) / (done - tick)}) + "\n")
+                tick = done
+            elapsed = time.perf_counter() - start
+
+            self.last_timings = {**timings, "seconds": elapsed, "images": total, "images_per_s": total / elapsed,
+                                 "data_fraction": timings["data_s"] / elapsed}
+            if log:
+                log.write(json.dumps({"event": "epoch", "epoch": self.epoch + 1, "rank": dist_util.rank(),
+                                      "steps": steps, **self.last_timings}) + "\n")
+        finally:
+            if log:
+                log.close()
+        dist_util.sync_buffers(self.model)
+
+        loss_sum, correct, total, steps = dist_util.all_reduce([loss_sum.item(), correct.item(), total, steps])
+        elapsed, = dist_util.all_reduce([elapsed], op="max")
+        return loss_sum / steps, 100 * correct / total, total / elapsed
+
+    def step_log_path(self):
+        if dist_util.world_size() > 1:
+            return "%s.rank%d" % (self.step_log, dist_util.rank())
+        return self.step_log
+
+    def evaluate(self, loader, model=None):
+        '''
+        Returns (mean batch loss, accuracy %) over `loader`, through `model` (default: the whole model).
+        When distributed, `loader` holds this process' shard and the results cover all of them.
+        '''
+        model = model or self.forward_model
+        model.eval()
+        loss_sum = torch.zeros((), device=self.device)
+        correct = torch.zeros((), dtype=torch.long, device=self.device)
+        total = 0
+
+        with torch.no_grad(), self.autocast():
+            for batch in loader:
+                images, labels = self.batch(batch)
+                outputs = model(images)
+                loss_sum += self.criterion(outputs.float(), labels)
+                correct += outputs.argmax(dim=1).eq(labels).sum()
+                total += labels.size(0)
+
+        loss_sum, correct, total, steps = dist_util.all_reduce([loss_sum.item(), correct.item(), total, len(loader)])
+        return loss_sum / steps, 100 * correct / total
+
+    def fit(self, train_loader, val_loader, num_epochs=10, checkpoint_path="best_model.pth", resume=False):
+        '''
+        Train with early stopping on the validation loss, saving the best weights to checkpoint_path.
+        With resume, continue from this run's latest resumable checkpoint if there is one; without,
+        delete this run's earlier checkpoints so they cannot be resumed or pruned in place of the new ones.
+        '''
+        checkpoints = Checkpoints(checkpoint_path, main=dist_util.is_main(), **self.checkpoint_options)
+        best_val_loss = float("inf")
+        patience_counter = 0
+        start_epoch = 0
+
+        latest = checkpoints.latest() if resume else None
+        if latest:
+            start_epoch, best_val_loss, patience_counter, stopped = checkpoints.load(
+                latest, self.model, self.optimizer, self.scheduler, dist_util.rank())
+            self.log(f"🟡 Resumed from '{latest}' at epoch {start_epoch+1}")
+            if stopped:
+                self.log("🟡 That run had already stopped early.")
+                start_epoch = num_epochs
+        elif resume:
+            self.log("🟡 No checkpoint to resume from, starting from scratch")
+        else:
+            cleared = checkpoints.clear()
+            if cleared:
+                self.log(f"🟡 Training from scratch, removed {cleared} checkpoint(s) of an earlier run from '{checkpoints.folder}'")
+
+        try:
+            self._fit_epochs(train_loader, val_loader, start_epoch, num_epochs, checkpoints, best_val_loss, patience_counter)
+        finally:
+            checkpoints.close()
+        # the other processes may read checkpoint_path next
+        dist_util.barrier()
+        self.log(f"Training complete. Best model saved as '{checkpoint_path}'.")
+
+    def _fit_epochs(self, train_loader, val_loader, start_epoch, num_epochs, checkpoints, best_val_loss, patience_counter):
+        for epoch in range(start_epoch, num_epochs):
+            self.epoch = epoch
+            if self.on_epoch_start:
+                self.on_epoch_start(epoch, self.model)
+            dist_util.set_epoch(train_loader, epoch)
+
+            if self.feature_cache and self.feature_cache.active():
+                cached_train, cached_val = self.feature_cache.loaders(train_loader, val_loader, self.device)
+                train_loss, train_acc, images_per_second = self.train_epoch(cached_train, self.feature_cache.head)
+                val_loss, val_acc = self.evaluate(cached_val, self.feature_cache.head)
+            else:
+                train_loss, train_acc, images_per_second = self.train_epoch(train_loader)
+                val_loss, val_acc = self.evaluate(val_loader)
+
+            improved = val_loss < best_val_loss
+            if improved:
+                best_val_loss = val_loss
+                patience_counter = 0
+                checkpoints.save_best(self.model)
+            else:
+                patience_counter += 1
+                if patience_counter >= self.patience:
+                    self.log(f"🟡 Early stopping at epoch {epoch+1}.")
+                    if checkpoints.folder:
+                        checkpoints.save(epoch, self.model, self.optimizer, self.scheduler, best_val_loss,
+                                         patience_counter, stopped=True, rng=dist_util.all_gather(rng_state()))
+                    break
+
+            self.scheduler.step()
+            if checkpoints.due(epoch, improved):
+                checkpoints.save(epoch, self.model, self.optimizer, self.scheduler, best_val_loss, patience_counter,
+                                 rng=dist_util.all_gather(rng_state()))
+
+            self.log(f"Epoch [{epoch+1}/{num_epochs}] | Train Loss: {train_loss:.4f} | Train Acc: {train_acc:.2f}% | "
+                  f"Val Loss: {val_loss:.4f} | Val Acc: {val_acc:.2f}% | LR: {self.scheduler.get_last_lr()[0]:.6f} | "
+                  f"{images_per_second:.1f} img/s | Data Wait: {100 * self.last_timings['data_fraction']:.0f}%")
+
+    def log(self, message):
+        if dist_util.is_main():
+            print(message)
+
+    def test(self, loader):
+        test_loss, test_acc = self.evaluate(loader)
+        return f"Final Test Loss: {test_loss:.4f} | Final Test Accuracy: {test_acc:.2f}%"
@@ -0,0 +1,161 @@
+import os
+import copy
+import json
+import types
+import argparse
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.optim as optim
+from torch.utils.data import DataLoader, Subset
+from resnet_parameters import Parameters
+from ferplus import FERPlusReader, FERPlusDataset
+from trainer import Trainer
+import model_util
+
+# Pick the fastest DataLoader settings (num_workers, prefetch_factor, persistent_workers, batch
+# size) for training a FERPlus model on this machine, and record them for the training scripts.
+#
+#   python tune_loader.py --arch resnet18 --steps 200
+#   python tune_loader.py --arch efficientnet_b0 --workers 0,2,4,8,16 --batch-sizes 32,64,128,256
+#
+# Each candidate trains a copy of the model for --steps steps, split over two passes so worker
+# start-up (which persistent_workers saves after the first epoch) is counted, and is scored by
+# images/sec; the share of time blocked on the loader is reported next to it. The search changes
+# one setting at a time in the order above, keeping the best value of each before moving on.
+# Results go to Parameters.loader_tuning under the model's name, where loader_options() finds them.
+
+ARCHS = ["resnet18", "efficientnet_b0"]
+
+def loader_kwargs(batch_size, num_workers, prefetch_factor, persistent_workers):
+    '''
+    DataLoader keyword arguments; prefetching and persistent workers only exist with worker processes.
+    '''
+    return {"batch_size": batch_size, "num_workers": num_workers, "pin_memory": True,
+            "prefetch_factor": prefetch_factor if num_workers > 0 else None,
+            "persistent_workers": persistent_workers and num_workers > 0}
+
+def loader_options(parameters, arch):
+    '''
+    DataLoader keyword arguments for training `arch`: the Parameters loader settings, replaced by
+    the tune_loader.py result for `arch` if parameters.loader_tuning holds one.
+    '''
+    settings = {"batch_size": parameters.batch_size, "num_workers": parameters.num_workers,
+                "prefetch_factor": parameters.prefetch_factor, "persistent_workers": parameters.persistent_workers}
+    if parameters.loader_tuning and os.path.exists(parameters.loader_tuning):
+        with open(parameters.loader_tuning) as f:
+            settings.update(json.load(f).get(arch, {}).get("settings", {}))
+    return loader_kwargs(**settings)
+
+def training_model(arch, parameters):
+    '''
+    The model as the training script starts it, frozen layers included, since they change the cost of backward.
+    '''
+    if arch == "resnet18":
+        model = model_util.create_resnet18(in_channels=parameters.in_channels,
+                                           small_stem=model_util.use_small_stem(parameters.input_size))
+        frozen = [model.layer1] if model_util.use_small_stem(parameters.input_size) else \
+            [model.conv1, model.bn1, model.layer1]
+    else:
+        model = model_util.create_efficientnet_b0(in_channels=parameters.in_channels)
+        frozen = [model.features]
+    for module in frozen:
+        for param in module.parameters():
+            param.requires_grad = False
+    return model
+
+def synthetic_reader(count, size=48, seed=0):
+    '''
+    Stand-in for a FERPlusReader with random 48x48 faces, so FERPlusDataset runs its real transforms.
+    '''
+    rng = np.random.RandomState(seed)
+    labels = rng.dirichlet(np.ones(model_util.EMOTION_COUNT), count).astype(np.float32)
+    return types.SimpleNamespace(images=rng.randint(0, 256, (count, size, size), dtype=np.uint8), labels=labels,
+                                 rects=np.tile(np.array([0, 0, size, size], dtype=np.int32), (count, 1)))
+
+def measure(model, dataset, settings, steps, parameters, seed=0):
+    '''
+    Train a copy of `model` for `steps` steps over two passes with the given loader settings.
+    Returns (images/sec, fraction of time waiting on data).
+    '''
+    model = copy.deepcopy(model)
+    optimizer = optim.Adam([p for p in model.parameters() if p.requires_grad], lr=1e-4)
+    trainer = Trainer.from_parameters(model, nn.CrossEntropyLoss(), parameters, optimizer=optimizer)
+    trainer.step_log = None
+
+    count = min(len(dataset), max(1, steps // 2) * settings["batch_size"])
+    subset = Subset(dataset, np.random.RandomState(seed).permutation(len(dataset))[:count].tolist())
+    loader = DataLoader(subset, shuffle=True, drop_last=False, **loader_kwargs(**settings))
+
+    images, seconds, waiting = 0, 0.0, 0.0
+    for _ in range(2):
+        trainer.train_epoch(loader)
+        images += trainer.last_timings["images"]
+        seconds += trainer.last_timings["seconds"]
+        waiting += trainer.last_timings["data_s"]
+    return images / seconds, waiting / seconds
+
+def autotune(model, dataset, candidates, steps, parameters, report=print):
+    '''
+    One-setting-at-a-time search over `candidates` ({setting: [values]}), starting from the first
+    value of each. Returns (best settings, images/sec, data fraction, all measured rows).
+    '''
+    best = {name: values[0] for name, values in candidates.items()}
+    measured = {}
+    for name, values in candidates.items():
+        # prefetching and persistence make no difference without workers
+        if name in ("prefetch_factor", "persistent_workers") and best["num_workers"] == 0:
+            continue
+        for value in values:
+            settings = {**best, name: value}
+            key = tuple(sorted(settings.items()))
+            if key not in measured:
+                measured[key] = measure(model, dataset, settings, steps, parameters)
+                report(f"  {json.dumps(settings)}: {measured[key][0]:.1f} img/s, data wait {100 * measured[key][1]:.0f}%")
+        best[name] = max(values, key=lambda value: measured.get(tuple(sorted({**best, name: value}.items())), (0.0,))[0])
+    throughput, data_fraction = measured[tuple(sorted(best.items()))]
+    return best, throughput, data_fraction, measured
+
+def main():
+    parameters = Parameters()
+    parser = argparse.ArgumentParser(description="Auto-tune the FERPlus training DataLoader.")
+    parser.add_argument("--arch", choices=ARCHS, default="resnet18")
+    parser.add_argument("--steps", type=int, default=200, help="training steps per candidate")
+    parser.add_argument("--workers", default="0,2,4,8")
+    parser.add_argument("--prefetch", default="2,4,8")
+    parser.add_argument("--persistent", default="0,1")
+    parser.add_argument("--batch-sizes", default="64,32,128")
+    parser.add_argument("--base-folder", default="Datasets/FERPlus-master/data")
+    parser.add_argument("--synthetic", type=int, default=8192, help="random faces to use when --base-folder is missing")
+    parser.add_argument("--output", default=parameters.loader_tuning)
+    args = parser.parse_args()
+
+    if os.path.isdir(args.base_folder):
+        reader = FERPlusReader.create(args.base_folder, ["FER2013Train"], "label.csv", parameters)
+    else:
+        print(f"🟡 {args.base_folder} not found, tuning on {args.synthetic} random faces")
+        reader = synthetic_reader(args.synthetic)
+    dataset = FERPlusDataset(reader, transform=model_util.train_transform(parameters.input_size, parameters.in_channels))
+    model = training_model(args.arch, parameters)
+
+    candidates = {"num_workers": [int(w) for w in args.workers.split(",")],
+                  "prefetch_factor": [int(p) for p in args.prefetch.split(",")],
+                  "persistent_workers": [p == "1" for p in args.persistent.split(",")],
+                  "batch_size": [int(b) for b in args.batch_sizes.split(",")]}
+    print(f"🟡 Tuning the {args.arch} loader at {parameters.input_size}x{parameters.input_size}, "
+          f"{args.steps} steps per candidate, {torch.get_num_threads()} threads, {os.cpu_count()} cores")
+    best, throughput, data_fraction, _ = autotune(model, dataset, candidates, args.steps, parameters)
+    print(f"🟡 Best: {json.dumps(best)} | {throughput:.1f} img/s | data wait {100 * data_fraction:.0f}%")
+
+    results = {}
+    if os.path.exists(args.output):
+        with open(args.output) as f:
+            results = json.load(f)
+    results[args.arch] = {"settings": best, "images_per_s": throughput, "data_fraction": data_fraction,
+                          "input_size": parameters.input_size, "in_channels": parameters.in_channels}
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"🟡 Saved to {args.output}; the training scripts pick it up through Parameters.loader_tuning")
+
+if __name__ == "__main__":
+    main()